@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import tenacity
+from firecloud.errors import FireCloudServerError
+
+from workspace_test_report import clone_workspace
+from workflow_dag import load_workflow_config
+
+
+async def run_blocking(semaphore, func, *args, **kwargs):
+    ''' run a blocking FISS/GCS call on the worker pool, holding the shared semaphore
+    so that no more than max_concurrency calls are in flight at once
+    '''
+    async with semaphore:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+
+async def test_workspace(ws, args, clone_time, gcs_path, send_notifications, semaphore, progress, scheduler=None,
+                         checkpoint=None, clone_ws=None):
+    ''' clone a single featured workspace, run its submissions until they finish, and generate its report.
+    each workspace is its own task, so a slow clone or a long-running workflow never blocks the others.
+    if clone_ws is passed (from a resumed run), cloning and submission setup are skipped.
+    '''
+    checkpoint = checkpoint or (lambda key, ws: None)
+    try:
+        if clone_ws is None:
+            clone_ws = await run_blocking(semaphore, clone_workspace,
+                                          ws.project, ws.workspace, args.clone_project,
+                                          clone_time=clone_time, share_with=args.share_with,
+                                          call_cache=args.call_cache, verbose=args.verbose)
+            await run_blocking(semaphore, clone_ws.create_submissions, verbose=args.verbose,
+                               dependencies=load_workflow_config(args.workflow_config).get(ws.key))
+            clone_ws.start_timer()
+            checkpoint(ws.key, clone_ws)
+        elif clone_ws.status is not None:  # already reported
+            return clone_ws
+
+        # poll this workspace until all its submissions are in a terminal state
+        while True:
+            await run_blocking(semaphore, clone_ws.check_submissions,
+                               abort_hr=args.abort_hr, verbose=False, scheduler=scheduler)
+            checkpoint(ws.key, clone_ws)
+            if not clone_ws.active_submissions:
+                break
+            if scheduler is not None:
+                # sleep until the next of this workspace's submissions is due to be checked
+                wait = scheduler.seconds_until_due([sub for sub in clone_ws.active_submissions
+                                                    if sub.status is not None])
+                await asyncio.sleep(max(wait if wait is not None else args.min_poll_interval, 1))
+            else:
+                await asyncio.sleep(args.sleep_time)
+
+        clone_ws.stop_timer()
+        await run_blocking(semaphore, clone_ws.generate_workspace_report, gcs_path, send_notifications, args.verbose)
+        checkpoint(ws.key, clone_ws)
+    except (tenacity.RetryError, FireCloudServerError) as e:
+        if args.verbose:
+            print(f"Error while processing workspace {ws.workspace}: {e}")
+        return None
+    finally:
+        progress['done'] += 1
+        if args.verbose:
+            print(f"{datetime.today().strftime('%H:%M')} finished {ws.workspace} "
+                  f"({progress['done']} of {progress['total']} Featured Workspaces)")
+
+    return clone_ws
+
+
+async def _test_all_async(fws, args, clone_time, gcs_path, send_notifications, scheduler, checkpoint, cloned):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.max_concurrency))
+    semaphore = asyncio.Semaphore(args.max_concurrency)
+    progress = {'done': 0, 'total': len(fws)}
+
+    cloned = cloned or {}
+    tasks = {key: asyncio.create_task(test_workspace(ws, args, clone_time, gcs_path,
+                                                     send_notifications, semaphore, progress, scheduler,
+                                                     checkpoint, cloned.get(key)))
+             for key, ws in fws.items()}
+    results = await asyncio.gather(*tasks.values())
+
+    return {key: clone_ws for key, clone_ws in zip(tasks.keys(), results) if clone_ws is not None}
+
+
+def test_all_async(fws, args, clone_time, gcs_path, send_notifications, scheduler=None, checkpoint=None, cloned=None):
+    ''' test all workspaces in fws concurrently from a single event loop.
+    blocking FISS calls run on a thread pool bounded by args.max_concurrency.
+    if a PollScheduler is passed, each workspace sleeps until its next submission is due instead of sleep_time.
+    checkpoint and cloned work as in pipeline.test_all_pipeline.
+    returns a dict of the cloned (and reported) workspaces, keyed like fws.
+    '''
+    return asyncio.run(_test_all_async(fws, args, clone_time, gcs_path, send_notifications, scheduler,
+                                       checkpoint, cloned))
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+from gcs_fns import download_from_gcs, upload_to_gcs
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS costs (
+    report_name TEXT,       -- master report of the test run, e.g. master_report_2019-10-23-17-48-44.html
+    clone_time TEXT,
+    project TEXT,           -- billing project of the cloned workspace
+    workspace TEXT,         -- cloned workspace ('' for a run total imported from an old cost report)
+    project_orig TEXT,
+    workspace_orig TEXT,
+    wf_name TEXT,
+    submission_id TEXT,     -- '' for a run total imported from an old cost report
+    submitted TEXT,         -- submission date, as reported by Terra
+    cost REAL,              -- dollars
+    recorded TEXT,
+    PRIMARY KEY (report_name, workspace, submission_id)
+);
+CREATE INDEX IF NOT EXISTS costs_workspace_orig ON costs (project_orig, workspace_orig);
+'''
+
+DEFAULT_PATH = 'cost_ledger.sqlite'
+
+
+class CostLedger:
+    ''' append-only record of test costs in a local sqlite database, one row per submission, so that cost
+    history and totals are a query instead of re-reading every cost report in the bucket.
+    with gcs_file (a gs:// path), the ledger is merged with the copy in the bucket by pull(), and uploaded by push().
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, gcs_file=None):
+        self.path = path
+        self.gcs_file = gcs_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def record_run(self, report_name, clone_time, ws_dict, costs):
+        ''' add the costs of a test run: costs is a dict of workspace key -> list of submission dicts
+        (wf_name, submission_id, submitted, cost) from get_submission_costs, for the workspaces in ws_dict
+        '''
+        now = datetime.now().isoformat()
+        rows = [(report_name, clone_time, ws.project, ws.workspace, ws.project_orig, ws.workspace_orig,
+                 sub['wf_name'], sub['submission_id'], sub['submitted'], sub['cost'], now)
+                for key, ws in ws_dict.items() for sub in costs[key]]
+        if not rows:  # still record that the run was costed
+            self.record_total(report_name, clone_time, 0)
+            return
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO costs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def record_total(self, report_name, clone_time, total_cost):
+        ''' add just the total cost of a test run, e.g. from a cost report made before the ledger existed '''
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO costs VALUES (?, ?, NULL, \'\', NULL, NULL, NULL, \'\', NULL, ?, ?)',
+                               (report_name, clone_time, total_cost, datetime.now().isoformat()))
+
+    def run_totals(self):
+        ''' dict of report name -> total cost, for every run in the ledger, in clone time order '''
+        with self._lock:
+            rows = self._conn.execute('SELECT report_name, SUM(cost) FROM costs '
+                                      'GROUP BY report_name ORDER BY MIN(clone_time)').fetchall()
+        return dict(rows)
+
+    def workspace_history(self, project_orig, workspace_orig):
+        ''' list of (clone time, total cost) of every tested run of a featured workspace '''
+        with self._lock:
+            return self._conn.execute('SELECT clone_time, SUM(cost) FROM costs '
+                                      'WHERE project_orig = ? AND workspace_orig = ? '
+                                      'GROUP BY report_name ORDER BY clone_time',
+                                      (project_orig, workspace_orig)).fetchall()
+
+    def pull(self, verbose=False):
+        ''' merge in the rows of the ledger in the bucket, if there is one '''
+        if self.gcs_file is None:
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            local_copy = os.path.join(tmp, os.path.basename(self.gcs_file))
+            if not download_from_gcs(self.gcs_file, local_copy):
+                return
+            with self._lock:
+                self._conn.execute('ATTACH DATABASE ? AS bucket', (local_copy,))
+                try:
+                    with self._conn:
+                        self._conn.execute('INSERT OR IGNORE INTO costs SELECT * FROM bucket.costs')
+                finally:
+                    self._conn.execute('DETACH DATABASE bucket')
+        if verbose:
+            print(f'merged cost ledger from {self.gcs_file}')
+
+    def push(self, verbose=False):
+        ''' upload the ledger to the bucket, if it has a gcs_file (it is not made public) '''
+        if self.gcs_file is None:
+            return
+        gcs_folder, file_name = self.gcs_file.rsplit('/', 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = os.path.join(tmp, file_name)
+            with self._lock:
+                backup = sqlite3.connect(snapshot)
+                self._conn.backup(backup)
+                backup.close()
+            upload_to_gcs(snapshot, gcs_folder + '/', verbose, public=False)
+
+
+_cost_ledger = None
+
+
+def get_cost_ledger():
+    ''' the process-wide cost ledger (by default DEFAULT_PATH, opened on first use) '''
+    global _cost_ledger
+    if _cost_ledger is None:
+        _cost_ledger = CostLedger()
+    return _cost_ledger
+
+
+def configure_cost_ledger(path=DEFAULT_PATH, gcs_file=None):
+    ''' replace the process-wide cost ledger, e.g. with settings from the command line '''
+    global _cost_ledger
+    _cost_ledger = CostLedger(path, gcs_file)
+    return _cost_ledger
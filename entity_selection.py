@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+
+from firecloud import api as fapi
+from fiss_fns import call_fiss
+
+
+# substrings marking the entities workflows should be tested on, most preferred first
+PREFERRED_ENTITY_MARKERS = ['_test', '_small']
+
+PAGE_SIZE = 100
+
+
+def query_entity_names(project, workspace, entity_type, filter_term=None, max_pages=None):
+    ''' names of the entities of a type, in name order, from the paginated entityQuery endpoint. only names are
+    fetched (no attributes), and only for entities matching filter_term (a text match on names and attribute
+    values, so callers should check the names themselves). returns [] if there are no entities of that type.
+    '''
+    names = []
+    page = 1
+    while max_pages is None or page <= max_pages:
+        res = call_fiss(fapi.get_entities_query, 200, project, workspace, entity_type,
+                        page=page, page_size=PAGE_SIZE, filter_terms=filter_term, fields='name',
+                        specialcodes=[404])
+        if res.status_code == 404:  # no entities of this type
+            return names
+        res = res.json()
+        names += [entity['name'] for entity in res['results']]
+        if page >= res['resultMetadata']['filteredPageCount']:
+            break
+        page += 1
+    return names
+
+
+def choose_entity(project, workspace, entity_type):
+    ''' the entity to test a workflow on: the last (by name) whose name contains '_test', otherwise the last
+    containing '_small', otherwise the first; None if there are no entities of that type
+    '''
+    for marker in PREFERRED_ENTITY_MARKERS:
+        matches = [name for name in query_entity_names(project, workspace, entity_type, filter_term=marker)
+                   if marker in name]
+        if matches:
+            return matches[-1]
+    first = query_entity_names(project, workspace, entity_type, max_pages=1)
+    return first[0] if first else None
+
+
+class EntitySelector:
+    ''' remembers the entity chosen for each (original workspace, entity type), so that workflows sharing an
+    entity type (and clones of the same workspace) don't query for it again. with path, the choices are also
+    kept in a json file for later runs; a choice loaded from the file is checked to still exist before it's used.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._chosen = {}       # key -> entity name (or None), chosen in this run
+        self._saved = {}        # key -> entity name, from earlier runs
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._saved = json.load(f)
+
+    @staticmethod
+    def _key(ws, entity_type):
+        return f'{ws.project_orig or ws.project}/{ws.workspace_orig or ws.workspace}/{entity_type}'
+
+    def entity_for(self, ws, entity_type):
+        ''' the entity to test ws's workflows of root entity_type on (see choose_entity), or None
+        '''
+        if entity_type is None:
+            return None
+        key = self._key(ws, entity_type)
+        with self._lock:
+            if key in self._chosen:
+                return self._chosen[key]
+            saved = self._saved.get(key)
+
+        entity_name = None
+        if saved is not None:
+            res = call_fiss(fapi.get_entity, 200, ws.project, ws.workspace, entity_type, saved, specialcodes=[404])
+            if res.status_code != 404:
+                entity_name = saved
+        if entity_name is None:
+            entity_name = choose_entity(ws.project, ws.workspace, entity_type)
+
+        with self._lock:
+            self._chosen[key] = entity_name
+        return entity_name
+
+    def save(self):
+        ''' add this run's choices to the json file, if there is one '''
+        if self.path is None:
+            return
+        with self._lock:
+            saved = dict(self._saved)
+            saved.update({key: name for key, name in self._chosen.items() if name is not None})
+        with open(self.path, 'w') as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+
+
+_entity_selector = EntitySelector()
+
+
+def get_entity_selector():
+    return _entity_selector
+
+
+def configure_entity_selector(path=None):
+    ''' replace the process-wide entity selector, e.g. to persist its choices in a json file '''
+    global _entity_selector
+    _entity_selector = EntitySelector(path)
+    return _entity_selector
@@ -1,42 +1,37 @@
 import os
 import argparse
-import time
-from datetime import datetime
 import threading
-from concurrent.futures import ThreadPoolExecutor
-
-import tenacity
-from firecloud.errors import FireCloudServerError
+from datetime import datetime
+from itertools import chain
 
-from workspace_test_report import clone_workspace
 from get_fws import format_fws, get_fws_dict_from_folder
-from gcs_fns import upload_to_gcs
+from gcs_fns import configure_report_debug_dir, get_upload_queue, upload_report_to_gcs
 from cleanup_workspaces import cleanup_workspaces
 from get_cost_for_all_tests import get_cost_of_all_tests, get_cost_of_test
-
-lock = threading.Lock()
+from cost_ledger import configure_cost_ledger
+from async_orchestrator import test_all_async
+from pipeline import test_all_pipeline
+from poll_scheduler import PollScheduler, load_poll_history, save_poll_history
+from shard_planner import load_shard_history, plan_shards, update_shard_history
+from run_store import RunStore
+from rate_limiter import configure_throttle
+from fiss_fns import configure_retry_budget, single_flight
+from fiss_cache import configure_fiss_cache
+from entity_selection import configure_entity_selector
+from metrics import metrics
+from transport import add_transport_arguments, configure_transport_from_args
+from ws_class import Wspace, dump_sidecar, sidecar_name
+from report_templates import MASTER_REPORT, MASTER_ROW, MASTER_TABLE_HEADER, TABLE_STYLE
 
 
 # TODO: implement unit tests, use wiremock - to generate canned responses for testing with up-to-date snapshots of errors
 
 
-def generate_master_report(gcs_path, clone_time, report_name, ws_dict=None, verbose=False):
-    ''' generate a report that lists all tested workspaces, the test result,
-    and links to each workspace report.
-    if ws_dict is passed, will use only the workspaces in the dict,
-    otherwise will return a report for all reports in the google bucket
-    '''
-    if verbose:
-        if ws_dict is None:
-            print('\nGenerating master report from ' + gcs_path)
-        else:
-            print('\nGenerating master report')
-
+def render_master_report(gcs_path, clone_time, fws_dict):
+    ''' the html of the master report for the workspaces in fws_dict, piece by piece (see report_templates) '''
     # define path for images
     gcs_path_imgs = gcs_path.replace('gs://', 'https://storage.googleapis.com/').replace('fw_reports/', 'imgs/')
 
-    fws_dict = ws_dict
-
     # list reports in alphabetical order, with failed reports first
     failed_list = []
     succeeded_list = []
@@ -61,111 +56,60 @@ def generate_master_report(gcs_path, clone_time, report_name, ws_dict=None, verb
     else:
         call_cache_text = 'Call Caching OFF (disabled)'
 
-    table_style_text = '''
-                    <style>
-                    table {
-                    font-family: Montserrat, sans-serif;
-                    border-collapse: collapse;
-                    width: 100%;
-                    }
-                    td, th {
-                    border: 1px solid #dddddd;
-                    text-align: left;
-                    padding: 8px;
-                    }
-                    </style>
-                    '''
-
-    workspaces_text = '''
-                    <table>
-                    <col width="10%">
-                    <col width="30%">
-                    <col width="5%">
-                    <col width="5%">
-                    <tr>
-                        <th>Project</th>
-                        <th>Featured Workspace</th>
-                        <th># WFs tested</th>
-                        <th>Status</th>
-                        <th>Report link</th>
-                        <th>Failed Workflows</th>
-                        <th>Runtime</th>
-                    </tr>
-                    '''
-    for key in finished_report_keys:
-        # if there were ANY failures
-        if 'FAIL' in fws_dict[key].status:
-            status_color = 'red'
-            status_text = f'<img src="{gcs_path_imgs}fail.jpg" alt="FAILURE!" title="sucks to suck!" width=30>'
-            failures_list = fws_dict[key].generate_failed_list()
-        elif 'SUCC' in fws_dict[key].status:
-            status_color = 'green'
-            status_text = f'<img src="{gcs_path_imgs}success_kid.png" alt="SUCCESS!" title="success kid is proud of you!" width=30>'
-            failures_list = ''
+    def rows():
+        for key in finished_report_keys:
+            ws = fws_dict[key]
+            # if there were ANY failures
+            if 'FAIL' in ws.status:
+                status_color = 'red'
+                status_text = f'<img src="{gcs_path_imgs}fail.jpg" alt="FAILURE!" title="sucks to suck!" width=30>'
+                failures_list = ws.generate_failed_list()
+            elif 'SUCC' in ws.status:
+                status_color = 'green'
+                status_text = f'<img src="{gcs_path_imgs}success_kid.png" alt="SUCCESS!" title="success kid is proud of you!" width=30>'
+                failures_list = ''
+            else:
+                status_color = 'black'
+                status_text = ws.status
+                failures_list = ''
+
+            yield MASTER_ROW.render(project=ws.project_orig,
+                                    workspace=ws.workspace_orig,
+                                    status_color=status_color,
+                                    status=status_text,
+                                    n_wf=len(ws.tested_workflows),
+                                    report_path=ws.report_path,
+                                    failures_list=failures_list,
+                                    runtime=ws.test_time)
+
+    return MASTER_REPORT.chunks(table_style_text=TABLE_STYLE,
+                                fail_count_text=fail_count_text,
+                                call_cache_text=call_cache_text,
+                                workspaces_text=chain([MASTER_TABLE_HEADER], rows(), ['</table>']),
+                                clone_time=clone_time,
+                                done_time=datetime.today().strftime('%Y-%m-%d-%H-%M-%S'))
+
+
+def generate_master_report(gcs_path, clone_time, report_name, ws_dict=None, verbose=False):
+    ''' generate a report that lists all tested workspaces, the test result,
+    and links to each workspace report.
+    if ws_dict is passed, will use only the workspaces in the dict,
+    otherwise will return a report for all reports in the google bucket
+    '''
+    if verbose:
+        if ws_dict is None:
+            print('\nGenerating master report from ' + gcs_path)
         else:
-            status_color = 'black'
-            status_text = fws_dict[key].status
-            failures_list = ''
-
-        # generate the time elapsed for the test
-        time_text = fws_dict[key].test_time
-
-        workspaces_text += '''
-<tr>
-    <td>{project}</td>
-    <td><big>{workspace}</big></td>
-    <td>{n_wf}</td>
-    <td><font color={status_color}>{status}</font></td>
-    <td><a href={report_path} target='_blank'>[open report for details]</a></td>
-    <td>{failures_list}</td>
-    <td>{runtime}</td>
-</tr>
-                    '''.format(project=fws_dict[key].project_orig,
-                               workspace=fws_dict[key].workspace_orig,
-                               status_color=status_color,
-                               status=status_text,
-                               n_wf=str(len(fws_dict[key].tested_workflows)),
-                               report_path=fws_dict[key].report_path,
-                               failures_list=failures_list,
-                               runtime=time_text)
-    workspaces_text += '</table>'
-
-    message = '''<html>
-<head>
-{table_style_text}
-</head>
-<body style='font-family:Montserrat,sans-serif; font-size:18px; padding:30; background-color:#FAFBFD'>
-<p>
-<center><div style='background-color:#82AA52; color:#FAFBFD; height:100px'>
-<h1>
-<img src='https://terra.bio/wp-content/uploads/2023/12/Terra-White-logo.png' alt='Terra rocks!' style='vertical-align: middle;' height='100'>
-<span style='vertical-align: middle;'>
-Featured Workspace Report: Master list</span></h1></center></div>
-
-<br><center><big>{fail_count_text}</big><br>{call_cache_text}</center>
-<br><br>
-{workspaces_text}<br>
-</p>
-
-<br><br>Test started: {clone_time}
-<br>Test finished: {done_time}
-</p></body>
-</html>'''
-
-    message = message.format(table_style_text=table_style_text,
-                             fail_count_text=fail_count_text,
-                             call_cache_text=call_cache_text,
-                             workspaces_text=workspaces_text,
-                             clone_time=clone_time,
-                             done_time=datetime.today().strftime('%Y-%m-%d-%H-%M-%S'))
-
-    # open, generate, and write the html text for the report
-    local_path = '/tmp/' + report_name
-    with open(local_path, 'w') as f:
-        f.write(message)
-
-    # upload report to google cloud bucket
-    report_path = upload_to_gcs(local_path, gcs_path, verbose)
+            print('\nGenerating master report')
+
+    fws_dict = ws_dict
+
+    # render the report straight into the (gzipped) upload, with its machine-readable version
+    # (read by the cost reporting)
+    report_path = upload_report_to_gcs(render_master_report(gcs_path, clone_time, fws_dict), gcs_path, report_name,
+                                       verbose)
+    upload_report_to_gcs(dump_sidecar(fws_dict.values(), report_name=report_name, clone_time=clone_time),
+                         gcs_path, sidecar_name(report_name), verbose, public=False)
 
     return report_path
 
@@ -173,147 +117,130 @@ Featured Workspace Report: Master list</span></h1></center></div>
 def test_all(args):
     # determine whether to email notifications of failures
     send_notifications = not args.mute_notifications
-    batch_number = "batch_unknown"
-    clone_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
-
-    # make a folder for this set of tests (folder name is current timestamp)
-    if args.report_name is None:
-        report_name = 'master_report_' + clone_time + '.html'
-    else:
-        report_name = args.report_name
-        cleaned_name = report_name.replace("master_report_", "").replace(".html", "")
-        parts = cleaned_name.split("batch_")
-        if len(parts) == 2:
-            batch_number = "batch_" + parts[1][:1]
-            clone_time = parts[1][1:]
-        else:
-            clone_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
-    gcs_path_subfolder = f"gs://terra-featured-workspace-tests-reports/fw_reports/{clone_time}/{batch_number}/"
-
-    # get dict of all Featured Workspaces
-    fws = format_fws(verbose=False)
-    listed_keys = list(fws.keys())
-    listed_keys.sort()
-    fws = {i: fws[i] for i in listed_keys}
-
-    batch_size = 18
-    overlap = 0
-
-    batch_1_keys = listed_keys[:batch_size]
-    batch_2_keys = listed_keys[batch_size - overlap: batch_size * 2 - overlap]
-    batch_3_keys = listed_keys[batch_size * 2 - overlap: batch_size * 3 - overlap]
-    batch_4_keys = listed_keys[batch_size * 3 - overlap: batch_size * 4 - overlap]
-
-    batch_1 = {i: fws[i] for i in batch_1_keys}
-    batch_2 = {i: fws[i] for i in batch_2_keys}
-    batch_3 = {i: fws[i] for i in batch_3_keys}
-    batch_4 = {i: fws[i] for i in batch_4_keys}
-
-    # Assigning based on batch number
-    if args.batch_number == 1:
-        fws = batch_1
-    elif args.batch_number == 2:
-        fws = batch_2
-    elif args.batch_number == 3:
-        fws = batch_3
-    elif args.batch_number == 4:
-        fws = batch_4
-
-    if args.troubleshoot:
-        copy_fws = {}
-        for key in fws.keys():
-            if 'Terra Notebooks Playground' in key:  # this fails fast
-                copy_fws[key] = fws[key]
-            elif 'GATKTutorials-Pipelining' in key:  # this succeeds fast
-                copy_fws[key] = fws[key]
-            elif 'GATKTutorials-Somatic' in key:  # this succeeds fast
-                copy_fws[key] = fws[key]
-            elif 'Introduction-to-TCGA-Dataset' in key:  # this fails fast
-                copy_fws[key] = fws[key]
-            elif 'Terra_Quickstart_Workspace' in key:  # one workflow fails in a few minutes
-                copy_fws[key] = fws[key]
-            elif 'AnVIL_T2T' in key:
-                copy_fws[key] = fws[key]
-        fws = dict(copy_fws)
-        print(fws.keys())
-
-    def process_workspace(project, workspace, clone_project, clone_time, share_with, call_cache, verbose, abort_hr):
-        try:
-            cloned_workspace = clone_workspace(
-                project, workspace, clone_project,
-                clone_time=clone_time, share_with=share_with,
-                call_cache=call_cache, verbose=verbose
-            )
-            cloned_workspace.create_submissions(verbose=verbose)
-            cloned_workspace.start_timer()
-            cloned_workspace.check_submissions(abort_hr=abort_hr, verbose=False)
-            return cloned_workspace
-        except tenacity.RetryError as e:
-            if verbose:
-                print(f"RetryError while processing workspace {workspace}: {e}")
-            return None
-
-    def threaded_process_workspace(ws, fws_testing, lock, args, clone_time):
-        cloned_workspace = process_workspace(
-            ws.project, ws.workspace, args.clone_project,
-            clone_time=clone_time, share_with=args.share_with,
-            call_cache=args.call_cache, verbose=args.verbose,
-            abort_hr=args.abort_hr
-        )
-        if cloned_workspace:
-            with lock:
-                fws_testing[ws.key] = cloned_workspace
-
-    def check_submission_on_workspace(clone_ws, args, gcs_path_subfolder, send_notifications):
+    store = RunStore(args.state_db)
+
+    if args.resume is not None:
+        # pick up a previous run where it left off, using the workspaces and settings saved in the store
+        run = store.get_run(args.resume)
+        if run is None:
+            raise ValueError(f'Run {args.resume} not found in {args.state_db}')
+        run_id = args.resume
+        clone_time = run['clone_time']
+        report_name = run['report_name']
+        gcs_path_subfolder = run['gcs_path']
+        fws = {key: Wspace(workspace=key.split('/', 1)[1], project=key.split('/', 1)[0]) for key in run['ws_keys']}
+        cloned = store.load_workspaces(run_id)
+        # submissions may have been created after the workspace was last saved; don't submit them again
+        for key, clone_ws in cloned.items():
+            if clone_ws.status is None:
+                clone_ws.recover_submissions(verbose=args.verbose)
+                store.save_workspace(run_id, key, clone_ws)
         if args.verbose:
-            print(f" Checking for submission status for {clone_ws.workspace}:")
-        if clone_ws.status is None:
-            clone_ws.check_submissions(abort_hr=args.abort_hr)
-            if not clone_ws.active_submissions:
-                clone_ws.stop_timer()
-                clone_ws.generate_workspace_report(gcs_path_subfolder, send_notifications, args.verbose)
-                return 1
+            print(f'Resuming run {run_id}: {len(cloned)} of {len(fws)} workspaces already cloned')
+    else:
+        batch_number = "batch_unknown"
+        clone_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+
+        # make a folder for this set of tests (folder name is current timestamp)
+        if args.report_name is None:
+            report_name = 'master_report_' + clone_time + '.html'
         else:
-            if args.verbose:
-                print(f"    {clone_ws.status}")
-            return 1
-        return 0
-
-    fws_testing = {}
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [
-            executor.submit(
-                threaded_process_workspace, ws, fws_testing, lock, args, clone_time
-            )
-            for ws in fws.values()
-        ]
-        for future in futures:
-            future.result()
-
-    while True:
-        start = time.time()
+            report_name = args.report_name
+            cleaned_name = report_name.replace("master_report_", "").replace(".html", "")
+            parts = cleaned_name.split("batch_")
+            if len(parts) == 2:
+                batch_number = "batch_" + parts[1][:1]
+                clone_time = parts[1][1:]
+            else:
+                clone_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+        gcs_path_subfolder = f"gs://terra-featured-workspace-tests-reports/fw_reports/{clone_time}/{batch_number}/"
+
+        # get dict of all Featured Workspaces
+        fws = format_fws(verbose=False)
+        listed_keys = list(fws.keys())
+        listed_keys.sort()
+        fws = {i: fws[i] for i in listed_keys}
+
+        # split the workspaces into batches of roughly equal historical runtime, and pick this run's batch
+        shards = plan_shards(listed_keys, args.num_batches,
+                             history=load_shard_history(args.shard_history), weight_by=args.shard_by)
+        if 1 <= args.batch_number <= args.num_batches:
+            fws = {i: fws[i] for i in shards[args.batch_number - 1]}
+
+        if args.troubleshoot:
+            copy_fws = {}
+            for key in fws.keys():
+                if 'Terra Notebooks Playground' in key:  # this fails fast
+                    copy_fws[key] = fws[key]
+                elif 'GATKTutorials-Pipelining' in key:  # this succeeds fast
+                    copy_fws[key] = fws[key]
+                elif 'GATKTutorials-Somatic' in key:  # this succeeds fast
+                    copy_fws[key] = fws[key]
+                elif 'Introduction-to-TCGA-Dataset' in key:  # this fails fast
+                    copy_fws[key] = fws[key]
+                elif 'Terra_Quickstart_Workspace' in key:  # one workflow fails in a few minutes
+                    copy_fws[key] = fws[key]
+                elif 'AnVIL_T2T' in key:
+                    copy_fws[key] = fws[key]
+            fws = dict(copy_fws)
+            print(fws.keys())
+
+        run_id = report_name.replace('.html', '')
+        store.start_run(run_id, clone_time, report_name, gcs_path_subfolder, fws.keys())
+        cloned = None
         if args.verbose:
-            print(f"\n{datetime.today().strftime('%H:%M')} status check:")
-        count_done = sum(
-            check_submission_on_workspace(clone_ws, args, gcs_path_subfolder, send_notifications)
-            for clone_ws in fws_testing.values()
-        )
+            print(f'Run id {run_id} (resume with --resume {run_id})')
 
-        if args.verbose:
-            print(f"Finished {count_done} of {len(fws_testing)} Featured Workspaces to be tested")
-        if count_done == len(fws_testing):
-            break
-        elapsed = time.time() - start
-        if elapsed < args.sleep_time:
-            time.sleep(args.sleep_time - elapsed)
+    # in adaptive mode, each submission gets its own next-check deadline instead of the fixed sleep_time tick
+    if args.poll_mode == 'adaptive':
+        scheduler = PollScheduler(min_interval=args.min_poll_interval,
+                                  max_interval=args.max_poll_interval,
+                                  history=load_poll_history(args.poll_history))
+    else:
+        scheduler = None
+
+    # save every cloned workspace's state to the store as it changes, so the run can be resumed
+    def checkpoint(key, clone_ws):
+        store.save_workspace(run_id, key, clone_ws)
+
+    if args.engine == 'async':
+        fws_testing = test_all_async(fws, args, clone_time, gcs_path_subfolder, send_notifications, scheduler,
+                                     checkpoint, cloned)
+    else:
+        fws_testing = test_all_pipeline(fws, args, clone_time, gcs_path_subfolder, send_notifications, scheduler,
+                                        checkpoint, cloned)
+
+    if scheduler is not None:
+        save_poll_history(args.poll_history, scheduler.history)
+    if args.update_shard_history:
+        update_shard_history(args.shard_history, fws_testing)
 
     # generate & open the master report
     master_report_path = generate_master_report(args.gcs_path, clone_time=clone_time, report_name=report_name,
                                                 ws_dict=fws_testing, verbose=args.verbose)
+
+    # dump per-endpoint latency/error/retry metrics for this run
+    os.makedirs(args.metrics_dir, exist_ok=True)
+    metrics.write_json(os.path.join(args.metrics_dir, run_id + '_metrics.json'))
+    metrics.write_prometheus(os.path.join(args.metrics_dir, run_id + '_metrics.prom'))
     os.system('open ' + master_report_path)
 
 
-if __name__ == '__main__':
+def run_maintenance(args):
+    ''' the housekeeping done before each test run: the cost analysis of earlier tests, then deleting their
+    old workspaces (in that order, since the cost analysis reads those workspaces' submissions)
+    '''
+    if not args.skip_cost:
+        # run the cost analysis on recent tests, recording their costs in the ledger
+        ledger = configure_cost_ledger(args.cost_ledger, args.cost_ledger_gcs)
+        get_cost_of_all_tests(args.gcs_path, args.clone_project, args.verbose, ledger)
+
+    if not args.skip_cleanup:
+        # delete any workspaces older than 30 days
+        cleanup_workspaces(args.clone_project, age_days=30, verbose=args.verbose)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='')
 
     parser.add_argument('--test_master_report', '-r', type=str, default=None,
@@ -329,38 +256,106 @@ if __name__ == '__main__':
     parser.add_argument('--share_with', type=str, default='GROUP_FireCloud-Support@firecloud.org',
                         help='email address of person or group with which to share cloned workspace')
     parser.add_argument('--sleep_time', type=int, default=60,
-                        help='time to wait between checking whether the submissions are complete')
+                        help='time to wait between checking whether the submissions are complete (fixed poll_mode only)')
+    parser.add_argument('--poll_mode', type=str, default='adaptive', choices=['adaptive', 'fixed'],
+                        help='adaptive: per-submission next-check deadlines; fixed: check everything every sleep_time')
+    parser.add_argument('--min_poll_interval', type=int, default=15,
+                        help='shortest time between status checks of a submission in adaptive poll_mode (default 15s)')
+    parser.add_argument('--max_poll_interval', type=int, default=900,
+                        help='longest time between status checks of a submission in adaptive poll_mode (default 900s)')
+    parser.add_argument('--poll_history', type=str, default=None,
+                        help='json file of historical workflow runtimes used (and updated) by adaptive poll_mode')
     parser.add_argument('--gcs_path', type=str, default='gs://terra-featured-workspace-tests-reports/fw_reports/',
                         help='google bucket path to save reports')
     parser.add_argument('--abort_hr', type=int, default=48,
                         help='# of hours after which to abort submissions (default 24). set to None if you do not wish to abort ever.')
     parser.add_argument('--call_cache', type=bool, default=False,
                         help='whether to call cache the submissions (default False for FW tests)')
+    parser.add_argument('--workflow_config', type=str, default=None,
+                        help='optional json file of per-workspace workflow dependencies (overrides name-prefix ordering)')
 
     parser.add_argument('--mute_notifications', '-m', action='store_true',
                         help='do NOT send emails to workspace owners in case of failure (default is do send)')
     parser.add_argument('--skip_cleanup', action='store_true', help='do NOT clean up old workspaces')
+    parser.add_argument('--skip_cost', action='store_true', help='do NOT run the cost analysis on recent tests')
+    parser.add_argument('--cost_ledger', type=str, default='cost_ledger.sqlite',
+                        help='sqlite file recording the cost of every tested submission (default cost_ledger.sqlite)')
+    parser.add_argument('--cost_ledger_gcs', type=str, default=None,
+                        help='optional gs:// path of a copy of the cost ledger to merge with and update, '
+                             'e.g. gs://terra-featured-workspace-tests-reports/cost_ledger.sqlite')
 
     parser.add_argument('--troubleshoot', '-t', action='store_true',
                         help='run on a subset of FWs that go quickly, to test the report')
     parser.add_argument('--verbose', '-v', action='store_true', help='print progress text')
 
-    parser.add_argument('--batch_number', '-b', type=int, default=1)
-
-    args = parser.parse_args()
-
+    parser.add_argument('--metrics_dir', type=str, default='metrics',
+                        help='folder to write the json and Prometheus textfile metrics of each run to')
+    parser.add_argument('--state_db', type=str, default='fw_test_runs.sqlite',
+                        help='sqlite file recording the state of every run, so it can be resumed')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='run id of a previous run to resume (polling continues without resubmitting)')
+
+    parser.add_argument('--batch_number', '-b', type=int, default=1,
+                        help='which batch of workspaces to test, from 1 to num_batches (any other value tests all)')
+    parser.add_argument('--num_batches', type=int, default=4,
+                        help='number of batches to split the featured workspaces into (default 4)')
+    parser.add_argument('--shard_history', type=str, default='workspace_runtimes.json',
+                        help='json file of historical per-workspace runtime/cost used to balance the batches')
+    parser.add_argument('--shard_by', type=str, default='runtime', choices=['runtime', 'cost'],
+                        help='historical stat to balance the batches on (default runtime)')
+    parser.add_argument('--update_shard_history', action='store_true',
+                        help='record the runtimes of this run in shard_history')
+
+    parser.add_argument('--engine', type=str, default='threads', choices=['threads', 'async'],
+                        help='orchestrator to use: a threaded clone -> poll -> report pipeline, or one asyncio task per workspace')
+    parser.add_argument('--max_concurrency', type=int, default=10,
+                        help='max number of FISS/GCS calls in flight at once (default 10)')
+    parser.add_argument('--fiss_rate_scale', type=float, default=1,
+                        help='multiplier for the per-endpoint FISS request rate limits in rate_limiter.py (default 1)')
+    parser.add_argument('--retry_budget', type=int, default=500,
+                        help='max total number of FISS retries in this run, after which calls fail fast (default 500)')
+    parser.add_argument('--fiss_cache_ttl', type=int, default=600,
+                        help='seconds to cache read-only FISS responses like get_workspace (default 600, 0 disables the cache)')
+    parser.add_argument('--fiss_cache_db', type=str, default=None,
+                        help='optional sqlite file to also cache read-only FISS responses in, for reuse by later runs')
+    parser.add_argument('--fiss_cache_db_ttl', type=int, default=86400,
+                        help='seconds to keep responses in fiss_cache_db (default 86400, one day)')
+    parser.add_argument('--entity_cache', type=str, default=None,
+                        help='optional json file remembering the entity each workspace\'s workflows are tested on, for reuse by later runs')
+    parser.add_argument('--report_debug_dir', type=str, default=None,
+                        help='optional local folder to also write every html report to (reports are otherwise only uploaded)')
+    parser.add_argument('--report_workers', type=int, default=2,
+                        help='number of threads generating workspace reports in the threads engine (default 2)')
+    parser.add_argument('--stage_queue_size', type=int, default=0,
+                        help='max workspaces waiting between pipeline stages in the threads engine (default 0, unbounded)')
+    add_transport_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    # talk to Terra/GCS directly, or record / replay the interactions
+    configure_transport_from_args(args)
+
+    # throttle all FISS traffic in this process, cap the total number of retries, and cache read-only responses
+    configure_throttle(rate_scale=args.fiss_rate_scale, max_concurrency=args.max_concurrency)
+    retry_budget = configure_retry_budget(args.retry_budget)
+    fiss_cache = configure_fiss_cache(ttl=args.fiss_cache_ttl, disk_path=args.fiss_cache_db,
+                                      disk_ttl=args.fiss_cache_db_ttl)
+    entity_selector = configure_entity_selector(args.entity_cache)
+    configure_report_debug_dir(args.report_debug_dir)
+
+    # the cost analysis and cleanup run in the background, so they don't delay the tests
+    maintenance = None
     if not args.troubleshoot:
-        # run the cost analysis on recent tests
-        get_cost_of_all_tests(args.gcs_path, args.clone_project, args.verbose)
-
-        if not args.skip_cleanup:
-            # delete any workspaces older than 30 days
-            cleanup_workspaces(args.clone_project, age_days=30, verbose=args.verbose)
+        maintenance = threading.Thread(target=run_maintenance, args=(args,), name='maintenance')
+        maintenance.start()
 
     if args.test_master_report is not None:
         fws_dict = get_fws_dict_from_folder(args.gcs_path, args.test_master_report, args.clone_project, args.verbose)
+        clone_time = args.test_master_report.replace('/', '')
+        report_name = args.report_name or 'master_report_' + clone_time + '.html'
         report_path = generate_master_report(args.gcs_path,
-                                             clone_time=args.test_master_report.replace('/', ''),
+                                             clone_time=clone_time,
+                                             report_name=report_name,
                                              ws_dict=fws_dict,
                                              verbose=args.verbose)
         os.system('open ' + report_path)
@@ -369,3 +364,18 @@ if __name__ == '__main__':
         os.system('open ' + report_path)
     else:
         test_all(args)
+        entity_selector.save()
+
+    if maintenance is not None:
+        maintenance.join()
+    # wait for the workspace reports still being uploaded in the background
+    get_upload_queue().flush()
+
+    print(retry_budget.report())
+    print(fiss_cache.report())
+    print(f'{single_flight.coalesced} FISS calls shared an identical in-flight request')
+    print(metrics.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,19 @@ the README at https://pypi.python.org/pypi/firecloud.
 from firecloud import api as fapi
 import json
 
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+try:
+    import ijson    # parses big metadata responses as they stream in (in requirements.txt, but optional)
+except ImportError:
+    ijson = None
+
+_warned_no_ijson = False
+
 from six import string_types
-from six.moves.urllib.parse import urlencode, urljoin
+from six.moves.urllib.parse import urlencode
 
-def get_workflow_metadata_withInclude(namespace, workspace, submission_id, workflow_id, *keysToInclude):
+def get_workflow_metadata_withInclude(namespace, workspace, submission_id, workflow_id, *keysToInclude, **kwargs):
     """Request the metadata for a workflow in a submission.
 
     Args:
@@ -21,6 +30,7 @@ def get_workflow_metadata_withInclude(namespace, workspace, submission_id, workf
         submission_id (str): Submission's unique identifier
         workflow_id (str): Workflow's unique identifier.
         *keysToInclude (strs): any number of keys to INCLUDE, to restrict values returned
+        **kwargs: passed on to the request, e.g. stream=True
 
     Swagger:
         https://api.firecloud.org/#!/Submissions/workflowMetadata
@@ -28,7 +38,7 @@ def get_workflow_metadata_withInclude(namespace, workspace, submission_id, workf
     includeKeyStr = '&'.join(['includeKey='+item for item in keysToInclude])
     uri = "workspaces/{0}/{1}/submissions/{2}/workflows/{3}?{4}&expandSubWorkflows=false".format(namespace,workspace, 
                 submission_id, workflow_id, includeKeyStr)
-    return fapi.__get(uri)
+    return fapi.__get(uri, **kwargs)
 
 def get_workflow_metadata_withExclude(namespace, workspace, submission_id, workflow_id, *keysToExclude):
     """Request the metadata for a workflow in a submission.
@@ -48,6 +58,72 @@ def get_workflow_metadata_withExclude(namespace, workspace, submission_id, workf
                 submission_id, workflow_id, excludeKeyStr)
     return fapi.__get(uri)
 
+FINAL_STATUS_KEYS = ['status', 'start', 'end', 'failures']
+
+
+def _final_status_from_events(events):
+    """Pick the final status fields out of ijson parse events, keeping only the
+    failures' causedBy messages (the rest of each failure tree is skipped)."""
+    final = {'failures': []}
+    for prefix, event, value in events:
+        if prefix in ['status', 'start', 'end'] and event == 'string':
+            final[prefix] = value
+        elif prefix == 'failures.item' and event == 'start_map':
+            final['failures'].append({'causedBy': []})
+        elif prefix == 'failures.item.causedBy.item.message':
+            final['failures'][-1]['causedBy'].append({'message': value})
+    return final
+
+
+def _final_status_from_json(metadata):
+    return {'status': metadata.get('status'),
+            'start': metadata.get('start'),
+            'end': metadata.get('end'),
+            'failures': [{'causedBy': [{'message': cause.get('message')} for cause in failure.get('causedBy', [])]}
+                         for failure in metadata.get('failures', [])]}
+
+
+def get_workflow_final_metadata(namespace, workspace, submission_id, workflow_id):
+    """Request only the final status, start and end times and failure messages of a workflow.
+
+    Only FINAL_STATUS_KEYS are requested, and the body is parsed as it streams in (with ijson, if
+    it is installed), so memory stays bounded even for huge scatter workflows. The returned
+    response's json is {'status', 'start', 'end', 'failures': [{'causedBy': [{'message'}]}]};
+    its Content-Length is the number of bytes actually transferred.
+
+    Args:
+        namespace (str): project to which workspace belongs
+        workspace (str): Workspace name
+        submission_id (str): Submission's unique identifier
+        workflow_id (str): Workflow's unique identifier.
+    """
+    r = get_workflow_metadata_withInclude(namespace, workspace, submission_id, workflow_id,
+                                          *FINAL_STATUS_KEYS, stream=True)
+    if r.status_code != 200:
+        return r
+
+    if ijson is not None and r.raw is not None:
+        r.raw.decode_content = True
+        final = _final_status_from_events(ijson.parse(r.raw))
+        n_bytes = r.raw.tell()
+        r.close()
+    else:
+        global _warned_no_ijson
+        if ijson is None and not _warned_no_ijson:
+            _warned_no_ijson = True
+            print('ijson is not installed: workflow metadata responses are read and parsed whole '
+                  '(pip3 install ijson to stream them)')
+        final = _final_status_from_json(r.json())
+        n_bytes = len(r.content)
+
+    response = Response()
+    response.status_code = r.status_code
+    response.url = r.url
+    response.headers = CaseInsensitiveDict({'Content-Type': 'application/json', 'Content-Length': str(n_bytes)})
+    response._content = json.dumps(final).encode('utf-8')
+    response.encoding = 'utf-8'
+    return response
+
 def export_workspace_attributes_TSV(namespace, workspace): 
     """Export workspace attributes.
 
@@ -87,9 +163,9 @@ def import_workspace_attributes_TSV(namespace, workspace, attrs):
 
 def get_workspace_cloudPlatform(namespace, name):
     """get cloud platform of workspace"""
-    request_url = f'https://api.firecloud.org/api/workspaces/{namespace}/{name}?fields=workspace.cloudPlatform'
+    uri = f'workspaces/{namespace}/{name}?fields=workspace.cloudPlatform'
 
-    return fapi.__get(request_url)
+    return fapi.__get(uri)
 
 def clone_workspace_with_bucket_location(from_namespace, from_workspace, to_namespace, to_workspace, bucketLocation, authorizationDomain="", copyFilesWithPrefix=None):
     """Clone a Terra workspace.
@@ -0,0 +1,174 @@
+import copy
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# read-only FISS endpoints whose (parsed json) responses may be cached
+CACHEABLE_ENDPOINTS = ['get_workspace',
+                       'list_workspace_configs',
+                       'get_workspace_cloudPlatform']
+
+# FISS endpoints that change a workspace, and so invalidate everything cached for it
+MUTATING_PREFIXES = ('clone_', 'create_', 'update_', 'delete_', 'import_', 'overwrite_', 'abort_', 'copy_',
+                     'upload_', 'lock_', 'unlock_')
+
+# where a FISS call's args name the workspace it refers to (or changes), as
+# (namespace position, namespace keyword, workspace position, workspace keyword).
+# most endpoints take the workspace first; a clone changes its destination, not its source workspace
+DEFAULT_WORKSPACE_ARGS = (0, 'namespace', 1, 'workspace')
+WORKSPACE_ARGS = {'clone_workspace': (2, 'to_namespace', 3, 'to_workspace'),
+                  'clone_workspace_with_bucket_location': (2, 'to_namespace', 3, 'to_workspace')}
+
+DISK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    namespace TEXT,
+    workspace TEXT,
+    value TEXT,             -- json of the parsed response
+    expires REAL            -- unix time
+);
+CREATE INDEX IF NOT EXISTS responses_ws ON responses (namespace, workspace);
+'''
+
+
+def _endpoint_name(fapifunc):
+    return getattr(fapifunc, '__name__', str(fapifunc))
+
+
+def request_key(fapifunc, args, kwargs):
+    ''' a string identifying a FISS call by its endpoint and arguments '''
+    return json.dumps([_endpoint_name(fapifunc), args, kwargs], sort_keys=True, default=str)
+
+
+def workspaces_of(fapifunc, args, kwargs):
+    ''' the (namespace, workspace) pairs a FISS call refers to, from the positional or keyword args that
+    WORKSPACE_ARGS (or DEFAULT_WORKSPACE_ARGS) gives for its endpoint
+    '''
+    ns_pos, ns_kwarg, ws_pos, ws_kwarg = WORKSPACE_ARGS.get(_endpoint_name(fapifunc), DEFAULT_WORKSPACE_ARGS)
+    namespace = args[ns_pos] if len(args) > ns_pos else kwargs.get(ns_kwarg)
+    workspace = args[ws_pos] if len(args) > ws_pos else kwargs.get(ws_kwarg)
+    if isinstance(namespace, str) and isinstance(workspace, str):
+        return [(namespace, workspace)]
+    return []
+
+
+class FissCache:
+    ''' thread-safe TTL + LRU cache of parsed json responses from read-only FISS endpoints, keyed on the
+    endpoint and its arguments. with disk_path, responses are also kept in a sqlite file (for disk_ttl seconds)
+    so that repeated command line runs can skip calls made by earlier runs.
+    ttl = 0 disables the cache.
+    '''
+
+    def __init__(self, ttl=600, max_entries=1024, disk_path=None, disk_ttl=86400):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_ttl = disk_ttl
+        self._entries = OrderedDict()   # key -> (expires, workspace, value), least recently used first
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+        self._conn = None
+        if disk_path is not None and ttl > 0:
+            self._conn = sqlite3.connect(disk_path, check_same_thread=False)
+            self._conn.executescript(DISK_SCHEMA)
+            with self._conn:
+                self._conn.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+
+    def is_cacheable(self, fapifunc):
+        return self.ttl > 0 and _endpoint_name(fapifunc) in CACHEABLE_ENDPOINTS
+
+    def is_mutation(self, fapifunc):
+        return _endpoint_name(fapifunc).startswith(MUTATING_PREFIXES)
+
+    def get(self, fapifunc, args, kwargs):
+        ''' returns (True, a copy of the cached response) on a hit, or (False, None) on a miss
+        '''
+        key = request_key(fapifunc, args, kwargs)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return True, copy.deepcopy(entry[2])
+                del self._entries[key]
+
+            if self._conn is not None:
+                row = self._conn.execute('SELECT value, expires FROM responses WHERE key = ? AND expires > ?',
+                                         (key, now)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    workspace = (workspaces_of(fapifunc, args, kwargs) or [None])[0]
+                    self._store(key, min(row[1], now + self.ttl), workspace, value)
+                    self.stats['disk_hits'] += 1
+                    return True, copy.deepcopy(value)
+
+            self.stats['misses'] += 1
+            return False, None
+
+    def _store(self, key, expires, workspace, value):
+        self._entries[key] = (expires, workspace, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def put(self, fapifunc, args, kwargs, value):
+        key = request_key(fapifunc, args, kwargs)
+        workspace = (workspaces_of(fapifunc, args, kwargs) or [None])[0]
+        now = time.time()
+        with self._lock:
+            self._store(key, now + self.ttl, workspace, copy.deepcopy(value))
+            if self._conn is not None:
+                namespace, name = workspace or (None, None)
+                with self._conn:
+                    self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                       (key, namespace, name, json.dumps(value), now + self.disk_ttl))
+
+    def invalidate(self, namespace, workspace):
+        ''' drop everything cached for a workspace, e.g. after it was changed '''
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[1] == (namespace, workspace)]
+            for key in stale:
+                del self._entries[key]
+            self.stats['invalidations'] += len(stale)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('DELETE FROM responses WHERE namespace = ? AND workspace = ?',
+                                       (namespace, workspace))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('DELETE FROM responses')
+
+    def report(self):
+        ''' returns a printable summary of the cache hit rate '''
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        hit_rate = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0
+        return (f"FISS cache: {lookups} lookups, {stats['hits']} hits, {stats['disk_hits']} disk hits, "
+                f"{stats['misses']} misses ({hit_rate:.0%} hit rate), {stats['evictions']} evictions, "
+                f"{stats['invalidations']} invalidations")
+
+
+_fiss_cache = FissCache()
+
+
+def get_fiss_cache():
+    return _fiss_cache
+
+
+def configure_fiss_cache(ttl=600, max_entries=1024, disk_path=None, disk_ttl=86400):
+    ''' replace the process-wide FISS response cache, e.g. with settings from the command line
+    '''
+    global _fiss_cache
+    _fiss_cache = FissCache(ttl=ttl, max_entries=max_entries, disk_path=disk_path, disk_ttl=disk_ttl)
+    return _fiss_cache
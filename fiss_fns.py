@@ -1,15 +1,174 @@
-import json
+import copy
+import os
 import sys
 import logging
+import random
+import threading
+import requests
 import tenacity as tn
 from firecloud import api as fapi
 from firecloud import errors as ferrors
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+from rate_limiter import get_throttle
+from fiss_cache import get_fiss_cache, request_key, workspaces_of
+from metrics import metrics, timed
+from transport import get_transport
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# response codes worth retrying; any other error code is deterministic and fails immediately
+TRANSIENT_CODES = [408, 429, 500, 502, 503, 504]
+
+# exceptions raised by a dropped or slow connection, retried like the transient codes
+TRANSIENT_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, ConnectionResetError)
+
+BACKOFF_BASE = 5        # seconds; full-jitter exponential backoff is random(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**n))
+BACKOFF_MAX = 120       # seconds
+RETRY_AFTER_MAX = 300   # seconds; cap on how long we'll honor a server's Retry-After
+
+# read-only FISS endpoints; identical concurrent calls to these share a single request
+READ_PREFIXES = ('get_', 'list_')
+
+
+def use_firecloud_api(root_url):
+    ''' send FISS calls to root_url instead of the production Terra API. a plain http root_url (e.g. a local
+    terra_simulator) gets an unauthenticated session, since there are no google credentials to check
+    '''
+    fapi.fcconfig.root_url = root_url.rstrip('/') + '/'
+    if root_url.startswith('http://'):
+        setattr(fapi, '__SESSION', requests.Session())
+
+
+# FIRECLOUD_API points every script in this repo at another Terra API, e.g. a local terra_simulator
+if os.environ.get('FIRECLOUD_API'):
+    use_firecloud_api(os.environ['FIRECLOUD_API'])
+
+
+class TransientFiSSError(ferrors.FireCloudServerError):
+    ''' FISS error with a transient response code; retry_after is the server's requested delay in seconds, if any '''
+    def __init__(self, code, message, retry_after=None):
+        super().__init__(code, message)
+        self.retry_after = retry_after
+
+
+class RetryBudget:
+    ''' process-wide cap on the number of call_fiss retries, so that a run fails fast
+    instead of retrying forever when Terra is down. also tracks retries and wait time per endpoint.
+    '''
+    def __init__(self, max_retries=500):
+        self.max_retries = max_retries
+        self.retries = 0
+        self.stats = {}  # endpoint name -> {'retries': n, 'wait_seconds': total seconds spent waiting}
+        self._lock = threading.Lock()
+
+    def exhausted(self):
+        with self._lock:
+            return self.retries >= self.max_retries
+
+    def spend(self, endpoint, wait_seconds):
+        with self._lock:
+            self.retries += 1
+            endpoint_stats = self.stats.setdefault(endpoint, {'retries': 0, 'wait_seconds': 0})
+            endpoint_stats['retries'] += 1
+            endpoint_stats['wait_seconds'] += wait_seconds
+
+    def report(self):
+        ''' returns a printable summary of retries and wasted wait time per endpoint '''
+        with self._lock:
+            lines = [f'{self.retries} FISS retries (budget {self.max_retries})']
+            for endpoint, endpoint_stats in sorted(self.stats.items()):
+                lines.append(f"    {endpoint}: {endpoint_stats['retries']} retries, "
+                             f"{endpoint_stats['wait_seconds']:.0f}s waiting")
+        return '\n'.join(lines)
+
+
+retry_budget = RetryBudget()
+
+
+def configure_retry_budget(max_retries):
+    ''' reset the process-wide retry budget '''
+    global retry_budget
+    retry_budget = RetryBudget(max_retries)
+    return retry_budget
+
+
+class SingleFlight:
+    ''' coalesces identical concurrent calls: while a call for a key is in flight, other callers with the
+    same key wait for it and get (a copy of) its result or exception instead of making their own call
+    '''
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}  # key -> [done event, result, exception]
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = [threading.Event(), None, None]
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return copy.deepcopy(call[1]) if isinstance(call[1], (dict, list)) else call[1]
+
+        try:
+            call[1] = func(*args, **kwargs)
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call[0].set()
+
+
+single_flight = SingleFlight()
+
+
+def parse_retry_after(value):
+    ''' parse a Retry-After header (seconds or an HTTP date) into seconds, or None '''
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exception):
+    ''' retry transient FISS errors and dropped or timed-out connections, but not deterministic 4xx errors
+    or our own bugs (e.g. a TypeError from bad arguments)
+    '''
+    return isinstance(exception, (TransientFiSSError,) + TRANSIENT_EXCEPTIONS)
+
+
+def wait_jitter_or_retry_after(retry_state):
+    ''' wait for the server's Retry-After if it sent one, otherwise full-jitter exponential backoff '''
+    exception = retry_state.outcome.exception()
+    retry_after = getattr(exception, 'retry_after', None)
+    if retry_after is not None:
+        return min(retry_after, RETRY_AFTER_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (retry_state.attempt_number - 1)))
+
+
+def stop_when_budget_exhausted(retry_state):
+    return retry_budget.exhausted()
+
+
 def my_before_sleep(retry_state):
     if retry_state.attempt_number < 1:
         loglevel = logging.INFO
@@ -18,14 +177,50 @@ def my_before_sleep(retry_state):
     logger.log(
         loglevel, 'Retrying %s with %s in %s seconds; attempt #%s ended with: %s',
         retry_state.fn, retry_state.args, str(int(retry_state.next_action.sleep)), retry_state.attempt_number, retry_state.outcome)
+    endpoint = getattr(retry_state.args[0], '__name__', str(retry_state.args[0]))
+    retry_budget.spend(endpoint, retry_state.next_action.sleep)
+    metrics.record_retry(endpoint, retry_state.next_action.sleep)
 
 
-@tn.retry(wait=tn.wait_chain(*[tn.wait_fixed(5)] +
-                             [tn.wait_fixed(10)] +
-                             [tn.wait_fixed(30)] +
-                             [tn.wait_fixed(60)]),
-          stop=tn.stop_after_attempt(5),
+@tn.retry(retry=tn.retry_if_exception(is_retryable),
+          wait=wait_jitter_or_retry_after,
+          stop=tn.stop_after_attempt(5) | stop_when_budget_exhausted,
           before_sleep=my_before_sleep)
+def _call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
+    ''' one retrying, throttled and timed FISS call; see call_fiss '''
+    # call the api (or replay it), throttled by the process-wide rate limiter, recording latency/status/size
+    response = get_throttle().call(timed(get_transport().fiss(fapifunc)), *args, **kwargs)
+
+    # check for errors; this is copied from _check_response_code in fiss
+    if type(okcode) == int:
+        # codes = [okcode]
+        if specialcodes is None:
+            codes = [okcode]
+        else:
+            codes = [okcode] + specialcodes
+    if response.status_code not in codes:
+        print(response.content)
+        if response.status_code in TRANSIENT_CODES:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            raise TransientFiSSError(response.status_code, response.content, retry_after)
+        raise ferrors.FireCloudServerError(response.status_code, response.content)
+    elif specialcodes is not None:
+        return response
+
+    # return the json response if all goes well
+    try:
+        return response.json()
+    except:
+        # not all responses are json
+        return response
+
+
+def _coalesced_call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
+    ''' _call_fiss, sharing one request among identical concurrent calls '''
+    key = request_key(fapifunc, args, dict(kwargs, okcode=okcode, specialcodes=specialcodes))
+    return single_flight.do(key, _call_fiss, fapifunc, okcode, *args, specialcodes=specialcodes, **kwargs)
+
+
 def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
     ''' call FISS (firecloud api), check for errors, return json response
 
@@ -43,29 +238,37 @@ def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
 
     example use:
         output = call_fiss(fapi.get_workspace, 200, 'help-gatk', 'Sequence-Format-Conversion')
+
+    only transient errors (TRANSIENT_CODES, or exceptions such as dropped connections) are retried, with
+    full-jitter exponential backoff or the server's Retry-After, while the process-wide retry_budget lasts.
+    other error codes raise FireCloudServerError straight away.
+
+    responses from the read-only endpoints in fiss_cache.CACHEABLE_ENDPOINTS are served from the process-wide
+    FISS cache while fresh, and calls to endpoints that change a workspace invalidate its cached responses.
+    identical concurrent calls to read-only (get_/list_) endpoints share one request and its parsed response.
     '''
-    # call the api
-    response = fapifunc(*args, **kwargs)
+    cache = get_fiss_cache()
 
-    # check for errors; this is copied from _check_response_code in fiss
-    if type(okcode) == int:
-        # codes = [okcode]
-        if specialcodes is None:
-            codes = [okcode]
-        else:
-            codes = [okcode] + specialcodes
-    if response.status_code not in codes:
-        print(response.content)
-        raise ferrors.FireCloudServerError(response.status_code, response.content)
-    elif specialcodes is not None:
-        return response
+    # non-parsed responses (specialcodes) aren't cached
+    if specialcodes is None and cache.is_cacheable(fapifunc):
+        hit, output = cache.get(fapifunc, args, kwargs)
+        if not hit:
+            output = _coalesced_call_fiss(fapifunc, okcode, *args, **kwargs)
+            if isinstance(output, (dict, list)):
+                cache.put(fapifunc, args, kwargs, output)
+        return output
+
+    if getattr(fapifunc, '__name__', '').startswith(READ_PREFIXES):
+        return _coalesced_call_fiss(fapifunc, okcode, *args, specialcodes=specialcodes, **kwargs)
+
+    if not cache.is_mutation(fapifunc):
+        return _call_fiss(fapifunc, okcode, *args, specialcodes=specialcodes, **kwargs)
 
-    # return the json response if all goes well
     try:
-        return response.json()
-    except:
-        # not all responses are json
-        return response
+        return _call_fiss(fapifunc, okcode, *args, specialcodes=specialcodes, **kwargs)
+    finally:
+        for namespace, workspace in workspaces_of(fapifunc, args, kwargs):
+            cache.invalidate(namespace, workspace)
 
 
 def format_timedelta(time_delta, hours_thresh):
@@ -1,15 +1,40 @@
+import gzip
+import io
 import os
 import subprocess
 import tenacity as tn
 import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from google.auth import default
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage
 
+from metrics import timed
+from report_templates import write_chunks
+from transport import get_transport
+
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# number of files read from GCS at once (the storage client keeps up to 10 connections open)
+GCS_WORKERS = 10
+
+# number of reports uploaded at once by the background upload queue
+UPLOAD_WORKERS = 4
+
+# reports are never changed once uploaded (a rerun gets a new clone time), so browsers may cache them for a while
+REPORT_CACHE_CONTROL = 'public, max-age=3600'
+
+# gzip level of uploaded reports: the size of level 9 (html is very repetitive), in about two thirds of the time
+REPORT_GZIP_LEVEL = 6
+
+# content type of a report, by file extension
+REPORT_CONTENT_TYPES = {'.html': 'text/html; charset=utf-8',
+                        '.json': 'application/json'}
+
 
 def my_before_sleep(retry_state):
     if retry_state.attempt_number < 1:
@@ -33,19 +58,84 @@ def run_subprocess(cmd, errorMessage):
         cmd = ' '.join(cmd)
     try:
         # print("running command: " + cmd)
-        return subprocess.check_output(
-            cmd, shell=True, universal_newlines=True)
+        return get_transport().call('subprocess', cmd, subprocess.check_output,
+                                    cmd, shell=True, universal_newlines=True)
     except subprocess.CalledProcessError as e:
         print(errorMessage)
         print("Exited with " + str(e.returncode) + "-" + e.output)
         exit(1)
 
 
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def storage_client():
+    ''' the process-wide google cloud storage client, created (and its credentials resolved) on first use.
+    if STORAGE_EMULATOR_HOST is set (e.g. to a local storage emulator for offline tests), the client talks to
+    the emulator, without credentials
+    '''
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            if os.environ.get('STORAGE_EMULATOR_HOST'):
+                _storage_client = storage.Client(project='emulator', credentials=AnonymousCredentials())
+            else:
+                credentials, project_id = default()
+                print(f"Authenticated with project: {project_id}")
+                _storage_client = storage.Client(project=project_id, credentials=credentials)
+        return _storage_client
+
+
+def split_gcs_path(gcs_path):
+    ''' (bucket name, object name or prefix) of a gs:// path '''
+    bucket_name, _, name = gcs_path.replace('gs://', '').partition('/')
+    return bucket_name, name
+
+
+def _list_folder(gcs_path):
+    client = storage_client()
+    bucket_name, prefix = split_gcs_path(gcs_path.rstrip('/') + '/')
+    prefix = prefix.lstrip('/')
+    blobs = client.list_blobs(bucket_name, prefix=prefix, delimiter='/')
+    paths = [f'gs://{bucket_name}/{blob.name}' for blob in blobs if blob.name != prefix]
+    # the sub-folders are known once the listing has been read
+    paths += [f'gs://{bucket_name}/{sub_prefix}' for sub_prefix in sorted(blobs.prefixes)]
+    return ''.join(path + '\n' for path in paths)
+
+
+def _read_file(gcs_path):
+    bucket_name, name = split_gcs_path(gcs_path)
+    return storage_client().bucket(bucket_name).blob(name).download_as_text()
+
+
+def gsutil_ls(gcs_path):
+    ''' what `gsutil ls gcs_path` prints: the files and sub-folders (ending in /) directly under gcs_path,
+    one gs:// path per line. listed with the storage client, in one paged request per 1000 entries
+    '''
+    return get_transport().gsutil('ls', gcs_path, lambda: _list_folder(gcs_path))
+
+
+def gsutil_cat(gcs_path):
+    ''' contents of the file at gcs_path '''
+    return get_transport().gsutil('cat', gcs_path, lambda: _read_file(gcs_path))
+
+
+def gsutil_cat_many(gcs_paths, max_workers=GCS_WORKERS):
+    ''' dict of gcs path -> contents for many files, read concurrently '''
+    gcs_paths = list(gcs_paths)
+    if not gcs_paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(gcs_paths, executor.map(gsutil_cat, gcs_paths)))
+
+
 def convert_to_public_url(gs_input):
     return gs_input.replace('gs://', 'https://storage.googleapis.com/')
 
 
-def upload_to_gcs(local_path, gcs_path, verbose=True):
+@timed
+def upload_to_gcs(local_path, gcs_path, verbose=True, public=True):
     """
     Uploads a file to Google Cloud Storage and makes it publicly accessible.
 
@@ -53,30 +143,202 @@ def upload_to_gcs(local_path, gcs_path, verbose=True):
         local_path (str): Path to the local file to upload.
         gcs_path (str): Destination GCS path (e.g., 'gs://my-bucket/path/').
         verbose (bool): Whether to print upload status messages.
+        public (bool): Whether to make the uploaded file publicly readable.
 
     Returns:
         str: Public URL of the uploaded file.
     """
-    credentials, project_id = default()
-    print(f"Authenticated with project: {project_id}")
-    client = storage.Client()
+    bucket_name, destination_blob_name, public_url = upload_destination(local_path, gcs_path)
+
+    if verbose:
+        print(f"Uploading {local_path} to gs://{bucket_name}/{destination_blob_name}...")
+
+    get_transport().upload(_upload_blob, local_path, public_url, bucket_name, destination_blob_name, public)
+
+    if verbose:
+        print(f"✅ Report uploaded successfully. View at: {public_url}")
+
+    return public_url
+
+
+class _ReportSink:
+    ''' file-like sink for write_chunks: encodes the text once and writes it to each of files '''
+
+    def __init__(self, *files):
+        self.files = [f for f in files if f is not None]
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.size += len(data)
+        for f in self.files:
+            f.write(data)
+
+
+def gzip_report(report, copy_to=None):
+    ''' (size, gzipped bytes) of a report: a string, or an iterable of strings (e.g. the chunks of a
+    report_templates.Template), compressed as it's rendered. with copy_to (a binary file), the report is also
+    written there uncompressed
+    '''
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=REPORT_GZIP_LEVEL, mtime=0) as gzip_file:
+        sink = _ReportSink(gzip_file, copy_to)
+        write_chunks([report] if isinstance(report, str) else report, sink)
+    return sink.size, buffer.getvalue()
+
+
+@timed
+def upload_report_to_gcs(report, gcs_path, file_name, verbose=True, public=True):
+    """
+    Uploads a report (html, or its json sidecar), rendered in memory, to Google Cloud Storage.
+    It is gzipped as it's rendered, stored with Content-Encoding: gzip (which browsers decompress) and the
+    content type of its file extension, and also written under the report debug folder, if one is configured.
+
+    Args:
+        report (str or iterable of str): The report, e.g. the chunks of a report_templates.Template.
+        gcs_path (str): Destination GCS path (e.g., 'gs://my-bucket/path/').
+        file_name (str): Name of the report file in gcs_path.
+        verbose (bool): Whether to print upload status messages.
+        public (bool): Whether to make the report publicly readable (and cacheable, for REPORT_CACHE_CONTROL).
+
+    Returns:
+        str: Public URL of the uploaded file.
+    """
+    bucket_name, destination_blob_name, public_url = upload_destination(file_name, gcs_path)
+    content_type = REPORT_CONTENT_TYPES[os.path.splitext(file_name)[1]]
+    debug_file = None
+    if _report_debug_dir is not None:
+        debug_path = os.path.join(_report_debug_dir, bucket_name, destination_blob_name)
+        os.makedirs(os.path.dirname(debug_path), exist_ok=True)
+        debug_file = open(debug_path, 'wb')
+
+    try:
+        size, compressed = gzip_report(report, debug_file)
+    finally:
+        if debug_file is not None:
+            debug_file.close()
+    if verbose:
+        print(f"Uploading {file_name} ({size} bytes, {len(compressed)} gzipped) to "
+              f"gs://{bucket_name}/{destination_blob_name}...")
+
+    get_transport().upload_gzipped(_upload_compressed_report, compressed, public_url,
+                                   bucket_name, destination_blob_name, content_type, public)
+
+    if verbose:
+        print(f"✅ Report uploaded successfully. View at: {public_url}")
+
+    return public_url
+
+
+def _upload_compressed_report(compressed, bucket_name, destination_blob_name, content_type, public=True):
+    blob = storage_client().bucket(bucket_name).blob(destination_blob_name)
+    blob.content_encoding = 'gzip'
+    if public:
+        blob.cache_control = REPORT_CACHE_CONTROL
+    blob.upload_from_string(compressed, content_type=content_type, predefined_acl='publicRead' if public else None)
+
+
+_report_debug_dir = None
+
+
+def configure_report_debug_dir(path):
+    ''' also write every uploaded report under path (at its bucket path), e.g. for debugging; None to stop '''
+    global _report_debug_dir
+    _report_debug_dir = path
+
+
+def upload_destination(local_path, gcs_path):
+    ''' (bucket name, blob name, public url) that upload_to_gcs uploads local_path to '''
     bucket_name = gcs_path.replace("gs://", "").split("/")[0]
     destination_blob_name = "/".join(gcs_path.replace("gs://", "").split("/")[1:])
 
     # Extract file name
     file_name = os.path.basename(local_path)  # Ensures correct filename extraction
     destination_blob_name = destination_blob_name.rstrip('/') + '/' + file_name  # Ensure proper path
+    public_url = f"https://storage.googleapis.com/{bucket_name}/{destination_blob_name}"
+    return bucket_name, destination_blob_name, public_url
 
-    if verbose:
-        print(f"Uploading {local_path} to gs://{bucket_name}/{destination_blob_name}...")
 
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(local_path)
-    blob.make_public()
-    public_url = f"https://storage.googleapis.com/{bucket_name}/{destination_blob_name}"
+def _upload_blob(local_path, bucket_name, destination_blob_name, public=True):
+    blob = storage_client().bucket(bucket_name).blob(destination_blob_name)
+    # a public file gets its ACL with the upload, instead of a separate make_public call
+    blob.upload_from_filename(local_path, predefined_acl='publicRead' if public else None)
 
-    if verbose:
-        print(f"✅ Report uploaded successfully. View at: {public_url}")
 
-    return public_url
+@tn.retry(wait=tn.wait_exponential(multiplier=2, max=60),
+          stop=tn.stop_after_attempt(5),
+          before_sleep=my_before_sleep,
+          reraise=True)
+def _upload_with_retries(text, gcs_path, file_name, verbose, public):
+    return upload_report_to_gcs(text, gcs_path, file_name, verbose, public)
+
+
+class UploadQueue:
+    ''' uploads reports to GCS in the background, max_workers at a time, retrying each upload a few times.
+    reports are retried whole, so they're submitted as strings (not as chunks that can only be read once).
+    submit() returns the report's public url straight away (submit_future() returns the upload's future, to wait
+    for one upload); flush() waits for everything submitted so far.
+    '''
+
+    def __init__(self, max_workers=UPLOAD_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload')
+        self._lock = threading.Lock()
+        self._pending = []      # (file name, future)
+        self.failures = []      # (file name, exception) of uploads that failed after retries
+
+    def submit(self, text, gcs_path, file_name, verbose=True, public=True):
+        self.submit_future(text, gcs_path, file_name, verbose, public)
+        return upload_destination(file_name, gcs_path)[2]
+
+    def submit_future(self, text, gcs_path, file_name, verbose=True, public=True):
+        ''' like submit(), but returns the upload's future: its result is the public url, or it raises if the
+        upload failed after retries
+        '''
+        future = self._executor.submit(_upload_with_retries, text, gcs_path, file_name, verbose, public)
+        with self._lock:
+            self._pending.append((file_name, future))
+        return future
+
+    def flush(self):
+        ''' wait for all submitted uploads to finish; returns the (file name, exception) of any that failed '''
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return list(self.failures)
+            for file_name, future in pending:
+                error = future.exception()
+                if error is not None:
+                    print(f'Upload of {file_name} failed: {error}')
+                    with self._lock:
+                        self.failures.append((file_name, error))
+
+
+_upload_queue = UploadQueue()
+
+
+def get_upload_queue():
+    return _upload_queue
+
+
+def download_from_gcs(gcs_file, local_path):
+    """
+    Downloads a file from Google Cloud Storage.
+
+    Args:
+        gcs_file (str): GCS path of the file (e.g., 'gs://my-bucket/path/file.sqlite').
+        local_path (str): Where to save it.
+
+    Returns:
+        bool: False if there is no such file in the bucket.
+    """
+    return get_transport().download(_download_blob, gcs_file, local_path)
+
+
+def _download_blob(gcs_file, local_path):
+    bucket_name, blob_name = split_gcs_path(gcs_file)
+    blob = storage_client().bucket(bucket_name).blob(blob_name)
+    if not blob.exists():
+        return False
+    blob.download_to_filename(local_path)
+    return True
@@ -1,24 +1,60 @@
-import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
 from get_fws import get_fws_dict_from_folder
 from fiss_fns import call_fiss
-from gcs_fns import convert_to_public_url, upload_to_gcs
+from gcs_fns import convert_to_public_url, gsutil_cat_many, gsutil_ls, upload_report_to_gcs
+from cost_ledger import get_cost_ledger
+from ws_class import dump_sidecar, load_sidecar, sidecar_name
+from report_templates import COST_REPORT, COST_ROW, COST_TABLE_HEADER, TABLE_STYLE
 from firecloud import api as fapi
 
 
-def get_cost_of_test(gcs_path, report_name, clone_project, verbose=True):
+# workspaces (and, where the listing has no cost, submissions) whose costs are fetched at once
+COST_WORKERS = 8
+
+
+def get_submission_costs(project, workspace, executor=None):
+    ''' the wf_name, submission_id, submitted (date) and cost of every submission in a workspace, as a list of
+    dicts in listing order, or None if the workspace doesn't exist. costs come from the list_submissions listing;
+    a get_submission call (run on executor, if given) is only made for submissions listed without a cost.
+    submissions that no longer exist are skipped.
+    '''
+    submissions_json = call_fiss(fapi.list_submissions, 200, project, workspace, specialcodes=[404])
+    if submissions_json.status_code == 404:  # error 404 means workspace does not exist
+        return None
+    submissions_json = submissions_json.json()
+
+    def cost_of(sub):
+        if sub.get('cost') is not None:
+            return sub['cost']
+        sub_json = call_fiss(fapi.get_submission, 200, project, workspace, sub['submissionId'], specialcodes=[404])
+        if sub_json.status_code == 404:  # 404 means submission not found
+            return None
+        return sub_json.json()['cost']
+
+    costs = executor.map(cost_of, submissions_json) if executor is not None else map(cost_of, submissions_json)
+    return [{'wf_name': sub['methodConfigurationName'],
+             'submission_id': sub['submissionId'],
+             'submitted': sub.get('submissionDate'),
+             'cost': cost}
+            for sub, cost in zip(submissions_json, costs) if cost is not None]
+
+
+def get_cost_of_test(gcs_path, report_name, clone_project, verbose=True, max_workers=COST_WORKERS, ledger=None,
+                     ws_to_check=None):
+    ''' generate the cost report for a test run; with a CostLedger, its submission costs are also recorded there.
+    ws_to_check is the run's dict of tested workspaces, e.g. from its master report's json sidecar; by default
+    it's rebuilt from the folder where the individual reports live
+    '''
     clone_time = report_name.replace('master_report_','').replace('.html','')
     if verbose:
         print('generating cost report for '+report_name)
 
 
-    # get the folder where the individual reports live
-    report_folder = gcs_path + clone_time
-    # get a list of the individual reports for this master report
-    system_command = "gsutil ls " + report_folder
-    all_paths = os.popen(system_command).read()
-
-    # get a dict of all workspaces
-    ws_to_check = get_fws_dict_from_folder(gcs_path, clone_time, clone_project, False)
+    # get a dict of all workspaces, from the folder where the individual reports live
+    if ws_to_check is None:
+        ws_to_check = get_fws_dict_from_folder(gcs_path, clone_time, clone_project, False)
 
     # get a list of all workspaces & projects
     ws_json = call_fiss(fapi.list_workspaces, 200)
@@ -26,41 +62,39 @@ def get_cost_of_test(gcs_path, report_name, clone_project, verbose=True):
     for ws in ws_json:
         project_dict[ws['workspace']['name']] = ws['workspace']['namespace']
     names_with_spaces = [key for key in project_dict.keys() if ' ' in key]
-    
-    total_cost = 0
-    abort = False
-    # for each workspace, get a list of submissions run
-    for ws in ws_to_check.values(): 
+
+    for ws in ws_to_check.values():
         # find unformatted workspace name (where spaces are really spaces)
         for key in names_with_spaces:
             if key.replace(' ','_') == ws.workspace:
                 ws.workspace = key
+
+    # get the cost of each workspace's submissions, many workspaces (and submissions) at a time
+    with ThreadPoolExecutor(max_workers=max_workers) as ws_executor, \
+            ThreadPoolExecutor(max_workers=max_workers) as sub_executor:
+        all_costs = dict(zip(ws_to_check, ws_executor.map(
+            lambda ws: get_submission_costs(ws.project, ws.workspace, sub_executor), ws_to_check.values())))
+
+    total_cost = 0
+    abort = False
+    # store the cost of each submission, and track total cost for the workspace in ws_cost
+    for key, ws in ws_to_check.items():
+        costs = all_costs[key]
+        if costs is None:
+            abort = True
+            break
         if verbose:
             print(ws.workspace)
-        
-        # get & store cost of each submission, and track total cost for the workspace in ws_cost
+
         ws_cost = 0
-        submissions_json = call_fiss(fapi.list_submissions, 200, ws.project, ws.workspace, specialcodes=[404])
-        if submissions_json.status_code == 404: # error 404 means workspace does not exist
-            abort = True
-            break
-        else:
-            submissions_json = submissions_json.json()
         submissions_dict = {}
-        for sub in submissions_json:
-            wf_name = sub['methodConfigurationName']
+        for sub in costs:
+            submissions_dict[sub['wf_name']] = '${:.2f}'.format(sub['cost'])
+            total_cost += sub['cost']
+            ws_cost += sub['cost']
             if verbose:
-                print('  '+wf_name)
-            subID = sub['submissionId']
-            sub_json = call_fiss(fapi.get_submission, 200, ws.project, ws.workspace, subID, specialcodes=[404])
-            if sub_json.status_code != 404: # 404 means submission not found
-                sub_json = sub_json.json()
-                cost = sub_json['cost']
-                submissions_dict[wf_name] = '${:.2f}'.format(cost)
-                total_cost += cost
-                ws_cost += cost
-                if verbose:
-                    print('    cost '+'${:.2f}'.format(cost))
+                print('  '+sub['wf_name'])
+                print('    cost '+'${:.2f}'.format(sub['cost']))
 
         ws.submissions_cost=submissions_dict
         ws.total_cost=ws_cost
@@ -74,19 +108,16 @@ def get_cost_of_test(gcs_path, report_name, clone_project, verbose=True):
             print('${:.2f}'.format(total_cost))
 
         # format a report
-        report_path = generate_cost_report(gcs_path, report_name, total_cost, ws_to_check, verbose)
+        report_path = generate_cost_report(gcs_path, report_name, total_cost, ws_to_check, verbose,
+                                           clone_time=clone_time)
+        if ledger is not None:
+            ledger.record_run(report_name, clone_time, ws_to_check, all_costs)
     
     return report_path, total_cost
 
 
-def generate_cost_report(gcs_path, report_name, total_cost, ws_dict, verbose=True):
-    ''' generate a report that lists all tested workspaces, the test COST,
-    and links to each workspace report for all workspaces in ws_dict
-    '''
-    if verbose:
-        print('\nGenerating master cost report')
-
-
+def render_cost_report(gcs_path, report_name, total_cost, ws_dict):
+    ''' the html of the cost report for the workspaces in ws_dict, piece by piece (see report_templates) '''
     # list reports in alphabetical order, with failed reports first
     finished_report_keys = sorted(ws_dict.keys())
 
@@ -94,129 +125,98 @@ def generate_cost_report(gcs_path, report_name, total_cost, ws_dict, verbose=Tru
     link = convert_to_public_url(gcs_path + report_name)
     total_cost_text = 'For Master Report <a href=' + link + '>' + report_name + '</a>' \
                         + '<br>Total cost: '+'${:,.2f}'.format(total_cost)
-    
-    table_style_text = '''
-                    <style>
-                    table {
-                    font-family: Montserrat, sans-serif;
-                    border-collapse: collapse;
-                    width: 100%;
-                    }
-                    td, th {
-                    border: 1px solid #dddddd;
-                    text-align: left;
-                    padding: 8px;
-                    }
-                    </style>
-                    '''
-
-    workspaces_text = '''
-                    <table>
-                    <col width="10%">
-                    <col width="30%">
-                    <tr>
-                        <th>Orig. Project</th>
-                        <th>Featured Workspace</th>
-                        <th>Report link</th>
-                        <th># Workflows</th>
-                        <th>Total cost</th>
-                        <th>Breakdown</th>
-                    </tr>
-                    '''
-    for key in finished_report_keys:
-        breakdown_text = ''
-        for wf_name, cost in ws_dict[key].submissions_cost.items():
-            breakdown_text += wf_name + ': ' + cost + '<br>'
-
-        workspaces_text += '''
-                            <tr>
-                                <td>{project}</td>
-                                <td><big>{workspace}</big></td>
-                                <td><a href={report_path} target='_blank'>[open report for details]</a></td>
-                                <td>{num_wf}</td>
-                                <td>{ws_cost}</td>
-                                <td>{breakdown_text}</td>
-                            </tr>                        
-                    '''.format(project = ws_dict[key].project_orig,
-                                workspace = ws_dict[key].workspace_orig,
-                                report_path = ws_dict[key].report_path,
-                                num_wf = str(len(ws_dict[key].submissions_cost)),
-                                ws_cost = '${:,.2f}'.format(ws_dict[key].total_cost),
-                                breakdown_text = breakdown_text)
-    workspaces_text += '</table>'
 
-    
-    
-    message = '''<html>
-    <head>
-    {table_style_text}
-    </head>
-    <body style='font-family:Montserrat,sans-serif; font-size:18px; padding:30; background-color:#FAFBFD'>
-    <p>
-    <center><div style='background-color:#82AA52; color:#FAFBFD; height:100px'>
-    <h1>
-    <img src='https://app.terra.bio/static/media/logo-wShadow.c7059479.svg' alt='Terra rocks!' style='vertical-align: middle;' height='100'>
-    <span style='vertical-align: middle;'>
-    Featured Workspace Test Cost Report</span></h1></center></div>
-
-    <br><center><big>{total_cost_text}</big></center>
-    <br><br>
-    {workspaces_text}<br>
-    </p>
-    </p></body>
-    </html>'''
-
-    message = message.format(table_style_text = table_style_text,
-                            total_cost_text = total_cost_text,
-                            workspaces_text = workspaces_text)
+    def rows():
+        for key in finished_report_keys:
+            ws = ws_dict[key]
+            yield COST_ROW.render(project=ws.project_orig,
+                                  workspace=ws.workspace_orig,
+                                  report_path=ws.report_path,
+                                  num_wf=len(ws.submissions_cost),
+                                  ws_cost='${:,.2f}'.format(ws.total_cost),
+                                  breakdown_text=[wf_name + ': ' + cost + '<br>'
+                                                  for wf_name, cost in ws.submissions_cost.items()])
 
-    
-    
-    # open, generate, and write the html text for the report
-    local_path = '/tmp/' + report_name.replace('.html','_COST.html')
-    f = open(local_path,'w')
-    f.write(message)
-    f.close()
+    return COST_REPORT.chunks(table_style_text=TABLE_STYLE,
+                              total_cost_text=total_cost_text,
+                              workspaces_text=chain([COST_TABLE_HEADER], rows(), ['</table>']))
 
-    # upload report to google cloud bucket
-    report_path = upload_to_gcs(local_path, gcs_path, verbose)
+
+def generate_cost_report(gcs_path, report_name, total_cost, ws_dict, verbose=True, clone_time=None):
+    ''' generate a report that lists all tested workspaces, the test COST,
+    and links to each workspace report for all workspaces in ws_dict
+    '''
+    if verbose:
+        print('\nGenerating master cost report')
+
+    # render the report straight into the (gzipped) upload, with its machine-readable version
+    cost_report_name = report_name.replace('.html','_COST.html')
+    report_path = upload_report_to_gcs(render_cost_report(gcs_path, report_name, total_cost, ws_dict), gcs_path,
+                                       cost_report_name, verbose)
+    upload_report_to_gcs(dump_sidecar(ws_dict.values(), report_name=report_name, clone_time=clone_time,
+                                      total_cost=total_cost),
+                         gcs_path, sidecar_name(cost_report_name), verbose, public=False)
 
     return report_path
 
-def get_cost_of_all_tests(gcs_path, project, verbose):
-    system_command = "gsutil ls " + gcs_path
-    all_paths = os.popen(system_command).read()
-
-    master_report_list = [] # accumulate all master reports to test
-    cost_report_list = [] # accumulate existing cost reports
-    for path in all_paths.split('\n'):
-        if ('master_report' in path) and ('COST' not in path):
-            if path.replace('.html','_COST.html') in all_paths.split('\n'): 
-                # don't redo a report you've already done
-                cost_report_list.append(path.replace('.html','_COST.html').split('/')[-1])
-            else:
-                master_report_list.append(path.split('/')[-1])
-
-    costs_over_time = []
-    # get new reports
+def get_cost_of_all_tests(gcs_path, project, verbose, ledger=None):
+    ''' make cost reports for the test runs in gcs_path that don't have one yet, recording their costs in the
+    ledger (by default the process-wide CostLedger), and print the total cost of every run
+    '''
+    ledger = ledger or get_cost_ledger()
+    ledger.pull(verbose)
+    run_totals = ledger.run_totals()
+
+    all_paths = gsutil_ls(gcs_path).split('\n')
+    master_report_paths = [path for path in all_paths
+                           if ('master_report' in path) and ('COST' not in path) and path.endswith('.html')]
+    master_report_list = [path.split('/')[-1] for path in master_report_paths]
+
+    # for the runs not in the ledger yet, read (all at once) their existing cost report, or else the json sidecar
+    # of their master report listing the tested workspaces. cost reports made before sidecars existed are
+    # parsed from the html
+    to_read = []
+    for path, report_name in zip(master_report_paths, master_report_list):
+        if report_name in run_totals:
+            continue  # already in the ledger
+        cost_report_path = path.replace('.html','_COST.html')
+        for candidate in [sidecar_name(cost_report_path), cost_report_path, sidecar_name(path)]:
+            if candidate in all_paths:
+                to_read.append(candidate)
+                break
+    contents = gsutil_cat_many(to_read)
+
+    recorded = False
+    for path, report_name in zip(master_report_paths, master_report_list):
+        if report_name in run_totals:
+            continue  # already in the ledger
+        clone_time = report_name.replace('master_report_','').replace('.html','')
+        cost_report_path = path.replace('.html','_COST.html')
+        if sidecar_name(cost_report_path) in contents:
+            total_cost = load_sidecar(contents[sidecar_name(cost_report_path)])['total_cost']
+            ledger.record_total(report_name, clone_time, total_cost)
+            recorded = True
+        elif cost_report_path in contents:
+            for line in contents[cost_report_path].split('\n'):
+                if 'Total cost:' in line:
+                    cost = line.split('cost: ')[-1].split('</big>')[0]
+                    ledger.record_total(report_name, clone_time, float(cost.replace('$', '').replace(',', '')))
+                    recorded = True
+        else:
+            ws_to_check = None
+            if sidecar_name(path) in contents:
+                ws_to_check = load_sidecar(contents[sidecar_name(path)])['workspaces']
+            report_path, cost = get_cost_of_test(gcs_path, report_name, project, verbose, ledger=ledger,
+                                                 ws_to_check=ws_to_check)
+            recorded = recorded or report_path is not None
+
+    if recorded:
+        ledger.push(verbose)
+        run_totals = ledger.run_totals()
+
     for report_name in master_report_list:
-        report_path, cost = get_cost_of_test(gcs_path, report_name, project, verbose)
-        # clone_time = report_name.replace('master_report_','').replace('.html','')
-        costs_over_time.append('${:,.2f}'.format(cost))
-    # accumulate previously calculated reports
-    for report_name in cost_report_list:
-        system_command = 'gsutil cat ' + gcs_path+report_name
-        contents = os.popen(system_command).read()
-        for line in contents.split('\n'):
-            # get cost
-            if 'Total cost:' in line:
-                cost = line.split('cost: ')[-1].split('</big>')[0]
-        costs_over_time.append(cost)
-
-
-    all_reports = master_report_list + cost_report_list
-    for i in range(len(all_reports)):
-        print(all_reports[i], costs_over_time[i])
+        if report_name in run_totals:
+            print(report_name, '${:,.2f}'.format(run_totals[report_name]))
 
 
 if __name__ == "__main__":
@@ -7,12 +7,16 @@ from firecloud import api as fapi
 
 from fiss_api_addons import get_workspace_cloudPlatform
 from fiss_fns import call_fiss
+from gcs_fns import gsutil_cat_many, gsutil_ls
+from transport import get_transport
 from workspace_test_report import list_notebooks, clone_workspace
-from ws_class import Wspace
+from ws_class import Wspace, load_sidecar
 
 
 def get_fws_dict_from_folder(gcs_path, test_master_report, clone_project, verbose=True):
-    ''' note this will NOT work except on a mac 
+    ''' rebuild the dict of tested workspaces from a folder of workspace reports that have already been run.
+    the reports are listed and read with the storage client, many at a time. a report's json sidecar is read
+    instead of its html where there is one (reports made before sidecars existed are parsed from the html)
     '''
     # generate a master report from a folder of workspace reports that have already been run
     report_folder = gcs_path + test_master_report
@@ -21,13 +25,17 @@ def get_fws_dict_from_folder(gcs_path, test_master_report, clone_project, verbos
     report_folder = report_folder.rstrip('/')
 
     # get list of reports in gcs bucket
-    system_command = "gsutil ls " + report_folder
-    all_paths = os.popen(system_command).read()
+    all_paths = gsutil_ls(report_folder)
 
     # pull out info
     fws_dict = {}
 
-    for path in all_paths.split('\n'):
+    all_paths = all_paths.split('\n')
+    sidecars = [path for path in all_paths if path.endswith('.json')]
+    reports = {}  # path -> (cloned workspace name, original featured workspace name)
+    for path in all_paths:
+        if not path.endswith('.html') or path.replace('.html', '.json') in sidecars:
+            continue
         ws_name = path.replace('.html', '').replace(report_folder + '/', '')
         ws_orig = ''.join(ws_name.split('_')[:-1])  # the original featured workspace name
 
@@ -35,45 +43,56 @@ def get_fws_dict_from_folder(gcs_path, test_master_report, clone_project, verbos
             print(ws_name)
 
         if len(ws_orig) > 0:  # in case of empty string
-            system_command = 'gsutil cat ' + path
-            contents = os.popen(system_command).read()
+            reports[path] = (ws_name, ws_orig)
+
+    # read all the reports at once
+    all_contents = gsutil_cat_many(sidecars + list(reports))
+
+    for path in sidecars:
+        fws_dict.update(load_sidecar(all_contents[path])['workspaces'])
 
-            for line in contents.split('\n'):
-                # get original billing project
-                if 'Billing Project:' in line:
-                    project_orig = line.split('</b>')[-1].replace('</big>', '')
+    for path, (ws_name, ws_orig) in reports.items():
+        contents = all_contents[path]
+        for line in contents.split('\n'):
+            # get original billing project
+            if 'Billing Project:' in line:
+                project_orig = line.split('</b>')[-1].replace('</big>', '')
 
-                # get workspace test status
-                if 'SUCCESS!' in line:
-                    status = 'SUCCESS!'
-                elif 'FAILURE!' in line:
-                    status = 'FAILURE!'
+            # get workspace test status
+            if 'SUCCESS!' in line:
+                status = 'SUCCESS!'
+            elif 'FAILURE!' in line:
+                status = 'FAILURE!'
 
-            key = project_orig + '/' + ws_orig
+        key = project_orig + '/' + ws_orig
 
-            fws_dict[key] = Wspace(workspace=ws_name,
-                                   project=clone_project,
-                                   workspace_orig=ws_orig,
-                                   project_orig=project_orig,
-                                   status=status,
-                                   report_path=path.replace('gs://', 'https://storage.googleapis.com/'))
+        fws_dict[key] = Wspace(workspace=ws_name,
+                               project=clone_project,
+                               workspace_orig=ws_orig,
+                               project_orig=project_orig,
+                               status=status,
+                               report_path=path.replace('gs://', 'https://storage.googleapis.com/'))
 
     return fws_dict
 
 
 def get_fw_json():
-    request_url = 'https://storage.googleapis.com/firecloud-alerts/featured-workspaces.json'
-    fws_json = requests.get(request_url).json()
+    # FEATURED_WORKSPACES_URL can point this at another list, e.g. the one served by a local terra_simulator
+    request_url = os.environ.get('FEATURED_WORKSPACES_URL',
+                                 'https://storage.googleapis.com/firecloud-alerts/featured-workspaces.json')
+    fws_json = get_transport().call('http', request_url, lambda url: requests.get(url).json(), request_url)
 
     return fws_json
 
 
 def get_cloudPlatform(namespace, name):
     """get cloud platform of workspace"""
-    fws_response = get_workspace_cloudPlatform(namespace, name)
+    # a workspace we can't look up (e.g. no access) stays in the run, with no cloud platform
+    fws_response = call_fiss(get_workspace_cloudPlatform, 200, namespace, name, specialcodes=[400, 401, 403, 404])
     if fws_response.status_code != 200:
         print(f'Error retrieving workspace information for workspace {namespace}/{name}')
         print(fws_response.text)
+        return None
 
     fws_cloudplatform = fws_response.json()
     try:
@@ -0,0 +1,126 @@
+import functools
+import json
+import math
+import threading
+import time
+
+
+def percentile(sorted_values, pct):
+    ''' nearest-rank percentile of an already sorted list '''
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Metrics:
+    ''' thread-safe per-function call metrics: latencies, response status codes,
+    bytes received, errors raised, and retries (with the time spent waiting to retry)
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}     # name -> list of seconds
+        self.status_codes = {}  # name -> {status code: count}
+        self.errors = {}        # name -> {exception name: count}
+        self.bytes = {}         # name -> total bytes received
+        self.retries = {}       # name -> number of retries
+        self.retry_wait = {}    # name -> total seconds spent waiting to retry
+
+    def record_call(self, name, seconds, status_code=None, n_bytes=0, error=None):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            self.bytes[name] = self.bytes.get(name, 0) + n_bytes
+            if status_code is not None:
+                codes = self.status_codes.setdefault(name, {})
+                codes[status_code] = codes.get(status_code, 0) + 1
+            if error is not None:
+                errors = self.errors.setdefault(name, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def record_retry(self, name, wait_seconds):
+        with self._lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+            self.retry_wait[name] = self.retry_wait.get(name, 0) + wait_seconds
+
+    def summary(self):
+        ''' dict of name -> summary stats, sorted by total time spent in that function '''
+        with self._lock:
+            summary = {}
+            for name, values in self.latencies.items():
+                values = sorted(values)
+                summary[name] = {'calls': len(values),
+                                 'total_seconds': sum(values),
+                                 'p50': percentile(values, 50),
+                                 'p95': percentile(values, 95),
+                                 'p99': percentile(values, 99),
+                                 'max': values[-1],
+                                 'status_codes': {str(code): n for code, n in self.status_codes.get(name, {}).items()},
+                                 'errors': dict(self.errors.get(name, {})),
+                                 'bytes_received': self.bytes.get(name, 0),
+                                 'retries': self.retries.get(name, 0),
+                                 'retry_wait_seconds': self.retry_wait.get(name, 0)}
+        return dict(sorted(summary.items(), key=lambda item: -item[1]['total_seconds']))
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def write_prometheus(self, path):
+        ''' write the metrics in the Prometheus textfile exposition format '''
+        lines = ['# TYPE fw_call_duration_seconds summary',
+                 '# TYPE fw_responses_total counter',
+                 '# TYPE fw_errors_total counter',
+                 '# TYPE fw_response_bytes_total counter',
+                 '# TYPE fw_retries_total counter',
+                 '# TYPE fw_retry_wait_seconds_total counter']
+        for name, stats in self.summary().items():
+            label = f'function="{name}"'
+            for key, quantile in [('p50', '0.5'), ('p95', '0.95'), ('p99', '0.99')]:
+                lines.append(f'fw_call_duration_seconds{{{label},quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'fw_call_duration_seconds_sum{{{label}}} {stats["total_seconds"]}')
+            lines.append(f'fw_call_duration_seconds_count{{{label}}} {stats["calls"]}')
+            for code, n in stats['status_codes'].items():
+                lines.append(f'fw_responses_total{{{label},code="{code}"}} {n}')
+            for error, n in stats['errors'].items():
+                lines.append(f'fw_errors_total{{{label},error="{error}"}} {n}')
+            lines.append(f'fw_response_bytes_total{{{label}}} {stats["bytes_received"]}')
+            lines.append(f'fw_retries_total{{{label}}} {stats["retries"]}')
+            lines.append(f'fw_retry_wait_seconds_total{{{label}}} {stats["retry_wait_seconds"]}')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def report(self, top=10):
+        ''' returns a printable table of the functions that took the most total time '''
+        lines = [f'{"function":40} {"calls":>7} {"total s":>9} {"p50 s":>7} {"p95 s":>7} {"p99 s":>7} {"retries":>7}']
+        for name, stats in list(self.summary().items())[:top]:
+            lines.append(f'{name:40} {stats["calls"]:7d} {stats["total_seconds"]:9.1f} {stats["p50"]:7.2f} '
+                         f'{stats["p95"]:7.2f} {stats["p99"]:7.2f} {stats["retries"]:7d}')
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+def timed(func, name=None):
+    ''' wrap func so that every call is recorded in the process-wide metrics. if the result looks
+    like an http response, its status code and size are recorded too.
+    '''
+    name = name or getattr(func, '__name__', str(func))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            metrics.record_call(name, time.perf_counter() - start, error=type(e).__name__)
+            raise
+        status_code = getattr(result, 'status_code', None)
+        n_bytes = 0
+        if status_code is not None:
+            n_bytes = int(result.headers.get('Content-Length', 0)) or len(result.content or b'')
+        metrics.record_call(name, time.perf_counter() - start, status_code, n_bytes)
+        return result
+
+    return wrapper
@@ -0,0 +1,204 @@
+import queue
+import threading
+import time
+from datetime import datetime
+
+import tenacity
+from firecloud.errors import FireCloudServerError
+
+from workspace_test_report import clone_workspace
+from workflow_dag import load_workflow_config
+
+_DONE = object()  # sentinel telling a stage worker that there is no more input
+
+
+def _no_checkpoint(key, ws):
+    pass
+
+
+def _put_unless_stopped(q, item, stop):
+    ''' put item on q, blocking while it is full, unless stop is set first. returns whether item was put '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def clone_stage(clone_q, poll_q, args, clone_time, scheduler, checkpoint, stop):
+    ''' clone workspaces and create & launch their submissions, handing each workspace
+    to the poll stage as soon as it is ready (blocking if the poll queue is full, until stop is set)
+    '''
+    while True:
+        ws = clone_q.get()
+        if ws is _DONE:
+            return
+        try:
+            clone_ws = clone_workspace(ws.project, ws.workspace, args.clone_project,
+                                       clone_time=clone_time, share_with=args.share_with,
+                                       call_cache=args.call_cache, verbose=args.verbose)
+            clone_ws.create_submissions(verbose=args.verbose,
+                                        dependencies=load_workflow_config(args.workflow_config).get(ws.key))
+            clone_ws.start_timer()
+            checkpoint(ws.key, clone_ws)
+            clone_ws.check_submissions(abort_hr=args.abort_hr, verbose=False, scheduler=scheduler)
+            checkpoint(ws.key, clone_ws)
+        except (tenacity.RetryError, FireCloudServerError) as e:
+            if args.verbose:
+                print(f"Error while cloning workspace {ws.workspace}: {e}")
+            continue
+        if not _put_unless_stopped(poll_q, (ws.key, clone_ws), stop):
+            return
+
+
+def report_stage(report_q, fws_testing, lock, gcs_path, send_notifications, args, checkpoint):
+    ''' generate the report for each workspace whose submissions have all finished.
+    a workspace whose report fails is marked failed (and still listed in the master report), without stopping
+    the worker. workspaces already marked failed while polling are listed without a report.
+    '''
+    while True:
+        item = report_q.get()
+        if item is _DONE:
+            return
+        key, clone_ws = item
+        if clone_ws.status is None:
+            try:
+                clone_ws.generate_workspace_report(gcs_path, send_notifications, args.verbose)
+            except Exception as e:
+                print(f"Error while reporting workspace {clone_ws.workspace}: {type(e).__name__}: {e}")
+                clone_ws.status = f'FAILURE! (report not generated: {type(e).__name__})'
+        checkpoint(key, clone_ws)
+        with lock:
+            fws_testing[key] = clone_ws
+
+
+def poll_stage(poll_q, report_q, clone_threads, args, scheduler, checkpoint, active):
+    ''' check the submissions of every workspace that has been cloned so far (starting with
+    the dict of workspaces in active), and pass workspaces whose submissions have all finished
+    on to the report stage (blocking while the report queue is full).
+    with args.stage_queue_size set, at most that many workspaces are polled at once, and the rest wait in
+    the poll queue, which holds back the clone stage. a workspace whose submissions can't be checked is
+    marked failed and passed on, without stopping the others.
+    '''
+    limit = args.stage_queue_size
+    n_done = 0
+    next_tick = 0
+    while True:
+        # check whether cloning is still going BEFORE taking from the queue, so nothing is missed at the end
+        cloning = any(t.is_alive() for t in clone_threads)
+        while not limit or len(active) < limit:
+            try:
+                key, clone_ws = poll_q.get_nowait()
+            except queue.Empty:
+                break
+            active[key] = clone_ws
+
+        if active and time.time() >= next_tick:
+            tick_start = time.time()
+            if args.verbose:
+                print(f"\n{datetime.today().strftime('%H:%M')} status check:")
+            for key, clone_ws in list(active.items()):
+                if args.verbose:
+                    print(f" Checking for submission status for {clone_ws.workspace}:")
+                try:
+                    clone_ws.check_submissions(abort_hr=args.abort_hr, scheduler=scheduler)
+                except Exception as e:
+                    print(f"Error while checking submissions for workspace {clone_ws.workspace}: "
+                          f"{type(e).__name__}: {e}")
+                    clone_ws.status = f'FAILURE! (submissions not checked: {type(e).__name__})'
+                checkpoint(key, clone_ws)
+                if not clone_ws.active_submissions or clone_ws.status is not None:
+                    clone_ws.stop_timer()
+                    report_q.put((key, active.pop(key)))
+                    n_done += 1
+            if args.verbose:
+                print(f"Finished {n_done} Featured Workspaces; {len(active)} being polled"
+                      + (", more still cloning" if cloning else ""))
+
+            if scheduler is not None:
+                # tick again when the next submission is due to be checked
+                wait = scheduler.seconds_until_due()
+                next_tick = time.time() + max(wait if wait is not None else args.min_poll_interval, 1)
+            else:
+                next_tick = tick_start + args.sleep_time
+
+        if not cloning and not active and poll_q.empty():
+            return
+
+        # wait for the next tick, waking early if a newly cloned workspace arrives and there's room for it
+        timeout = min(max(next_tick - time.time(), 1), 10)
+        if limit and len(active) >= limit:
+            time.sleep(timeout)
+            continue
+        try:
+            key, clone_ws = poll_q.get(timeout=timeout)
+            active[key] = clone_ws
+        except queue.Empty:
+            pass
+
+
+def test_all_pipeline(fws, args, clone_time, gcs_path, send_notifications, scheduler=None,
+                      checkpoint=None, cloned=None):
+    ''' test all workspaces in fws as a streaming clone -> poll -> report pipeline, so that each workspace
+    is polled as soon as its own clone and submissions are done, and reported as soon as it finishes.
+    clone workers run on args.max_concurrency threads and reports on args.report_workers threads;
+    args.stage_queue_size bounds the queues between stages and the number of workspaces polled at once
+    (0 means unbounded).
+    checkpoint(key, clone_ws) is called whenever a workspace's state may have changed, and cloned is
+    an optional dict of already-cloned workspaces (from a resumed run) that skip the clone stage.
+    returns a dict of the reported workspaces, keyed like fws.
+    '''
+    checkpoint = checkpoint or _no_checkpoint
+    cloned = cloned or {}
+    clone_q = queue.Queue()
+    poll_q = queue.Queue(maxsize=args.stage_queue_size)
+    report_q = queue.Queue(maxsize=args.stage_queue_size)
+    lock = threading.Lock()
+    stop = threading.Event()    # set if polling fails, so that the clone workers stop
+
+    # workspaces from a resumed run are either already reported, or go straight to polling
+    fws_testing = {key: ws for key, ws in cloned.items() if ws.status is not None}
+    active = {key: ws for key, ws in cloned.items() if ws.status is None}
+    to_clone = [ws for key, ws in fws.items() if key not in cloned]
+
+    n_clone_workers = max(min(args.max_concurrency, len(to_clone)), 1)
+    for ws in to_clone:
+        clone_q.put(ws)
+    for _ in range(n_clone_workers):
+        clone_q.put(_DONE)
+
+    clone_threads = [threading.Thread(target=clone_stage,
+                                      args=(clone_q, poll_q, args, clone_time, scheduler, checkpoint, stop))
+                     for _ in range(n_clone_workers)]
+    report_threads = [threading.Thread(target=report_stage,
+                                       args=(report_q, fws_testing, lock, gcs_path, send_notifications, args,
+                                             checkpoint))
+                      for _ in range(args.report_workers)]
+    for t in clone_threads + report_threads:
+        t.start()
+
+    try:
+        poll_stage(poll_q, report_q, clone_threads, args, scheduler, checkpoint, active)
+    except BaseException:
+        # don't clone (or launch submissions for) any more workspaces once the run has failed
+        stop.set()
+        while True:
+            try:
+                clone_q.get_nowait()
+            except queue.Empty:
+                break
+        for _ in clone_threads:
+            clone_q.put(_DONE)
+        for t in clone_threads:
+            t.join()
+        raise
+    finally:
+        # always stop the report workers, so that an error while polling fails the run instead of hanging it
+        for _ in report_threads:
+            report_q.put(_DONE)
+        for t in report_threads:
+            t.join()
+
+    return fws_testing
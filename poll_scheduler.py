@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+
+# submission states worth polling quickly when a submission enters them, since fast failures show up then.
+# a submission stays Submitted while its workflows run, so these are only polled quickly for startup_window seconds
+STARTUP_STATES = ['submission initialized in Python', 'Accepted', 'Evaluating', 'Submitting', 'Submitted']
+
+
+def history_key(sub):
+    ''' key used to look up a workflow's historical runtime: the original workspace name
+    (with the clone timestamp stripped off) and the workflow name
+    '''
+    workspace_orig = re.sub(r'_\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$', '', sub.workspace)
+    return f'{workspace_orig}/{sub.wf_name}'
+
+
+class PollScheduler:
+    ''' priority-queue scheduler that keeps a next-check deadline for every active submission.
+
+    - submissions submitted less than startup_window seconds ago, or that entered a startup state less than
+      startup_window seconds ago, are polled every min_interval seconds so that fast failures are detected quickly
+    - while a submission stays in the same state, its interval grows by a factor of backoff each check,
+      up to max_interval
+    - if the workflow's historical runtime is known, the next check is never scheduled later than
+      its expected completion time, and is polled every min_interval seconds just after that time
+    '''
+
+    def __init__(self, min_interval=15, max_interval=900, backoff=1.5, startup_window=600, history=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.startup_window = startup_window
+        self.history = history if history is not None else {}  # history_key -> runtime in seconds
+
+        self._lock = threading.Lock()
+        self._heap = []                     # (deadline, seq, key), with lazy deletion
+        self._seq = itertools.count()
+        self._deadlines = {}                # key -> next-check deadline
+        self._state = {}                    # key -> dict of first_seen, last_status, status_since, interval
+        self._completed = set()             # keys of submissions that reached a terminal state
+
+    @staticmethod
+    def _key(sub):
+        return (sub.project, sub.workspace, sub.wf_name)
+
+    def _prune(self):
+        ''' drop heap entries that are stale (rescheduled or completed): those on top, and all of them once
+        they outnumber the live ones, so the heap stays proportional to the submissions being tracked
+        even when nothing reads it in deadline order (call with the lock held)
+        '''
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
+
+    def is_due(self, sub, now=None):
+        ''' True if the submission has never been checked or its next-check deadline has passed
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            deadline = self._deadlines.get(self._key(sub))
+        return deadline is None or deadline <= now
+
+    def update(self, sub, now=None):
+        ''' call after checking a submission's status: compute and store its next-check deadline
+        '''
+        now = time.time() if now is None else now
+        key = self._key(sub)
+        with self._lock:
+            state = self._state.setdefault(key, {'first_seen': now, 'last_status': None, 'status_since': now,
+                                                 'interval': self.min_interval})
+            elapsed = now - state['first_seen']
+            if sub.status != state['last_status']:
+                state['status_since'] = now
+            in_status = now - state['status_since']
+
+            if elapsed < self.startup_window or (sub.status in STARTUP_STATES and in_status < self.startup_window):
+                interval = self.min_interval
+            elif sub.status != state['last_status']:
+                interval = self.min_interval  # something changed - start backing off again
+            else:
+                interval = min(state['interval'] * self.backoff, self.max_interval)
+            state['interval'] = interval
+            state['last_status'] = sub.status
+
+            # tighten polling around the workflow's historical completion time
+            expected = self.history.get(history_key(sub))
+            if expected is not None:
+                remaining = expected - elapsed
+                window = max(4 * self.min_interval, 0.1 * expected)
+                if remaining >= self.min_interval:
+                    interval = min(interval, remaining)
+                elif remaining > -window:
+                    interval = self.min_interval
+                # otherwise it's overdue, so go back to backing off
+
+            deadline = now + interval
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+            self._prune()
+
+    def complete(self, sub, now=None):
+        ''' call once a submission reaches a terminal state: stop tracking it and record its runtime
+        '''
+        now = time.time() if now is None else now
+        key = self._key(sub)
+        with self._lock:
+            self._deadlines.pop(key, None)
+            self._completed.add(key)
+            self._prune()
+            state = self._state.pop(key, None)
+            if state is not None and sub.status == 'Done':
+                self.history[history_key(sub)] = now - state['first_seen']
+
+    def seconds_until_due(self, subs=None, now=None):
+        ''' seconds until the next check is due, for the given submissions or (if None) for all of them.
+        returns 0 if any submission has not been scheduled yet, or None if nothing is being tracked.
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            if subs is not None:
+                deadlines = [self._deadlines.get(self._key(sub)) for sub in subs
+                             if self._key(sub) not in self._completed]
+                if any(d is None for d in deadlines):
+                    return 0
+                return max(min(deadlines) - now, 0) if deadlines else None
+
+            self._prune()
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - now, 0)
+
+
+def load_poll_history(path):
+    ''' load historical workflow runtimes (in seconds) from a json file, if it exists
+    '''
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_poll_history(path, history):
+    ''' save historical workflow runtimes (in seconds) to a json file
+    '''
+    if path is None:
+        return
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
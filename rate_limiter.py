@@ -0,0 +1,128 @@
+import threading
+import time
+
+
+# requests per second allowed for each class of FISS endpoint (bursts of up to 2x are allowed)
+DEFAULT_RATES = {'clone': 1,
+                 'submit': 2,
+                 'status': 10,
+                 'metadata': 5,
+                 'acl': 2,
+                 'other': 5}
+
+# status codes meaning the server is overloaded, so we should back off
+THROTTLE_CODES = [429, 500, 502, 503, 504]
+
+
+def endpoint_class(fapifunc):
+    ''' classify a FISS api function by the kind of load it puts on Terra
+    '''
+    name = getattr(fapifunc, '__name__', '')
+    if 'clone' in name:
+        return 'clone'
+    if name in ['create_submission', 'abort_submission']:
+        return 'submit'
+    if name in ['get_submission', 'list_submissions']:
+        return 'status'
+    if 'metadata' in name:
+        return 'metadata'
+    if 'acl' in name:
+        return 'acl'
+    return 'other'
+
+
+class TokenBucket:
+    ''' thread-safe token bucket: acquire() blocks until a token is available
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(2 * rate, 1)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ConcurrencyGovernor:
+    ''' caps the number of requests in flight, adapting the cap with AIMD: it grows by about one
+    for every `limit` successful requests, and halves (at most once per decrease_interval seconds)
+    when the server signals overload.
+    '''
+
+    def __init__(self, max_limit=10, min_limit=1, decrease_interval=5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_interval = decrease_interval
+        self.limit = float(max_limit)
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, overloaded):
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease > self.decrease_interval:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class FissThrottle:
+    ''' process-wide throttle for FISS traffic: one token bucket per endpoint class,
+    plus an adaptive cap on the total number of requests in flight
+    '''
+
+    def __init__(self, rates=None, rate_scale=1, max_concurrency=10):
+        rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.buckets = {name: TokenBucket(rate * rate_scale) for name, rate in rates.items()}
+        self.governor = ConcurrencyGovernor(max_limit=max_concurrency)
+
+    def call(self, fapifunc, *args, **kwargs):
+        ''' call fapifunc(*args, **kwargs) once its endpoint class has a token and there's room in flight
+        '''
+        self.buckets[endpoint_class(fapifunc)].acquire()
+        self.governor.acquire()
+        overloaded = True  # a raised exception (e.g. connection error) counts as overload
+        try:
+            response = fapifunc(*args, **kwargs)
+            overloaded = response.status_code in THROTTLE_CODES
+            return response
+        finally:
+            self.governor.release(overloaded)
+
+
+_throttle = FissThrottle()
+
+
+def get_throttle():
+    return _throttle
+
+
+def configure_throttle(rates=None, rate_scale=1, max_concurrency=10):
+    ''' replace the process-wide throttle, e.g. with settings from the command line
+    '''
+    global _throttle
+    _throttle = FissThrottle(rates=rates, rate_scale=rate_scale, max_concurrency=max_concurrency)
+    return _throttle
@@ -0,0 +1,232 @@
+from itertools import islice
+from string import Formatter
+
+
+class Template:
+    ''' a str.format-style template, parsed once (when it's defined) instead of on every report.
+    a field's value can be a string (or anything format() accepts, with the field's format spec), or a list or
+    generator of strings, e.g. table rows, which are put in place one after another without being joined first.
+    '''
+
+    def __init__(self, text):
+        self.text = text
+        self._parts = []    # (literal text, field name or None, format spec)
+        for literal, field_name, format_spec, conversion in Formatter().parse(text):
+            if conversion is not None:
+                raise ValueError(f'conversions (!{conversion}) are not supported in report templates')
+            self._parts.append((literal, field_name, format_spec))
+
+    def chunks(self, **values):
+        ''' the rendered text, piece by piece (values that aren't fields of the template are ignored), e.g. to
+        stream a whole report without building it as one string
+        '''
+        for literal, field_name, format_spec in self._parts:
+            if literal:
+                yield literal
+            if field_name is None:
+                continue
+            value = values[field_name]
+            if type(value) is str and not format_spec:
+                yield value
+            elif isinstance(value, (list, tuple)) or hasattr(value, '__next__'):
+                yield from value
+            else:
+                yield format(value, format_spec)
+
+    def render(self, **values):
+        ''' the rendered text, as one string. quicker than chunks() for small templates, e.g. table rows '''
+        pieces = []
+        for literal, field_name, format_spec in self._parts:
+            pieces.append(literal)
+            if field_name is None:
+                continue
+            value = values[field_name]
+            if type(value) is str and not format_spec:
+                pieces.append(value)
+            elif isinstance(value, (list, tuple)) or hasattr(value, '__next__'):
+                pieces.extend(value)
+            else:
+                pieces.append(format(value, format_spec))
+        return ''.join(pieces)
+
+    def write_to(self, sink, **values):
+        ''' write the rendered text to sink, anything with a write(str) method (an open file, io.StringIO,
+        or a gzip.open(..., 'wt') stream), without holding the whole report in memory
+        '''
+        write_chunks(self.chunks(**values), sink)
+
+
+def write_chunks(chunks, sink, chunks_per_write=256):
+    ''' write an iterable of strings to sink, joined chunks_per_write at a time (so that the sink sees a few large
+    writes, and only that much of the report is held in memory)
+    '''
+    chunks = iter(chunks)
+    while True:
+        batch = list(islice(chunks, chunks_per_write))
+        if not batch:
+            return
+        sink.write(''.join(batch))
+
+
+TABLE_STYLE = '''
+<style>
+table {
+font-family: Montserrat, sans-serif;
+border-collapse: collapse;
+width: 100%;
+}
+td, th {
+border: 1px solid #dddddd;
+text-align: left;
+padding: 8px;
+}
+</style>
+'''
+
+
+# Submission.get_HTML: the details of one tested workflow
+SUBMISSION_DETAILS = Template('''
+Workflow Id: {wfid}
+<br>Submission Id: {subid}
+<br>Entity Name: {entity}
+<br>Status: <font color={status_color}>{status}</font>
+{error_message}
+{runtime}
+<br><a href={link} target='_blank'>Click here for more details</a>
+<br><br>
+''')
+
+
+# Wspace.generate_workspace_report
+WORKFLOW_SECTION = Template('<h3>{wf_name}</h3><blockquote>{html}</blockquote>')
+
+WORKSPACE_REPORT = Template('''<html>
+<head><link href='https://fonts.googleapis.com/css?family=Lato' rel='stylesheet'>
+</head>
+<body style='font-family:Montserrat,sans-serif; font-size:18px; padding:30; background-color:#FAFBFD'>
+<p>
+<center><div style='background-color:#82AA52; color:#FAFBFD; height:100px'>
+<h1>
+<img src='https://app.terra.bio/static/media/logo-wShadow.c7059479.svg' alt='Terra rocks!' style='vertical-align: middle;' height='100'>
+<span style='vertical-align: middle;'>
+Featured Workspace Report</span></h1>
+
+<h1><font color={status_color}>{status_text}</font></h1></center> <br><br>
+<br><br><h2><b> Cloned Workspace: </b>
+<a href={workspace_link} target='_blank'>{workspace}</a></h2>
+<big><b> Featured Workspace: </b>{workspace_orig}</big>
+<br>
+<big><b> Billing Project: </b>{project_orig}</big>
+<br><br>{time_text}
+<br>{call_cache_text}
+<br><br><big><b> Workflows: </b>{wf_list}</big>
+<br><big><b> Notebooks: </b>{nb_list}</big>
+<br>
+<h2>Workflows:</h2>
+<blockquote>{wf_text}</blockquote>
+<br>
+<h2>Notebooks:</h2>
+<blockquote>{nb_text}</blockquote>
+</p>
+
+</p></body>
+</html>''')
+
+
+# generate_master_report
+MASTER_TABLE_HEADER = '''
+<table>
+<col width="10%">
+<col width="30%">
+<col width="5%">
+<col width="5%">
+<tr>
+    <th>Project</th>
+    <th>Featured Workspace</th>
+    <th># WFs tested</th>
+    <th>Status</th>
+    <th>Report link</th>
+    <th>Failed Workflows</th>
+    <th>Runtime</th>
+</tr>
+'''
+
+MASTER_ROW = Template('''
+<tr>
+    <td>{project}</td>
+    <td><big>{workspace}</big></td>
+    <td>{n_wf}</td>
+    <td><font color={status_color}>{status}</font></td>
+    <td><a href={report_path} target='_blank'>[open report for details]</a></td>
+    <td>{failures_list}</td>
+    <td>{runtime}</td>
+</tr>
+''')
+
+MASTER_REPORT = Template('''<html>
+<head>
+{table_style_text}
+</head>
+<body style='font-family:Montserrat,sans-serif; font-size:18px; padding:30; background-color:#FAFBFD'>
+<p>
+<center><div style='background-color:#82AA52; color:#FAFBFD; height:100px'>
+<h1>
+<img src='https://terra.bio/wp-content/uploads/2023/12/Terra-White-logo.png' alt='Terra rocks!' style='vertical-align: middle;' height='100'>
+<span style='vertical-align: middle;'>
+Featured Workspace Report: Master list</span></h1></center></div>
+
+<br><center><big>{fail_count_text}</big><br>{call_cache_text}</center>
+<br><br>
+{workspaces_text}<br>
+</p>
+
+<br><br>Test started: {clone_time}
+<br>Test finished: {done_time}
+</p></body>
+</html>''')
+
+
+# generate_cost_report
+COST_TABLE_HEADER = '''
+<table>
+<col width="10%">
+<col width="30%">
+<tr>
+    <th>Orig. Project</th>
+    <th>Featured Workspace</th>
+    <th>Report link</th>
+    <th># Workflows</th>
+    <th>Total cost</th>
+    <th>Breakdown</th>
+</tr>
+'''
+
+COST_ROW = Template('''
+<tr>
+    <td>{project}</td>
+    <td><big>{workspace}</big></td>
+    <td><a href={report_path} target='_blank'>[open report for details]</a></td>
+    <td>{num_wf}</td>
+    <td>{ws_cost}</td>
+    <td>{breakdown_text}</td>
+</tr>
+''')
+
+COST_REPORT = Template('''<html>
+<head>
+{table_style_text}
+</head>
+<body style='font-family:Montserrat,sans-serif; font-size:18px; padding:30; background-color:#FAFBFD'>
+<p>
+<center><div style='background-color:#82AA52; color:#FAFBFD; height:100px'>
+<h1>
+<img src='https://app.terra.bio/static/media/logo-wShadow.c7059479.svg' alt='Terra rocks!' style='vertical-align: middle;' height='100'>
+<span style='vertical-align: middle;'>
+Featured Workspace Test Cost Report</span></h1></center></div>
+
+<br><center><big>{total_cost_text}</big></center>
+<br><br>
+{workspaces_text}<br>
+</p>
+</p></body>
+</html>''')
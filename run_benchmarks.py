@@ -0,0 +1,491 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# metrics compared between commits; a higher value is worse for all of them
+COMPARED_METRICS = ['wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'api_calls_per_workspace']
+
+# differences smaller than these are noise, whatever the relative change
+NOISE_FLOOR = {'wall_seconds': 0.5, 'cpu_seconds': 0.2, 'peak_rss_mb': 5, 'api_calls_per_workspace': 0.5}
+
+CLONE_PROJECT = 'sim-clones'
+GCS_PATH = 'gs://sim-reports/fw_reports/'
+
+
+def git_commit():
+    ''' short hash of HEAD, with a + if the tree has uncommitted changes '''
+    def git(*args):
+        return subprocess.run(['git'] + list(args), cwd=HERE, capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('+' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def sim_requests(url):
+    with urllib.request.urlopen(url + '/sim/stats') as response:
+        return sum(json.load(response)['requests'].values())
+
+
+@contextlib.contextmanager
+def measure(result, url, n_workspaces):
+    ''' record wall time, cpu time and simulator requests per workspace of the enclosed block into result '''
+    requests_before = sim_requests(url)
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+    yield
+    result['wall_seconds'] = round(time.perf_counter() - start, 3)
+    result['cpu_seconds'] = round(cpu_seconds() - cpu_before, 3)
+    result['api_calls_per_workspace'] = round((sim_requests(url) - requests_before) / max(n_workspaces, 1), 2)
+
+
+def start_simulator_process(case):
+    ''' run terra_simulator.py in its own process (so its cpu and memory aren't counted) and wait for it '''
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'terra_simulator.py'),
+                             '--port', str(port),
+                             '--n_workspaces', str(case['workspaces']),
+                             '--workflows_per_workspace', str(case['workflows']),
+                             '--runtime_median', str(case['runtime']),
+                             '--queue_seconds', str(case['runtime'] / 4),
+                             '--latency', str(case['latency']),
+                             '--seed', '0',
+                             '--metadata_shards', str(case.get('metadata_shards', 10))],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            sim_requests(url)
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('terra_simulator did not start')
+
+
+def bench_test_all(case, url, workdir):
+    ''' the whole featured_workspaces_test run, end to end '''
+    from featured_workspaces_test import main
+
+    result = {}
+    with measure(result, url, case['workspaces']):
+        main(['-m', '-b', '0', '--skip_cost', '--skip_cleanup',
+              '--transport', 'sandbox', '--replay_storage_dir', os.path.join(workdir, 'storage'),
+              '--clone_project', CLONE_PROJECT, '--share_with', 'sim-support@example.com',
+              '--gcs_path', GCS_PATH,
+              '--min_poll_interval', '1', '--max_poll_interval', str(max(math.ceil(case['runtime']), 2)),
+              '--fiss_rate_scale', '1000', '--max_concurrency', str(case['concurrency']),
+              '--state_db', os.path.join(workdir, 'runs.sqlite'),
+              '--metrics_dir', os.path.join(workdir, 'metrics'),
+              '--shard_history', os.path.join(workdir, 'shards.json')])
+    return result
+
+
+def bench_phases(case, url, workdir):
+    ''' the steps of a test run, timed separately: cloning and polling every workspace with
+    Wspace.check_submissions, then the workspace reports, generate_master_report and get_cost_of_test
+    '''
+    from featured_workspaces_test import generate_master_report
+    from gcs_fns import get_upload_queue
+    from get_cost_for_all_tests import get_cost_of_test
+    from get_fws import format_fws
+    from workspace_test_report import clone_workspace
+
+    clone_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    report_name = 'master_report_' + clone_time + '.html'
+    n = case['workspaces']
+    phases = {}
+
+    fws = format_fws(verbose=False)
+    cloned = {}
+    with measure(phases.setdefault('clone', {}), url, n):
+        for key, ws in fws.items():
+            cloned[key] = clone_workspace(ws.project, ws.workspace, CLONE_PROJECT, clone_time=clone_time)
+            cloned[key].create_submissions()
+            cloned[key].start_timer()
+
+    ticks = []
+    with measure(phases.setdefault('check_submissions', {}), url, n):
+        active = dict(cloned)
+        while active:
+            tick_start = time.perf_counter()
+            for key, clone_ws in list(active.items()):
+                clone_ws.check_submissions(verbose=False)
+                if not clone_ws.active_submissions:
+                    clone_ws.stop_timer()
+                    del active[key]
+            ticks.append(time.perf_counter() - tick_start)
+            if active:
+                time.sleep(1)
+    phases['check_submissions']['ticks'] = len(ticks)
+    phases['check_submissions']['mean_tick_seconds'] = round(sum(ticks) / len(ticks), 4)
+
+    with measure(phases.setdefault('workspace_reports', {}), url, n):
+        for clone_ws in cloned.values():
+            clone_ws.generate_workspace_report(GCS_PATH + clone_time + '/')
+        get_upload_queue().flush()
+
+    with measure(phases.setdefault('master_report', {}), url, n):
+        generate_master_report(GCS_PATH, clone_time, report_name, ws_dict=cloned)
+
+    with measure(phases.setdefault('cost', {}), url, n):
+        get_cost_of_test(GCS_PATH, report_name, CLONE_PROJECT, verbose=False)
+
+    return {'wall_seconds': round(sum(phase['wall_seconds'] for phase in phases.values()), 3),
+            'cpu_seconds': round(sum(phase['cpu_seconds'] for phase in phases.values()), 3),
+            'api_calls_per_workspace': round(sum(phase['api_calls_per_workspace'] for phase in phases.values()), 2),
+            'phases': phases}
+
+
+def bench_rebuild_report(case, url, workdir):
+    ''' featured_workspaces_test -r: rebuilding the master report of a finished run from its workspace reports'
+    json sidecars (the run itself, cloning and reporting every workspace, isn't timed)
+    '''
+    from featured_workspaces_test import main
+    from gcs_fns import get_upload_queue, gsutil_cat
+    from get_fws import format_fws
+    from workspace_test_report import clone_workspace
+    from ws_class import load_sidecar, sidecar_name
+
+    clone_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    cloned = {}
+    for key, ws in format_fws(verbose=False).items():
+        cloned[key] = clone_workspace(ws.project, ws.workspace, CLONE_PROJECT, clone_time=clone_time)
+        cloned[key].create_submissions()
+        cloned[key].start_timer()
+    while any(clone_ws.active_submissions for clone_ws in cloned.values()):
+        time.sleep(1)
+        for clone_ws in cloned.values():
+            clone_ws.check_submissions(verbose=False)
+    for clone_ws in cloned.values():
+        clone_ws.stop_timer()
+        clone_ws.generate_workspace_report(GCS_PATH + clone_time + '/')
+    get_upload_queue().flush()
+
+    result = {}
+    with measure(result, url, case['workspaces']):
+        main(['-r', clone_time + '/', '--skip_cost', '--skip_cleanup',
+              '--transport', 'sandbox', '--replay_storage_dir', os.path.join(workdir, 'storage'),
+              '--clone_project', CLONE_PROJECT, '--gcs_path', GCS_PATH,
+              '--metrics_dir', os.path.join(workdir, 'metrics')])
+
+    # the rebuilt master report must list every workspace of the run
+    report_name = 'master_report_' + clone_time + '.html'
+    rebuilt = load_sidecar(gsutil_cat(GCS_PATH + sidecar_name(report_name)))['workspaces']
+    if len(rebuilt) != len(cloned):
+        raise RuntimeError(f'rebuilt master report lists {len(rebuilt)} of {len(cloned)} workspaces')
+    return result
+
+
+TARGETS = {'test_all': bench_test_all,
+           'phases': bench_phases,
+           'rebuild_report': bench_rebuild_report}
+
+
+def run_case(case):
+    ''' run one benchmark case in this process, against a fresh simulator; returns its result dict '''
+    from fiss_fns import use_firecloud_api
+    from rate_limiter import configure_throttle
+    from transport import configure_transport
+
+    sim_proc, url = start_simulator_process(case)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.environ['FEATURED_WORKSPACES_URL'] = url + '/featured-workspaces.json'
+            use_firecloud_api(url + '/api/')
+            configure_transport('sandbox', storage_dir=os.path.join(workdir, 'storage'))
+            configure_throttle(rate_scale=1000, max_concurrency=case['concurrency'])
+            os.chdir(workdir)
+            # the code under test prints a lot; keep the benchmark output readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = TARGETS[case['target']](case, url, workdir)
+    finally:
+        sim_proc.kill()
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return dict(case, **result)
+
+
+def bench_metadata(args):
+    ''' compare the old and new ways Submission.get_final_status fetches workflow metadata (everything but
+    calls and inputs, parsed whole; vs. only the final status keys, parsed as they stream in), for workflows with
+    each number of scattered calls: bytes transferred, latency and the peak python memory of fetch + parse
+    '''
+    import tracemalloc
+    from firecloud import api as fapi
+    from fiss_api_addons import get_workflow_final_metadata, get_workflow_metadata_withExclude, ijson
+    from fiss_fns import use_firecloud_api
+
+    def fetch_old(*ids):
+        response = get_workflow_metadata_withExclude(*ids, 'calls', 'inputs')
+        return len(response.content), response.json()
+
+    def fetch_new(*ids):
+        response = get_workflow_final_metadata(*ids)
+        return int(response.headers['Content-Length']), response.json()
+
+    print(f"new path parses with {'ijson' if ijson else 'json (ijson is not installed)'}")
+    print(f'{"shards":>8} {"path":8} {"bytes":>12} {"mean ms":>9} {"peak MB":>9}')
+    for shards in args.shards:
+        case = {'workspaces': 1, 'workflows': 1, 'runtime': 0.4, 'latency': 0, 'metadata_shards': shards}
+        sim_proc, url = start_simulator_process(case)
+        try:
+            use_firecloud_api(url + '/api/')
+            ws = ('sim-featured', 'Sim-Workspace-0000')
+            sub_id = fapi.create_submission(*ws, 'sim-featured', 'sim_workflow_0', 'sample_test', 'sample').json()['submissionId']
+            while True:
+                sub = fapi.get_submission(*ws, sub_id).json()
+                if sub['status'] == 'Done':
+                    break
+                time.sleep(0.2)
+            ids = ws + (sub_id, sub['workflows'][0]['workflowId'])
+
+            for path, fetch in [('old', fetch_old), ('new', fetch_new)]:
+                latencies = []
+                peak = 0
+                for _ in range(args.repeat):
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    n_bytes, metadata = fetch(*ids)
+                    latencies.append(time.perf_counter() - start)
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                print(f'{shards:8d} {path:8} {n_bytes:12d} {sum(latencies) / len(latencies) * 1000:9.1f} '
+                      f'{peak / 2**20:9.2f}')
+        finally:
+            sim_proc.kill()
+
+
+def synthetic_tested_workspaces(n, workflows=3):
+    ''' dict of n tested Wspaces (every fourth with a failed workflow), for benchmarking the reports '''
+    from submission_class import Submission
+    from ws_class import Wspace
+
+    fws_dict = {}
+    for i in range(n):
+        ws = Wspace(workspace=f'Sim-Workspace-{i:05d}_clone', project=CLONE_PROJECT,
+                    workspace_orig=f'Sim-Workspace-{i:05d}', project_orig='sim-featured',
+                    status='FAILURE!' if i % 4 == 0 else 'SUCCESS!', test_time='0:12:34',
+                    report_path=f'https://storage.googleapis.com/sim-reports/fw_reports/Sim-Workspace-{i:05d}.html')
+        for j in range(workflows):
+            final_status = 'Failed' if i % 4 == 0 and j == 0 else 'Succeeded'
+            ws.tested_workflows.append(Submission(workspace=ws.workspace, project=ws.project, wf_project='sim',
+                                                  wf_name=f'sim_workflow_{j}', entity_name='sample_test',
+                                                  entity_type='sample', final_status=final_status))
+        ws.submissions_cost = {sub.wf_name: '$1.23' for sub in ws.tested_workflows}
+        ws.total_cost = 1.23 * workflows
+        fws_dict[ws.project_orig + '/' + ws.workspace_orig] = ws
+    return fws_dict
+
+
+def bench_reports(args):
+    ''' time the master and cost reports for each number of workspace rows: rendered to one string, and
+    streamed through gzip as they're uploaded. for comparison, the master report is also built the old way,
+    by += and str.format of each row onto the table (with the same templates), then formatting the page
+    '''
+    import tracemalloc
+    from itertools import chain
+    from featured_workspaces_test import render_master_report
+    from gcs_fns import gzip_report
+    from get_cost_for_all_tests import render_cost_report
+    from report_templates import MASTER_REPORT, MASTER_ROW, MASTER_TABLE_HEADER, TABLE_STYLE
+
+    def master_concat(fws_dict):
+        text = MASTER_TABLE_HEADER
+        for ws in fws_dict.values():
+            text += MASTER_ROW.text.format(project=ws.project_orig, workspace=ws.workspace_orig, n_wf=len(ws.tested_workflows),
+                                           status_color='red', status=ws.status, report_path=ws.report_path,
+                                           failures_list=ws.generate_failed_list(), runtime=ws.test_time)
+        text += '</table>'
+        return MASTER_REPORT.text.format(table_style_text=TABLE_STYLE, fail_count_text='', call_cache_text='',
+                                         workspaces_text=text, clone_time='', done_time='')
+
+    def master_join(fws_dict):
+        rows = (MASTER_ROW.render(project=ws.project_orig, workspace=ws.workspace_orig, n_wf=len(ws.tested_workflows),
+                                  status_color='red', status=ws.status, report_path=ws.report_path,
+                                  failures_list=ws.generate_failed_list(), runtime=ws.test_time)
+                for ws in fws_dict.values())
+        return MASTER_REPORT.render(table_style_text=TABLE_STYLE, fail_count_text='', call_cache_text='',
+                                    workspaces_text=chain([MASTER_TABLE_HEADER], rows, ['</table>']),
+                                    clone_time='', done_time='')
+
+    paths = [('master rows, +=', master_concat),
+             ('master rows, join', master_join),
+             ('master report', lambda fws_dict: ''.join(render_master_report(GCS_PATH, 'now', fws_dict))),
+             ('master gzip', lambda fws_dict: gzip_report(render_master_report(GCS_PATH, 'now', fws_dict))[1]),
+             ('cost report', lambda fws_dict: ''.join(render_cost_report(GCS_PATH, 'master_report_now.html', 0, fws_dict))),
+             ('cost gzip', lambda fws_dict: gzip_report(render_cost_report(GCS_PATH, 'master_report_now.html', 0, fws_dict))[1])]
+
+    print(f'{"rows":>8} {"path":18} {"bytes":>12} {"mean ms":>9} {"peak MB":>9}')
+    for n in args.rows:
+        fws_dict = synthetic_tested_workspaces(n)
+        for name, render in paths:
+            latencies = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                report = render(fws_dict)
+                latencies.append(time.perf_counter() - start)
+            # memory is traced in a separate render, since tracing slows it down
+            tracemalloc.start()
+            render(fws_dict)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{n:8d} {name:18} {len(report):12d} {sum(latencies) / len(latencies) * 1000:9.1f} '
+                  f'{peak / 2**20:9.2f}')
+
+
+def case_key(case):
+    return f"{case['target']} ws={case['workspaces']} wf={case['workflows']} latency={case['latency']}"
+
+
+def run(args):
+    ''' run every combination of the requested targets and sizes, each in a fresh python process
+    (so that peak memory is per case), and append the results to the history file
+    '''
+    results = []
+    for target, n_ws, n_wf, latency in itertools.product(args.targets, args.workspaces, args.workflows, args.latency):
+        case = {'target': target, 'workspaces': n_ws, 'workflows': n_wf, 'latency': latency,
+                'runtime': args.runtime, 'concurrency': args.max_concurrency}
+        print(f'running {case_key(case)} ...', flush=True)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', json.dumps(case)],
+                              cwd=HERE, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stderr[-3000:])
+            print('    FAILED')
+            continue
+        result = json.loads(proc.stdout.strip().split('\n')[-1])
+        results.append(result)
+        print(f"    {result['wall_seconds']:.1f}s wall, {result['cpu_seconds']:.1f}s cpu, "
+              f"{result['peak_rss_mb']:.0f} MB peak rss, {result['api_calls_per_workspace']:.1f} api calls/workspace")
+
+    history = load_history(args.history)
+    history.append({'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+                    'results': results})
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=1)
+    print(f'results for {history[-1]["commit"]} saved to {args.history}')
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_entry(history, ref):
+    ''' the latest history entry whose commit starts with ref '''
+    for entry in reversed(history):
+        if entry['commit'].startswith(ref):
+            return entry
+    raise ValueError(f'no benchmark results for {ref}')
+
+
+def compare(args):
+    ''' compare two benchmark runs (default: the last two), flagging metrics that got worse by more than
+    threshold (and by more than the noise floor). exits with status 1 if anything regressed.
+    '''
+    history = load_history(args.history)
+    if len(history) < 2 and (args.base is None or args.head is None):
+        print('need at least two benchmark runs to compare')
+        return 0
+    base = find_entry(history, args.base) if args.base else history[-2]
+    head = find_entry(history, args.head) if args.head else history[-1]
+    base_results = {case_key(result): result for result in base['results']}
+
+    print(f"comparing {base['commit']} ({base['date']}) -> {head['commit']} ({head['date']})")
+    regressions = 0
+    for result in head['results']:
+        key = case_key(result)
+        if key not in base_results:
+            continue
+        print(key)
+        for metric in COMPARED_METRICS:
+            old, new = base_results[key].get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0
+            regressed = new - old > NOISE_FLOOR[metric] and change > args.threshold
+            regressions += regressed
+            print(f"    {metric:25} {old:10.2f} -> {new:10.2f} ({change:+.0%})" + ('  REGRESSION' if regressed else ''))
+
+    print(f'{regressions} regression(s)')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the test orchestration against a local terra_simulator')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run benchmarks and add the results to the history file')
+    run_parser.add_argument('--targets', nargs='+', default=list(TARGETS), choices=list(TARGETS),
+                            help='what to benchmark: the whole test_all run, and/or its phases timed separately')
+    run_parser.add_argument('--workspaces', type=int, nargs='+', default=[10, 100],
+                            help='numbers of synthetic featured workspaces (default 10 100)')
+    run_parser.add_argument('--workflows', type=int, nargs='+', default=[2],
+                            help='numbers of workflows per workspace (default 2)')
+    run_parser.add_argument('--latency', type=float, nargs='+', default=[0],
+                            help='seconds of latency added to every simulated api call (default 0)')
+    run_parser.add_argument('--runtime', type=float, default=3,
+                            help='median simulated workflow runtime in seconds (default 3)')
+    run_parser.add_argument('--max_concurrency', type=int, default=10,
+                            help='max_concurrency passed to the code under test (default 10)')
+    run_parser.add_argument('--history', type=str, default='benchmark_history.json',
+                            help='json file the results are appended to')
+
+    compare_parser = subparsers.add_parser('compare', help='flag regressions between two benchmarked commits')
+    compare_parser.add_argument('--base', type=str, default=None, help='commit to compare from (default: second to last run)')
+    compare_parser.add_argument('--head', type=str, default=None, help='commit to compare to (default: last run)')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative increase counted as a regression (default 0.1)')
+    compare_parser.add_argument('--history', type=str, default='benchmark_history.json',
+                                help='json file of benchmark results')
+
+    metadata_parser = subparsers.add_parser('metadata', help='compare workflow metadata fetches for final statuses')
+    metadata_parser.add_argument('--shards', type=int, nargs='+', default=[10, 1000, 10000],
+                                 help='numbers of scattered calls in the simulated workflow (default 10 1000 10000)')
+    metadata_parser.add_argument('--repeat', type=int, default=5, help='fetches per path and size (default 5)')
+
+    reports_parser = subparsers.add_parser('reports', help='time rendering the master and cost reports')
+    reports_parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                                help='numbers of workspaces listed in the reports (default 1000 10000)')
+    reports_parser.add_argument('--repeat', type=int, default=3, help='renders per path and size (default 3)')
+
+    case_parser = subparsers.add_parser('case', help=argparse.SUPPRESS)
+    case_parser.add_argument('case', type=str)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    elif args.command == 'metadata':
+        bench_metadata(args)
+    elif args.command == 'reports':
+        bench_reports(args)
+    else:
+        print(json.dumps(run_case(json.loads(args.case))))
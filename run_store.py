@@ -0,0 +1,105 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from ws_class import Wspace
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    clone_time TEXT,
+    report_name TEXT,
+    gcs_path TEXT,
+    ws_keys TEXT,           -- json list of the featured workspace keys tested in this run
+    created TEXT
+);
+CREATE TABLE IF NOT EXISTS workspaces (
+    run_id TEXT,
+    key TEXT,               -- featured workspace key (project/workspace)
+    state TEXT,             -- json of Wspace.to_dict()
+    updated TEXT,
+    PRIMARY KEY (run_id, key)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT,
+    key TEXT,
+    wf_name TEXT,
+    sub_id TEXT,
+    wf_id TEXT,
+    status TEXT,
+    ts TEXT
+);
+CREATE INDEX IF NOT EXISTS events_run ON events (run_id, key);
+'''
+
+
+class RunStore:
+    ''' durable record of test runs in a local sqlite database: the workspaces cloned in each run,
+    the full state of each cloned Wspace (including sub_ids and wf_ids), and a journal of every
+    submission status transition. used to resume a run that died without resubmitting anything.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._last_state = {}    # (run_id, key) -> last saved state json
+        self._last_subs = {}     # (run_id, key, wf_name) -> last saved (status, sub_id, wf_id)
+
+    def start_run(self, run_id, clone_time, report_name, gcs_path, ws_keys):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                               (run_id, clone_time, report_name, gcs_path, json.dumps(list(ws_keys)),
+                                datetime.now().isoformat()))
+
+    def get_run(self, run_id):
+        ''' returns a dict of the run's settings, or None if the run is not in the store
+        '''
+        with self._lock:
+            row = self._conn.execute('SELECT clone_time, report_name, gcs_path, ws_keys FROM runs WHERE run_id = ?',
+                                     (run_id,)).fetchone()
+        if row is None:
+            return None
+        return {'clone_time': row[0], 'report_name': row[1], 'gcs_path': row[2], 'ws_keys': json.loads(row[3])}
+
+    def save_workspace(self, run_id, key, ws):
+        ''' save the current state of a cloned workspace, journaling any submission status changes.
+        does nothing if the state hasn't changed since the last save.
+        '''
+        state = json.dumps(ws.to_dict())
+        now = datetime.now().isoformat()
+        with self._lock:
+            if self._last_state.get((run_id, key)) == state:
+                return
+            subs = ws.active_submissions + ws.tested_workflows
+            events = []
+            for sub in subs:
+                sub_key = (run_id, key, sub.wf_name)
+                sub_state = (sub.status, sub.sub_id, sub.wf_id)
+                if self._last_subs.get(sub_key) != sub_state:
+                    self._last_subs[sub_key] = sub_state
+                    events.append((run_id, key, sub.wf_name, sub.sub_id, sub.wf_id, sub.status, now))
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO workspaces VALUES (?, ?, ?, ?)', (run_id, key, state, now))
+                self._conn.executemany('INSERT INTO events (run_id, key, wf_name, sub_id, wf_id, status, ts) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?)', events)
+            self._last_state[(run_id, key)] = state
+
+    def load_workspaces(self, run_id):
+        ''' rebuild the Wspace objects saved for a run, as a dict keyed by featured workspace key
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT key, state FROM workspaces WHERE run_id = ?', (run_id,)).fetchall()
+        ws_dict = {}
+        for key, state in rows:
+            ws = Wspace.from_dict(json.loads(state))
+            ws_dict[key] = ws
+            self._last_state[(run_id, key)] = state
+            for sub in ws.active_submissions + ws.tested_workflows:
+                self._last_subs[(run_id, key, sub.wf_name)] = (sub.status, sub.sub_id, sub.wf_id)
+        return ws_dict
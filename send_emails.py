@@ -1,10 +1,13 @@
 # using SendGrid's Python Library
 # https://github.com/sendgrid/sendgrid-python
 import os
+import json
 import argparse
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
+from transport import get_transport
+
 def send_email(from_email, to_emails, subject, content):
     """Note: `to_emails` must be a LIST if there are multiple emails."""
     message = Mail(
@@ -15,9 +18,9 @@ def send_email(from_email, to_emails, subject, content):
     
     try:
         sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-        response = sg.send(message)
-
-        return response.status_code
+        # in replay mode nothing is sent; the recorded status code is returned instead
+        return get_transport().call('email', json.dumps([to_emails, subject], default=str),
+                                    lambda: sg.send(message).status_code)
 
     except Exception as e:
         print(e)
@@ -0,0 +1,68 @@
+import heapq
+import json
+import os
+from statistics import median
+
+
+def load_shard_history(path):
+    ''' load historical per-workspace test stats from a json file, if it exists.
+    the file maps workspace key (project/workspace) to a dict like {"runtime": seconds, "cost": dollars}
+    '''
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_shard_history(path, history):
+    ''' write the history file (workspace key -> stats) '''
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+
+def update_shard_history(path, ws_dict):
+    ''' merge the runtimes of the workspaces tested in this run into the history file
+    '''
+    history = load_shard_history(path)
+    for key, ws in ws_dict.items():
+        if ws.runtime_seconds is not None:
+            history.setdefault(key, {})['runtime'] = round(ws.runtime_seconds)
+    save_shard_history(path, history)
+
+
+def merge_shard_histories(path, batch_paths):
+    ''' merge the history files of parallel batch jobs back into the history file at path.
+    each batch started from a copy of path and updated only its own workspaces, so any entry that differs from
+    path's copy comes from the batch that tested that workspace.
+    '''
+    history = load_shard_history(path)
+    merged = dict(history)
+    for batch_path in batch_paths:
+        for key, stats in load_shard_history(batch_path).items():
+            if stats != history.get(key):
+                merged[key] = stats
+    save_shard_history(path, merged)
+
+
+def plan_shards(keys, n_shards, history=None, weight_by='runtime'):
+    ''' split workspace keys into n_shards lists with roughly equal total weight (historical runtime or cost),
+    using longest-processing-time-first bin packing: the heaviest remaining workspace always goes to the
+    currently lightest shard. workspaces with no history get the median weight of the others.
+    the plan depends only on the inputs, so every parallel job computes the same shards.
+    '''
+    history = history or {}
+    weights = {key: history[key][weight_by] for key in keys
+               if key in history and history[key].get(weight_by) is not None}
+    default_weight = median(weights.values()) if weights else 1
+
+    # heaviest first; ties broken by key so the order is reproducible
+    ordered_keys = sorted(keys, key=lambda key: (-weights.get(key, default_weight), key))
+
+    shards = [[] for _ in range(n_shards)]
+    loads = [(0, i) for i in range(n_shards)]  # (total weight, shard index) - ties go to the lowest index
+    for key in ordered_keys:
+        load, i = heapq.heappop(loads)
+        shards[i].append(key)
+        heapq.heappush(loads, (load + weights.get(key, default_weight), i))
+
+    return [sorted(shard) for shard in shards]
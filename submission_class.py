@@ -1,8 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field, asdict, fields
 from datetime import datetime
 from firecloud import api as fapi
 from fiss_fns import call_fiss, format_timedelta
-from fiss_api_addons import get_workflow_metadata_withExclude
+from fiss_api_addons import get_workflow_final_metadata
+from report_templates import SUBMISSION_DETAILS
 
 
 @dataclass
@@ -23,6 +24,18 @@ class Submission:
     message: str = None         # error message
     runtime: str = ''           # runtime for a submission - WIP - defined in get_final_status
     cost: int = None            # cost of submission
+    depends_on: list = field(default_factory=lambda: [])  # names of workflows that must finish before this one is submitted
+
+    def to_dict(self):
+        ''' json-serializable dict of this submission's state
+        '''
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, sub_dict):
+        ''' rebuild a Submission from the output of to_dict
+        '''
+        return cls(**{f.name: sub_dict[f.name] for f in fields(cls) if f.name in sub_dict})
 
     def create_submission(self, verbose=False):
         ''' create a workflow submission using fiss
@@ -77,6 +90,13 @@ class Submission:
         if verbose:
             print('    ' + datetime.today().strftime('%H:%M') + ' ' + self.status + ' - ' + self.wf_name)
 
+    def update_status(self, status, verbose=False):
+        ''' set the status from a listing of all of the workspace's submissions (see Wspace.refresh_submission_statuses)
+        '''
+        self.status = status
+        if verbose:
+            print('    ' + datetime.today().strftime('%H:%M') + ' ' + self.status + ' - ' + self.wf_name)
+
     def abort_submission(self):
         ''' abort submission
         '''
@@ -88,8 +108,8 @@ class Submission:
 
         # 3 cases: 1) has wfID & subID; 2) has subID (submission happened but wf failed); 3) has neither (submission failed)
         if self.wf_id is not None:  # has wf_id and sub_id
-            # get info about workflow submission - but exclude info about calls & inputs (which can make the json too big and cause an error)
-            res = call_fiss(get_workflow_metadata_withExclude, 200, self.project, self.workspace, self.sub_id, self.wf_id, 'calls', 'inputs')
+            # get only the status, start/end times and failure messages (the full metadata json can get big enough to cause an error)
+            res = call_fiss(get_workflow_final_metadata, 200, self.project, self.workspace, self.sub_id, self.wf_id)
             self.final_status = res['status']
 
             start_time = res['start']  # overwrite status from submission tracking
@@ -171,24 +191,11 @@ class Submission:
         else:
             runtime_text = f'<br>Runtime: {self.runtime}'
 
-        message_html = '''
-        Workflow Id: {wfid}
-        <br>Submission Id: {subid}
-        <br>Entity Name: {entity}
-        <br>Status: <font color={status_color}>{status}</font>
-        {error_message}
-        {runtime}
-        <br><a href={link} target='_blank'>Click here for more details</a>
-        <br><br>
-        '''
-        message_html = message_html.format(wfname=self.wf_name,
-                                           wfid=self.wf_id,
-                                           subid=self.sub_id,
-                                           entity=self.entity_name,
-                                           status_color=status_color,
-                                           status=self.final_status,
-                                           error_message=error_message,
-                                           runtime=runtime_text,
-                                           link=self.get_link())
-
-        return message_html
+        return SUBMISSION_DETAILS.render(wfid=self.wf_id,
+                                         subid=self.sub_id,
+                                         entity=self.entity_name,
+                                         status_color=status_color,
+                                         status=self.final_status,
+                                         error_message=error_message,
+                                         runtime=runtime_text,
+                                         link=self.get_link())
@@ -0,0 +1,424 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+TERRA_TIME_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+SIM_OWNER = 'sim-owner@example.com'
+
+
+def terra_time(t):
+    return datetime.fromtimestamp(t, timezone.utc).strftime(TERRA_TIME_FMT)
+
+
+class TerraSimulator:
+    ''' in-memory stand-in for the parts of Terra (Rawls/Orchestration) that this project uses.
+    it starts with n_workspaces synthetic featured workspaces in `project`, each with workflows_per_workspace
+    workflows (named with stage prefixes if staged) and a sample_test entity.
+    each submission runs one workflow that is Queued for about queue_seconds, then Running for a lognormal
+    runtime (runtime_median seconds, with runtime_sigma spread), then Succeeded, or Failed with probability
+    failure_rate. fault_rates (e.g. {429: 0.01, 500: 0.005}) is the chance of any request failing with that code;
+    every request also takes latency seconds. all randomness comes from seed.
+    workflow metadata has metadata_shards scattered calls (with their inputs and outputs), and honors includeKey /
+    excludeKey, so that the size of metadata requests is realistic.
+    '''
+
+    def __init__(self, n_workspaces=10, workflows_per_workspace=2, staged=False, runtime_median=60,
+                 runtime_sigma=0.5, queue_seconds=5, failure_rate=0.1, fault_rates=None, latency=0, seed=0,
+                 project='sim-featured', metadata_shards=10):
+        self.metadata_shards = metadata_shards
+        self.runtime_median = runtime_median
+        self.runtime_sigma = runtime_sigma
+        self.queue_seconds = queue_seconds
+        self.failure_rate = failure_rate
+        self.fault_rates = fault_rates or {}
+        self.latency = latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.workspaces = {}        # (namespace, name) -> workspace state
+        self.featured = []          # featured-workspaces.json
+        self.request_counts = {}    # route name -> number of requests
+        self.fault_counts = {}      # status code -> number of injected faults
+
+        for i in range(n_workspaces):
+            name = f'Sim-Workspace-{i:04d}'
+            wf_names = [(f'{n + 1}_sim_workflow' if staged else f'sim_workflow_{n}')
+                        for n in range(workflows_per_workspace)]
+            self.add_workspace(project, name, wf_names)
+            self.featured.append({'namespace': project, 'name': name})
+
+    def add_workspace(self, namespace, name, wf_names, owners=None, entities=None):
+        self.workspaces[(namespace, name)] = {
+            'workspace': {'namespace': namespace,
+                          'name': name,
+                          'bucketName': 'fc-sim-' + uuid.uuid4().hex[:12],
+                          'cloudPlatform': 'Gcp',
+                          'createdDate': terra_time(time.time()),
+                          'attributes': {}},
+            'owners': owners or [SIM_OWNER],
+            'acl': {},
+            'configs': [{'name': wf_name, 'namespace': namespace, 'rootEntityType': 'sample'}
+                        for wf_name in wf_names],
+            'entities': entities or {'sample': [{'name': 'sample_test', 'entityType': 'sample', 'attributes': {}}]},
+            'submissions': {}}
+
+    # --- submission lifecycle ---
+
+    def _new_submission(self, config_name):
+        now = time.time()
+        runtime = self._rng.lognormvariate(math.log(self.runtime_median), self.runtime_sigma)
+        return {'submissionId': str(uuid.uuid4()),
+                'workflowId': str(uuid.uuid4()),
+                'methodConfigurationName': config_name,
+                'submitted': now,
+                'started': now + self._rng.uniform(0.5, 1.5) * self.queue_seconds,
+                'runtime': runtime,
+                'outcome': 'Failed' if self._rng.random() < self.failure_rate else 'Succeeded',
+                'aborted': None}
+
+    def _workflow_state(self, sub, now):
+        ''' (workflow status, submission status, end time) of a simulated submission at time now '''
+        end = sub['started'] + sub['runtime']
+        if sub['aborted'] is not None and sub['aborted'] < end:
+            return 'Aborted', 'Aborted', sub['aborted']
+        if now < sub['started']:
+            return 'Queued', 'Submitted', None
+        if now < end:
+            return 'Running', 'Submitted', None
+        return sub['outcome'], 'Done', end
+
+    def _submission_json(self, sub, now):
+        wf_status, sub_status, end = self._workflow_state(sub, now)
+        workflow = {'status': wf_status, 'entityName': 'sample_test', 'messages': []}
+        if wf_status != 'Queued':
+            workflow['workflowId'] = sub['workflowId']
+        if wf_status == 'Failed':
+            workflow['messages'] = ['Simulated workflow failure']
+        return {'submissionId': sub['submissionId'],
+                'submissionDate': terra_time(sub['submitted']),
+                'methodConfigurationName': sub['methodConfigurationName'],
+                'status': sub_status,
+                'workflows': [workflow],
+                'cost': self._cost(sub, now)}
+
+    def _cost(self, sub, now):
+        # about $0.50 per hour of runtime
+        _, _, end = self._workflow_state(sub, now)
+        ran = max(min(now, end or now) - sub['started'], 0)
+        return round(ran / 3600 * 0.5, 4)
+
+    def _metadata_json(self, sub, now, query):
+        wf_status, _, end = self._workflow_state(sub, now)
+        wf_name = sub['methodConfigurationName']
+        bucket = f'gs://fc-sim/{sub["submissionId"]}/{wf_name}/{sub["workflowId"]}'
+        metadata = {'id': sub['workflowId'],
+                    'workflowName': wf_name,
+                    'status': wf_status,
+                    'submission': terra_time(sub['submitted']),
+                    'start': terra_time(sub['started']),
+                    'failures': [],
+                    'labels': {'cromwell-workflow-id': 'cromwell-' + sub['workflowId']},
+                    'inputs': {f'{wf_name}.input_files': [f'gs://sim-data/sample_{i}.bam' for i in range(self.metadata_shards)]},
+                    'outputs': {},
+                    'submittedFiles': {'workflow': f'version 1.0\nworkflow {wf_name} {{\n' + '  # ...\n' * 200 + '}\n'},
+                    'calls': {f'{wf_name}.scatter_task': [
+                        {'shardIndex': i,
+                         'executionStatus': 'Done' if end is not None else 'Running',
+                         'inputs': {'input_file': f'gs://sim-data/sample_{i}.bam', 'memory_gb': 4, 'disk_gb': 100},
+                         'outputs': {'output_file': f'{bucket}/call-scatter_task/shard-{i}/out.bam'},
+                         'callRoot': f'{bucket}/call-scatter_task/shard-{i}',
+                         'stdout': f'{bucket}/call-scatter_task/shard-{i}/stdout',
+                         'stderr': f'{bucket}/call-scatter_task/shard-{i}/stderr',
+                         'runtimeAttributes': {'docker': 'us.gcr.io/sim/tools:1.0', 'cpu': '2', 'memory': '4 GB',
+                                               'disks': 'local-disk 100 HDD', 'preemptible': '3'}}
+                        for i in range(self.metadata_shards)]}}
+        if end is not None:
+            metadata['end'] = terra_time(end)
+            metadata['outputs'] = {f'{wf_name}.output_files': [shard['outputs']['output_file'] for shard in
+                                                               metadata['calls'][f'{wf_name}.scatter_task']]}
+        if wf_status == 'Failed':
+            metadata['failures'] = [{'message': 'Workflow failed',
+                                     'causedBy': [{'message': 'Simulated task failure', 'causedBy': []}]}]
+        if 'includeKey' in query:
+            metadata = {key: value for key, value in metadata.items() if key in query['includeKey'] + ['id']}
+        for key in query.get('excludeKey', []):
+            metadata.pop(key, None)
+        return metadata
+
+    # --- request handling ---
+
+    def _workspace(self, namespace, name):
+        ws = self.workspaces.get((namespace, name))
+        if ws is None:
+            raise KeyError(f'{namespace}/{name} does not exist')
+        return ws
+
+    def _submission(self, namespace, name, sub_id):
+        sub = self._workspace(namespace, name)['submissions'].get(sub_id)
+        if sub is None:
+            raise KeyError(f'Submission {sub_id} not found')
+        return sub
+
+    def handle(self, method, path, query, body):
+        ''' route a request; returns (status code, json-able response or None, extra headers) '''
+        route = 'featured_workspaces' if path.endswith('featured-workspaces.json') else None
+        for pattern_method, pattern, name in ROUTES:
+            match = pattern.fullmatch(path)
+            if match and pattern_method == method:
+                route = name
+                break
+        with self._lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+            fault = None
+            roll = self._rng.random() if route not in [None, 'featured_workspaces'] else 1
+            for code, rate in sorted(self.fault_rates.items()):
+                if roll < rate:
+                    fault = code
+                    break
+                roll -= rate
+            if fault is not None:
+                self.fault_counts[fault] = self.fault_counts.get(fault, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        if fault is not None:
+            return fault, {'message': f'Simulated {fault} fault'}, {'Retry-After': '1'} if fault == 429 else {}
+        if route is None:
+            return 404, {'message': f'No simulated endpoint for {method} {path}'}, {}
+        if route == 'featured_workspaces':
+            return 200, self.featured, {}
+
+        args = [part for part in match.groups()]
+        try:
+            with self._lock:
+                return getattr(self, '_' + route)(time.time(), query, body, *args)
+        except KeyError as e:
+            return 404, {'message': str(e).strip("'")}, {}
+
+    def _list_workspaces(self, now, query, body):
+        return 200, [{'workspace': ws['workspace'], 'accessLevel': 'OWNER'} for ws in self.workspaces.values()], {}
+
+    def _get_workspace(self, now, query, body, namespace, name):
+        ws = self._workspace(namespace, name)
+        return 200, {'workspace': ws['workspace'], 'owners': ws['owners'], 'accessLevel': 'OWNER'}, {}
+
+    def _delete_workspace(self, now, query, body, namespace, name):
+        self._workspace(namespace, name)
+        del self.workspaces[(namespace, name)]
+        return 202, {'message': f'Your Google bucket for {namespace}/{name} will be deleted within 24h.'}, {}
+
+    def _clone_workspace(self, now, query, body, namespace, name):
+        source = self._workspace(namespace, name)
+        if (body['namespace'], body['name']) in self.workspaces:
+            return 409, {'message': f"Workspace {body['namespace']}/{body['name']} already exists"}, {}
+        self.add_workspace(body['namespace'], body['name'], [config['name'] for config in source['configs']],
+                           owners=['sim-runner@example.com'], entities=source['entities'])
+        return 201, self.workspaces[(body['namespace'], body['name'])]['workspace'], {}
+
+    def _update_acl(self, now, query, body, namespace, name):
+        ws = self._workspace(namespace, name)
+        for update in body:
+            ws['acl'][update['email']] = update['accessLevel']
+        return 200, {'usersUpdated': body, 'invitesSent': [], 'invitesUpdated': [], 'usersNotFound': []}, {}
+
+    def _list_configs(self, now, query, body, namespace, name):
+        return 200, self._workspace(namespace, name)['configs'], {}
+
+    def _get_entities(self, now, query, body, namespace, name, etype):
+        return 200, self._workspace(namespace, name)['entities'].get(etype, []), {}
+
+    def _get_entity(self, now, query, body, namespace, name, etype, entity_name):
+        for entity in self._workspace(namespace, name)['entities'].get(etype, []):
+            if entity['name'] == entity_name:
+                return 200, entity, {}
+        return 404, {'message': f'{etype} {entity_name} does not exist in {namespace}/{name}'}, {}
+
+    def _entity_query(self, now, query, body, namespace, name, etype):
+        entities = self._workspace(namespace, name)['entities'].get(etype)
+        if entities is None:
+            return 404, {'message': f'Entity type {etype} not found'}, {}
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('pageSize', ['100'])[0])
+        matches = sorted(entities, key=lambda entity: entity['name'],
+                         reverse=query.get('sortDirection', ['asc'])[0] == 'desc')
+        for term in query.get('filterTerms', [''])[0].lower().split():
+            matches = [entity for entity in matches if term in json.dumps(entity).lower()]
+        if 'fields' in query:
+            fields = query['fields'][0].split(',')
+            matches = [dict(entity, attributes={key: value for key, value in entity['attributes'].items()
+                                                if key in fields}) for entity in matches]
+        return 200, {'parameters': {'page': page, 'pageSize': page_size},
+                     'resultMetadata': {'unfilteredCount': len(entities),
+                                        'filteredCount': len(matches),
+                                        'filteredPageCount': max(math.ceil(len(matches) / page_size), 1)},
+                     'results': matches[(page - 1) * page_size:page * page_size]}, {}
+
+    def _create_submission(self, now, query, body, namespace, name):
+        ws = self._workspace(namespace, name)
+        config_name = body['methodConfigurationName']
+        if not any(config['name'] == config_name for config in ws['configs']):
+            return 404, {'message': f'Method configuration {config_name} not found'}, {}
+        sub = self._new_submission(config_name)
+        ws['submissions'][sub['submissionId']] = sub
+        return 201, self._submission_json(sub, now), {}
+
+    def _list_submissions(self, now, query, body, namespace, name):
+        submissions = []
+        for sub in self._workspace(namespace, name)['submissions'].values():
+            sub_json = self._submission_json(sub, now)
+            statuses = {}
+            for workflow in sub_json.pop('workflows'):
+                statuses[workflow['status']] = statuses.get(workflow['status'], 0) + 1
+            sub_json['workflowStatuses'] = statuses
+            submissions.append(sub_json)
+        return 200, submissions, {}
+
+    def _get_submission(self, now, query, body, namespace, name, sub_id):
+        return 200, self._submission_json(self._submission(namespace, name, sub_id), now), {}
+
+    def _abort_submission(self, now, query, body, namespace, name, sub_id):
+        sub = self._submission(namespace, name, sub_id)
+        if sub['aborted'] is None:
+            sub['aborted'] = now
+        return 204, None, {}
+
+    def _workflow_metadata(self, now, query, body, namespace, name, sub_id, wf_id):
+        sub = self._submission(namespace, name, sub_id)
+        if sub['workflowId'] != wf_id or self._workflow_state(sub, now)[0] == 'Queued':
+            return 404, {'message': f'Workflow {wf_id} not found'}, {}
+        return 200, self._metadata_json(sub, now, query), {}
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.request_counts),
+                    'faults': {str(code): n for code, n in self.fault_counts.items()},
+                    'workspaces': len(self.workspaces),
+                    'submissions': sum(len(ws['submissions']) for ws in self.workspaces.values())}
+
+
+_WS = r'/api/workspaces/([^/]+)/([^/]+)'
+ROUTES = [('GET', re.compile(r'/api/workspaces'), 'list_workspaces'),
+          ('GET', re.compile(_WS), 'get_workspace'),
+          ('DELETE', re.compile(_WS), 'delete_workspace'),
+          ('POST', re.compile(_WS + r'/clone'), 'clone_workspace'),
+          ('PATCH', re.compile(_WS + r'/acl'), 'update_acl'),
+          ('GET', re.compile(_WS + r'/methodconfigs'), 'list_configs'),
+          ('GET', re.compile(_WS + r'/entities/([^/]+)'), 'get_entities'),
+          ('GET', re.compile(_WS + r'/entities/([^/]+)/([^/]+)'), 'get_entity'),
+          ('GET', re.compile(_WS + r'/entityQuery/([^/]+)'), 'entity_query'),
+          ('POST', re.compile(_WS + r'/submissions'), 'create_submission'),
+          ('GET', re.compile(_WS + r'/submissions'), 'list_submissions'),
+          ('GET', re.compile(_WS + r'/submissions/([^/]+)'), 'get_submission'),
+          ('DELETE', re.compile(_WS + r'/submissions/([^/]+)'), 'abort_submission'),
+          ('GET', re.compile(_WS + r'/submissions/([^/]+)/workflows/([^/]+)'), 'workflow_metadata')]
+
+
+def make_handler(simulator):
+    ''' an http request handler class serving the given TerraSimulator '''
+
+    class SimulatorHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # headers and body go out in separate writes; don't wait for delayed acks
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            raw_body = self.rfile.read(length) if length else b''
+            try:
+                body = json.loads(raw_body) if raw_body else None
+            except ValueError:
+                body = parse_qs(raw_body.decode())
+
+            if url.path == '/sim/stats':
+                code, response, headers = 200, simulator.stats(), {}
+            else:
+                code, response, headers = simulator.handle(method, url.path.rstrip('/'), parse_qs(url.query), body)
+
+            content = json.dumps(response).encode() if response is not None else b''
+            self.send_response(code)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if response is not None:
+                self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PATCH(self):
+            self._dispatch('PATCH')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+        def log_message(self, format, *args):
+            pass
+
+    return SimulatorHandler
+
+
+def start_simulator(simulator, host='127.0.0.1', port=0):
+    ''' serve simulator on a background thread; returns (server, base url). port 0 picks a free port '''
+    server = ThreadingHTTPServer((host, port), make_handler(simulator))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local stand-in for the Terra API, for load testing')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default 8080)')
+    parser.add_argument('--n_workspaces', type=int, default=10, help='number of synthetic featured workspaces')
+    parser.add_argument('--workflows_per_workspace', type=int, default=2, help='number of workflows in each workspace')
+    parser.add_argument('--staged', action='store_true', help='prefix workflow names with stage numbers (1_, 2_, ...)')
+    parser.add_argument('--runtime_median', type=float, default=60, help='median workflow runtime in seconds')
+    parser.add_argument('--runtime_sigma', type=float, default=0.5, help='spread (lognormal sigma) of workflow runtimes')
+    parser.add_argument('--queue_seconds', type=float, default=5, help='typical time a workflow stays Queued')
+    parser.add_argument('--failure_rate', type=float, default=0.1, help='fraction of workflows that fail')
+    parser.add_argument('--fault_429', type=float, default=0, help='fraction of requests answered with a 429')
+    parser.add_argument('--fault_500', type=float, default=0, help='fraction of requests answered with a 500')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--metadata_shards', type=int, default=10, help='number of scattered calls in workflow metadata')
+
+    args = parser.parse_args()
+
+    simulator = TerraSimulator(n_workspaces=args.n_workspaces,
+                               workflows_per_workspace=args.workflows_per_workspace,
+                               staged=args.staged,
+                               runtime_median=args.runtime_median,
+                               runtime_sigma=args.runtime_sigma,
+                               queue_seconds=args.queue_seconds,
+                               failure_rate=args.failure_rate,
+                               fault_rates={429: args.fault_429, 500: args.fault_500},
+                               latency=args.latency,
+                               seed=args.seed,
+                               metadata_shards=args.metadata_shards)
+    server, url = start_simulator(simulator, args.host, args.port)
+    print(f'Simulating {args.n_workspaces} featured workspaces at {url}. To test against it:')
+    print(f'    export FIRECLOUD_API={url}/api/')
+    print(f'    export FEATURED_WORKSPACES_URL={url}/featured-workspaces.json')
+    print(f'    python3 featured_workspaces_test.py -v -m -b 0 --skip_cost --skip_cleanup --transport sandbox '
+          f'--clone_project sim-clones --share_with sim-support@example.com')
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(simulator.stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,242 @@
+import atexit
+import functools
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from fiss_cache import request_key
+
+
+MODES = ['live', 'record', 'replay', 'sandbox']
+
+# response headers kept in fixtures; everything else is dropped to keep them small
+KEPT_HEADERS = ['Content-Type', 'Retry-After']
+
+# clone timestamps (e.g. 2019-10-23-17-48-44) differ between runs, so they're masked in fixture keys
+CLONE_TIME = re.compile(r'\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}')
+
+
+class FixtureMissing(KeyError):
+    ''' raised in replay mode for a call that isn't in the fixture file '''
+
+
+def fixture_key(kind, key):
+    return kind + ' ' + CLONE_TIME.sub('<clone_time>', key)
+
+
+def encode_response(response):
+    ''' compact, json-able form of a requests.Response '''
+    headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+    try:
+        body = {'json': response.json()}
+    except ValueError:
+        body = {'text': response.content.decode('utf-8', errors='replace')}
+    return dict(status_code=response.status_code, headers=headers, **body)
+
+
+def decode_response(encoded):
+    ''' rebuild a requests.Response from encode_response's output '''
+    response = requests.Response()
+    response.status_code = encoded['status_code']
+    response.headers = CaseInsensitiveDict(encoded['headers'])
+    if 'json' in encoded:
+        response._content = json.dumps(encoded['json']).encode('utf-8')
+    else:
+        response._content = encoded['text'].encode('utf-8')
+    response.encoding = 'utf-8'
+    return response
+
+
+class Transport:
+    ''' the way this code reaches Terra, GCS and email.
+    live: call through as usual.
+    sandbox: call through (e.g. to a local terra_simulator), but keep uploads and downloads in storage_dir and don't send email.
+    record: call through, and keep every interaction (in order, per request) to save in fixture_path.
+    replay: never touch the network; serve the recorded interactions in order, repeating the last one
+        for each request once they run out (so polling sees the final state), after waiting latency_scale
+        times the recorded latency plus latency seconds. uploads and downloads use storage_dir instead.
+    fixture files are json, gzipped if fixture_path ends with .gz. consecutive identical responses
+    to the same request (e.g. while polling) are stored once with a repeat count.
+    '''
+
+    def __init__(self, mode='live', fixture_path=None, latency_scale=1.0, latency=0, storage_dir=None):
+        if mode not in MODES:
+            raise ValueError(f'transport mode must be one of {MODES}, not {mode}')
+        if mode in ['record', 'replay'] and fixture_path is None:
+            raise ValueError(f'a fixture file is needed to {mode}')
+        self.mode = mode
+        self.fixture_path = fixture_path
+        self.latency_scale = latency_scale
+        self.latency = latency
+        self.storage_dir = storage_dir or 'replay_storage'
+        self._lock = threading.Lock()
+        self._fixtures = {}     # fixture key -> list of {'result': ..., 'elapsed': seconds, 'repeat': n}
+        self._position = {}     # fixture key -> [entry index, repeats served from that entry]
+        if mode == 'replay':
+            self._fixtures = self._load()
+
+    def _load(self):
+        opener = gzip.open if self.fixture_path.endswith('.gz') else open
+        with opener(self.fixture_path, 'rt') as f:
+            return json.load(f)
+
+    def save(self):
+        ''' write the recorded interactions to fixture_path (record mode only) '''
+        if self.mode != 'record':
+            return
+        opener = gzip.open if self.fixture_path.endswith('.gz') else open
+        with self._lock:
+            with opener(self.fixture_path, 'wt') as f:
+                json.dump(self._fixtures, f, separators=(',', ':'))
+
+    def _record(self, key, result, elapsed):
+        with self._lock:
+            entries = self._fixtures.setdefault(key, [])
+            if entries and entries[-1]['result'] == result:
+                entries[-1]['repeat'] += 1
+            else:
+                entries.append({'result': result, 'elapsed': round(elapsed, 3), 'repeat': 1})
+
+    def _replay(self, key):
+        with self._lock:
+            entries = self._fixtures.get(key)
+            if not entries:
+                raise FixtureMissing(f'no recorded interaction for {key}')
+            position = self._position.setdefault(key, [0, 0])
+            entry = entries[position[0]]
+            position[1] += 1
+            if position[1] >= entry['repeat'] and position[0] < len(entries) - 1:
+                self._position[key] = [position[0] + 1, 0]
+        delay = entry['elapsed'] * self.latency_scale + self.latency
+        if delay > 0:
+            time.sleep(delay)
+        return entry['result']
+
+    def call(self, kind, key, func, *args, encode=None, decode=None, **kwargs):
+        ''' make (or record, or replay) the call func(*args, **kwargs), identified by kind and key.
+        encode/decode convert the result to and from its json-able fixture form (default: unchanged).
+        '''
+        if self.mode == 'sandbox' and kind == 'email':
+            return None
+        if self.mode in ['live', 'sandbox']:
+            return func(*args, **kwargs)
+        key = fixture_key(kind, key)
+        if self.mode == 'replay':
+            result = self._replay(key)
+            return decode(result) if decode else result
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self._record(key, encode(result) if encode else result, time.perf_counter() - start)
+        return result
+
+    def fiss(self, fapifunc):
+        ''' wrap a FISS api function (keeping its name) so that its responses are recorded / replayed '''
+        @functools.wraps(fapifunc)
+        def wrapper(*args, **kwargs):
+            return self.call('fiss', request_key(fapifunc, args, kwargs), fapifunc, *args,
+                             encode=encode_response, decode=decode_response, **kwargs)
+        return wrapper
+
+    def local_storage_path(self, url):
+        ''' where a gs:// or public storage url lives under storage_dir '''
+        url = url.replace('gs://', 'https://storage.googleapis.com/')
+        return os.path.join(self.storage_dir, url.split('://', 1)[-1])
+
+    def gsutil(self, command, gcs_path, func):
+        ''' the output of `gsutil command gcs_path` (ls or cat), from func(). in sandbox mode,
+        the local storage under storage_dir is read instead
+        '''
+        if self.mode != 'sandbox':
+            return self.call('gsutil', f'{command} {gcs_path}', func)
+        local_path = self.local_storage_path(gcs_path.rstrip('/'))
+        if command == 'cat':
+            with open(local_path) as f:
+                return f.read()
+        if not os.path.isdir(local_path):
+            return ''
+        folder = gcs_path.rstrip('/')
+        return ''.join(f'{folder}/{name}' + ('/' if os.path.isdir(os.path.join(local_path, name)) else '') + '\n'
+                       for name in sorted(os.listdir(local_path)))
+
+    def upload(self, upload_func, local_path, public_url, *args, **kwargs):
+        ''' upload a file with upload_func(local_path, *args, **kwargs), or in replay/sandbox mode copy it under
+        storage_dir (at the path of its public url) instead
+        '''
+        if self.mode not in ['replay', 'sandbox']:
+            upload_func(local_path, *args, **kwargs)
+            return
+        destination = self.local_storage_path(public_url)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(local_path, destination)
+
+    def upload_gzipped(self, upload_func, compressed, public_url, *args, **kwargs):
+        ''' upload gzipped in-memory data with upload_func(compressed, *args, **kwargs), or in replay/sandbox mode
+        write it, decompressed, under storage_dir (at the path of its public url) instead
+        '''
+        if self.mode not in ['replay', 'sandbox']:
+            upload_func(compressed, *args, **kwargs)
+            return
+        destination = self.local_storage_path(public_url)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'wb') as f:
+            f.write(gzip.decompress(compressed))
+
+    def download(self, download_func, gcs_file, local_path):
+        ''' download a file with download_func(gcs_file, local_path), or in replay/sandbox mode copy it from
+        under storage_dir instead. returns False if there is no such file
+        '''
+        if self.mode not in ['replay', 'sandbox']:
+            return download_func(gcs_file, local_path)
+        source = self.local_storage_path(gcs_file)
+        if not os.path.exists(source):
+            return False
+        shutil.copyfile(source, local_path)
+        return True
+
+
+_transport = Transport()
+
+
+def get_transport():
+    return _transport
+
+
+def configure_transport(mode='live', fixture_path=None, latency_scale=1.0, latency=0, storage_dir=None):
+    ''' replace the process-wide transport, e.g. with settings from the command line.
+    in record mode the fixtures are saved when the process exits.
+    '''
+    global _transport
+    _transport = Transport(mode=mode, fixture_path=fixture_path, latency_scale=latency_scale, latency=latency,
+                           storage_dir=storage_dir)
+    if mode == 'record':
+        atexit.register(_transport.save)
+    return _transport
+
+
+def add_transport_arguments(parser):
+    ''' add the record/replay command line arguments to an argparse parser '''
+    parser.add_argument('--transport', type=str, default='live', choices=MODES,
+                        help='live: talk to Terra/GCS; record: also save every interaction to --fixtures; '
+                             'replay: serve the interactions in --fixtures instead (nothing touches the network); '
+                             'sandbox: talk to FISS (e.g. a local terra_simulator) but keep uploads local and send no email')
+    parser.add_argument('--fixtures', type=str, default=None,
+                        help='fixture file to record to / replay from (gzipped if it ends with .gz)')
+    parser.add_argument('--replay_latency_scale', type=float, default=1.0,
+                        help='in replay, wait this multiple of each recorded call latency (default 1, 0 for none)')
+    parser.add_argument('--replay_latency', type=float, default=0,
+                        help='in replay, extra seconds to wait on every call (default 0)')
+    parser.add_argument('--replay_storage_dir', type=str, default='replay_storage',
+                        help='in replay/sandbox, local folder that stands in for GCS uploads (default replay_storage)')
+
+
+def configure_transport_from_args(args):
+    return configure_transport(mode=args.transport, fixture_path=args.fixtures,
+                               latency_scale=args.replay_latency_scale, latency=args.replay_latency,
+                               storage_dir=args.replay_storage_dir)
@@ -0,0 +1,74 @@
+import functools
+import json
+import re
+
+
+# a workflow name starting with a number and a separator (e.g. '1_align', '2-call variants') is an ordered stage
+STAGE_PREFIX = re.compile(r'^(\d+)[_\-\s.]')
+
+
+def workflow_stage(wf_name):
+    ''' the stage number from the workflow's name prefix, or None if it isn't prefixed
+    '''
+    match = STAGE_PREFIX.match(wf_name)
+    return int(match.group(1)) if match else None
+
+
+@functools.lru_cache(maxsize=None)
+def load_workflow_config(path):
+    ''' load the optional per-workspace workflow dependency config, a json file like
+    {"project/workspace": {"2_call_variants": ["1_align_sample", "1_align_normal"]}}
+    where workspaces are keyed by their ORIGINAL (featured) project/name.
+    '''
+    if path is None:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _has_cycle(deps):
+    # Kahn's algorithm: if we can't peel off every workflow, there's a cycle
+    remaining = {wf: set(wf_deps) for wf, wf_deps in deps.items()}
+    ready = [wf for wf, wf_deps in remaining.items() if not wf_deps]
+    while ready:
+        done = ready.pop()
+        del remaining[done]
+        for wf, wf_deps in remaining.items():
+            if done in wf_deps:
+                wf_deps.discard(done)
+                if not wf_deps:
+                    ready.append(wf)
+    return len(remaining) > 0
+
+
+def plan_dependencies(wf_names, optional=(), config=None):
+    ''' build the workflow dependency DAG for a workspace.
+    returns a dict of wf_name -> sorted list of the workflow names it must wait for.
+
+    by default, if at least two different stage prefixes are present, each prefixed workflow waits for
+    every workflow in the closest earlier stage (so 1_a and 1_b run together, then 2_c). workflows without
+    a prefix, and optional workflows (which aren't tested), don't wait for anything and nothing waits for them.
+    config (a dict of wf_name -> list of dependencies) overrides the dependencies of the workflows it lists.
+    '''
+    deps = {wf: [] for wf in wf_names}
+    stages = {wf: workflow_stage(wf) for wf in wf_names if wf not in optional}
+    stages = {wf: n for wf, n in stages.items() if n is not None}
+
+    if len(set(stages.values())) > 1:
+        for wf, n in stages.items():
+            earlier = [m for m in stages.values() if m < n]
+            if earlier:
+                previous = max(earlier)
+                deps[wf] = sorted(other for other, m in stages.items() if m == previous)
+
+    if config:
+        configured = dict(deps)
+        for wf, wf_deps in config.items():
+            if wf in configured:
+                configured[wf] = sorted(dep for dep in wf_deps if dep in deps and dep != wf)
+        if _has_cycle(configured):
+            print('WARNING: workflow config has a dependency cycle, falling back to name prefixes')
+        else:
+            deps = configured
+
+    return deps
@@ -6,8 +6,10 @@ from datetime import datetime
 from ws_class import Wspace
 from firecloud import api as fapi
 from fiss_fns import call_fiss
-from gcs_fns import run_subprocess
+from gcs_fns import configure_report_debug_dir, get_upload_queue, run_subprocess
 from fiss_api_addons import clone_workspace_with_bucket_location
+from transport import add_transport_arguments, configure_transport_from_args
+from entity_selection import configure_entity_selector
 
 
 def get_ws_bucket(project, name):
@@ -200,7 +202,15 @@ if __name__ == "__main__":
     parser.add_argument('--mute_notifications', '-m', action='store_true', help='do NOT send emails to workspace owners in case of failure (default is do send)')
 
     parser.add_argument('--verbose', '-v', action='store_true', help='print progress text')
+    parser.add_argument('--entity_cache', type=str, default=None, help='optional json file remembering the entity the workflows are tested on, for reuse by later runs')
+    parser.add_argument('--report_debug_dir', type=str, default=None, help='optional local folder to also write the html report to (it is otherwise only uploaded)')
+    add_transport_arguments(parser)
 
     args = parser.parse_args()
 
+    configure_transport_from_args(args)
+    entity_selector = configure_entity_selector(args.entity_cache)
+    configure_report_debug_dir(args.report_debug_dir)
     test_one(args)
+    get_upload_queue().flush()
+    entity_selector.save()
@@ -1,16 +1,32 @@
-from dataclasses import dataclass, field
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 from firecloud import api as fapi
 from datetime import datetime, timedelta
 from submission_class import Submission
-from gcs_fns import upload_to_gcs
+from gcs_fns import get_upload_queue, upload_destination
 from fiss_fns import call_fiss, format_timedelta
 from send_emails import send_email
+from workflow_dag import plan_dependencies
+from entity_selection import get_entity_selector
+from report_templates import WORKFLOW_SECTION, WORKSPACE_REPORT
 
 
 WORKFLOWS_THAT_REQUIRE_MULTIPLE_ENTITIES = ['0_idap_pre_processing_for_analysis',  # terracontest/ TOSC19-idap
                                             '1_processing-for-variant-discovery-gatk4'  # terracontest/ TOSC19-idap
                                             ]
 
+# submission statuses after which a submission won't change
+TERMINAL_STATES = ['Done', 'Aborted', 'Submission Failed']
+
+# format version of the json sidecars written next to the html reports
+SIDECAR_VERSION = 1
+
+# submissions are created in the background by this many threads, shared by all workspaces
+# (FISS calls are also bounded by the process-wide throttle)
+SUBMISSION_WORKERS = 16
+_submission_executor = ThreadPoolExecutor(max_workers=SUBMISSION_WORKERS, thread_name_prefix='create_submission')
+
 
 @dataclass
 class Wspace:
@@ -30,6 +46,7 @@ class Wspace:
     submissions_cost: str = None  # dict of submissions and their costs
     total_cost: str = None      # total cost of all submissions
     test_time: str = None       # to keep track of how long the test takes
+    runtime_seconds: float = None  # how long the test took, in seconds (set by stop_timer)
     report_path: str = None
 
     def __post_init__(self):
@@ -38,6 +55,33 @@ class Wspace:
                     .format(project=self.project.replace(' ', '%20'),
                             workspace=self.workspace.replace(' ', '%20'))
         self.key = self.project + '/' + self.workspace
+        self.creating = {}  # wf_name -> future of a create_submission running in the background
+
+    def to_dict(self):
+        ''' json-serializable dict of this workspace's state, including its submissions
+        '''
+        ws_dict = {f.name: getattr(self, f.name) for f in fields(self)}
+        ws_dict['active_submissions'] = [sub.to_dict() for sub in self.active_submissions]
+        ws_dict['tested_workflows'] = [sub.to_dict() for sub in self.tested_workflows]
+        if isinstance(self.test_time, datetime):  # timer is still running
+            ws_dict['test_time'] = self.test_time.isoformat()
+            ws_dict['timer_running'] = True
+        return ws_dict
+
+    @classmethod
+    def from_dict(cls, ws_dict):
+        ''' rebuild a Wspace (and its Submissions) from the output of to_dict
+        '''
+        ws_dict = dict(ws_dict)
+        active_submissions = [Submission.from_dict(sub) for sub in ws_dict.pop('active_submissions', [])]
+        tested_workflows = [Submission.from_dict(sub) for sub in ws_dict.pop('tested_workflows', [])]
+        if ws_dict.pop('timer_running', False):
+            ws_dict['test_time'] = datetime.fromisoformat(ws_dict['test_time'])
+
+        ws = cls(**{f.name: ws_dict[f.name] for f in fields(cls) if f.name in ws_dict})
+        ws.active_submissions = active_submissions
+        ws.tested_workflows = tested_workflows
+        return ws
 
     def start_timer(self):
         if self.test_time is None:  # only do this once!
@@ -51,7 +95,9 @@ class Wspace:
         if self.test_time is not None:
             if type(self.test_time) is not str:
                 start_time = self.test_time
-                self.test_time = format_timedelta(datetime.now() - start_time, 2)  # 2 hours is threshold for labeling this red
+                elapsed = datetime.now() - start_time
+                self.runtime_seconds = elapsed.total_seconds()
+                self.test_time = format_timedelta(elapsed, 2)  # 2 hours is threshold for labeling this red
 
     def share_workspace(self, email_to_add):
         """Share the workspace with the provided email address (VIEWER, canShare, no compute)."""
@@ -68,7 +114,10 @@ class Wspace:
                   acl_updates,
                   False)  # set invite_users_not_found=False
 
-    def create_submissions(self, verbose=False):
+    def create_submissions(self, verbose=False, dependencies=None):
+        ''' set up a Submission for each workflow in the workspace. dependencies is an optional dict of
+        wf_name -> list of workflows it must wait for, overriding the ordering from name prefixes.
+        '''
         project = self.project
         workspace = self.workspace
         if verbose:
@@ -102,26 +151,7 @@ class Wspace:
                 wf_name = item['name']              # the name of the workflow
 
                 # get and store the name of the data (entity) being used, if any
-                entities = call_fiss(fapi.get_entities, 200, project, workspace, entityType)
-                entityName = None
-                if len(entities) != 0:
-                    allEntities = []
-                    for ent in entities:
-                        allEntities.append(ent['name'])
-
-                    # if there's a _test entity, use it
-                    for ent in allEntities:
-                        if '_test' in ent:
-                            entityName = ent
-                    # otherwise if there's a _small entity, use it
-                    if entityName is None:
-                        for ent in allEntities:
-                            if '_small' in ent:
-                                entityName = ent
-
-                    # otherwise just use the first entity
-                    if entityName is None:
-                        entityName = allEntities[0]  # use the first one
+                entityName = get_entity_selector().entity_for(self, entityType)
 
                 # if there is no entityName, make sure entityType is also None
                 if entityName is None:
@@ -145,29 +175,21 @@ class Wspace:
                     submissions_unordered[wf_name].final_status = 'Not tested'
                     submissions_unordered[wf_name].message = 'Optional workflow not tested'
 
-            # check whether workflows are ordered, and structure list of submissions accordingly
-            first_char = list(wf[0] for wf in workflow_names)
-            submissions_list = []
-            if ('1' in first_char) and ('2' in first_char):
-                do_order = True
-                workflow_names.sort()
-                for wf_name in workflow_names:
-                    submissions_list.append([submissions_unordered[wf_name]])
-                if verbose:
-                    print('[submitting workflows sequentially]')
-            else:
-                do_order = False
-                sub_list = []
-                for wf_name in workflow_names:
-                    sub_list.append(submissions_unordered[wf_name])
-                submissions_list = [sub_list]
-                if verbose:
-                    print('[submitting workflows in parallel]')
+            # work out which workflows must wait for others, from their name prefixes and the optional config
+            optional = [wf_name for wf_name in workflow_names if 'optional' in wf_name.lower()]
+            deps = plan_dependencies(workflow_names, optional, dependencies)
+            for wf_name in workflow_names:
+                submissions_unordered[wf_name].depends_on = deps[wf_name]
+                if verbose and deps[wf_name]:
+                    print(f'[{wf_name} waits for: ' + ', '.join(deps[wf_name]) + ']')
+            if verbose and not any(deps.values()):
+                print('[submitting workflows in parallel]')
 
-            self.active_submissions = submissions_list
+            self.active_submissions = [submissions_unordered[wf_name] for wf_name in workflow_names]
 
-    def check_submissions(self, abort_hr=None, verbose=True):
-        # SUBMIT the submissions and check status
+    def check_submissions(self, abort_hr=None, verbose=True, scheduler=None):
+        # SUBMIT the submissions whose dependencies have finished and check status
+        # if a PollScheduler is passed, only submissions whose next-check deadline has passed are checked
 
         # check how long this workspace has been going - abort submissions if it's been running for >24 hours
         if abort_hr is not None:
@@ -175,46 +197,105 @@ class Wspace:
         else:
             abort_submissions = False
 
-        # define terminal states
-        terminal_states = set(['Done', 'Aborted', 'Submission Failed'])
-
-        if len(self.active_submissions) > 0:  # only proceed if there are still active submissions to do
-            count = 0
-            # the way active_submissions is structured, if workflows need to be run in order, they will be
-            # separate lists within active_submissions; if they can be run in parallel, there will be
-            # one list inside active_submissions containing all the workflow submissions to run.
-            sublist = self.active_submissions[0]
-            for sub in sublist:
-                # if the submission hasn't yet been submitted, do it
-                if sub.status is None:
-                    sub.create_submission(verbose=True)
-
-                # if the submission hasn't finished, check its status
-                if sub.status not in terminal_states:  # to avoid overchecking
-                    sub.check_status(verbose=True)  # check and update the status of the submission
-
-                # if the submission has finished, count it
-                if sub.status in terminal_states:
-                    count += 1
-                    if sub.wf_name not in (wfsub.wf_name for wfsub in self.tested_workflows):
-                        if sub.final_status is None:  # this won't be None if the (optional) workflow is not being tested
-                            # get final status & error messages
-                            sub.get_final_status()
-                        # append the full submission as a list item in tested_workflows
-                        self.tested_workflows.append(sub)
+        finished = set(wfsub.wf_name for wfsub in self.tested_workflows)
+        checked = set()  # check each submission's status at most once per call
+        n_workflows = len(self.active_submissions) + len(self.tested_workflows)
+
+        # keep passing over the active submissions as long as finishing one unblocks another
+        progress = True
+        while progress:
+            progress = False
+            # only look at submissions whose dependencies have all finished
+            ready = [sub for sub in self.active_submissions if all(dep in finished for dep in sub.depends_on)]
+
+            # start every submission that hasn't been submitted yet, all at once and without waiting for them
+            self.start_submissions(ready)
+            ready = [sub for sub in ready if sub.wf_name not in self.creating]
+
+            # check the status of every unfinished submission that's due, all at once
+            due = [sub for sub in ready
+                   if sub.sub_id is not None and sub.status not in TERMINAL_STATES and sub.wf_name not in checked
+                   and (scheduler is None or scheduler.is_due(sub))]  # to avoid overchecking
+            if due:
+                self.refresh_submission_statuses(due, verbose=True)
+                for sub in due:
+                    checked.add(sub.wf_name)
+                    if scheduler is not None:
+                        scheduler.update(sub)
+
+            for sub in ready:
+                # if the submission has finished, move it from active_submissions to tested_workflows
+                if sub.status in TERMINAL_STATES:
+                    if scheduler is not None:
+                        scheduler.complete(sub)
+                    if sub.final_status is None:  # this won't be None if the (optional) workflow is not being tested
+                        # get final status & error messages
+                        sub.get_final_status()
+                    self.tested_workflows.append(sub)
+                    self.active_submissions.remove(sub)
+                    finished.add(sub.wf_name)
+                    progress = True
 
                 # if need to abort (because test is taking too long)
                 elif abort_submissions:
                     sub.abort_submission()
 
-            if verbose:
-                print('    Finished ' + str(count) + ' of ' + str(len(sublist)) + ' workflows in this set of submissions')
+        if verbose and n_workflows > 0:
+            print('    Finished ' + str(len(self.tested_workflows)) + ' of ' + str(n_workflows) + ' workflows')
+
+    def start_submissions(self, subs):
+        ''' create the submissions among subs that haven't been submitted yet, concurrently in the background,
+        and collect the ones started earlier that are done. a submission whose creation raised an error is marked
+        Submission Failed (with the error as its message) without affecting the others.
+        '''
+        for sub in subs:
+            if sub.status is None and sub.wf_name not in self.creating:
+                self.creating[sub.wf_name] = _submission_executor.submit(sub.create_submission, verbose=True)
+
+        for sub in subs:
+            future = self.creating.get(sub.wf_name)
+            if future is None or not future.done():
+                continue
+            del self.creating[sub.wf_name]
+            error = future.exception()
+            if error is not None:
+                sub.status = 'Submission Failed'
+                sub.message = f'{type(error).__name__}: {error}'
+                print('SUBMISSION FAILED (' + sub.message + ', status marked Submission Failed) - ' + sub.wf_name)
+
+    def recover_submissions(self, verbose=True):
+        ''' after a resume: find the submissions that were created in Terra but never saved with their submission
+        id (e.g. the process stopped while start_submissions was creating them in the background), so that they
+        aren't submitted, and paid for, a second time. each workflow is submitted at most once in a cloned
+        workspace, so a submission of the workflow in the workspace's list of submissions is that one.
+        '''
+        pending = [sub for sub in self.active_submissions if sub.sub_id is None and sub.status is None]
+        if not pending:
+            return
+        listing = call_fiss(fapi.list_submissions, 200, self.project, self.workspace)
+        submitted = {item['methodConfigurationName']: item for item in listing}
+        for sub in pending:
+            item = submitted.get(sub.wf_name)
+            if item is not None:
+                sub.sub_id = item['submissionId']
+                sub.update_status(item['status'], verbose=verbose)
+                if verbose:
+                    print(f'    recovered submission {sub.sub_id} - {sub.wf_name}')
+
+    def refresh_submission_statuses(self, subs, verbose=True):
+        ''' update the status of subs with one list_submissions call for the whole workspace, instead of a
+        get_submission per submission. get_submission is only used when its details are needed: to find the
+        workflow id of a submission that just finished, or if a submission is missing from the list.
+        '''
+        listing = call_fiss(fapi.list_submissions, 200, self.project, self.workspace)
+        statuses = {item['submissionId']: item['status'] for item in listing}
 
-            # if all submissions are done, remove this set of submissions from the master submissions_list
-            if count == len(sublist):
-                self.active_submissions.pop(0)
-                # immediately submit the next submission if there is one
-                self.check_submissions()
+        for sub in subs:
+            status = statuses.get(sub.sub_id)
+            if status is None or (status in TERMINAL_STATES and sub.wf_id is None):
+                sub.check_status(verbose=verbose)
+            else:
+                sub.update_status(status, verbose=verbose)
 
     def get_workspace_run_cost(self):
         ''' after tests are run, query for costs
@@ -229,12 +310,8 @@ class Wspace:
     def generate_failed_list(self):
         ''' generate html for the list of failed workflows in the workspace
         '''
-        failed_list_html = ''
-        for sub in self.tested_workflows:
-            if 'Succeeded' not in sub.final_status:
-                failed_list_html += '<font color=red>' + sub.final_status + '</font>: ' + sub.wf_name + '<br>'
-
-        return failed_list_html
+        return ''.join('<font color=red>' + sub.final_status + '</font>: ' + sub.wf_name + '<br>'
+                       for sub in self.tested_workflows if 'Succeeded' not in sub.final_status)
 
     def generate_workspace_report(self, gcs_path, send_notifications=False, verbose=False):
         ''' generate a failure/success report for each workflow in a workspace,
@@ -275,73 +352,37 @@ class Wspace:
         notebooks_list = ['These tests do not currently test notebooks']
 
         # generate detail text from workflows
-        workflows_text = ''
-        for wfsub in self.tested_workflows:
-            workflows_text += '<h3>{wf_name}</h3><blockquote>{html}</blockquote>'\
-                              .format(wf_name=wfsub.wf_name,
-                                      html=wfsub.get_HTML())
+        workflows_text = [WORKFLOW_SECTION.render(wf_name=wfsub.wf_name, html=wfsub.get_HTML())
+                          for wfsub in self.tested_workflows]
 
         # generate detail text from notebooks
         notebooks_text = '<i>These tests do not currently test notebooks.</i>'
 
         html_output = self.workspace.replace(' ', '_') + '.html'
-        local_path = '/tmp/' + html_output
-        # open, generate, and write the html text for the report
-        f = open(local_path, 'w')
-        message = '''<html>
-        <head><link href='https://fonts.googleapis.com/css?family=Lato' rel='stylesheet'>
-        </head>
-        <body style='font-family:Montserrat,sans-serif; font-size:18px; padding:30; background-color:#FAFBFD'>
-        <p>
-        <center><div style='background-color:#82AA52; color:#FAFBFD; height:100px'>
-        <h1>
-        <img src='https://app.terra.bio/static/media/logo-wShadow.c7059479.svg' alt='Terra rocks!' style='vertical-align: middle;' height='100'>
-        <span style='vertical-align: middle;'>
-        Featured Workspace Report</span></h1>
-
-        <h1><font color={status_color}>{status_text}</font></h1></center> <br><br>
-        <br><br><h2><b> Cloned Workspace: </b>
-        <a href={workspace_link} target='_blank'>{workspace}</a></h2>
-        <big><b> Featured Workspace: </b>{workspace_orig}</big>
-        <br>
-        <big><b> Billing Project: </b>{project_orig}</big>
-        <br><br>{time_text}
-        <br>{call_cache_text}
-        <br><br><big><b> Workflows: </b>{wf_list}</big>
-        <br><big><b> Notebooks: </b>{nb_list}</big>
-        <br>
-        <h2>Workflows:</h2>
-        <blockquote>{wf_text}</blockquote>
-        <br>
-        <h2>Notebooks:</h2>
-        <blockquote>{nb_text}</blockquote>
-        </p>
-
-        </p></body>
-        </html>'''
-
-        message = message.format(status_color=status_color,
-                                 status_text=status_text,
-                                 workspace_link=self.link,
-                                 workspace=self.workspace,
-                                 workspace_orig=self.workspace_orig,
-                                 project_orig=self.project_orig,
-                                 time_text=time_text,
-                                 call_cache_text=call_cache_text,
-                                 wf_list=', '.join(workflows_list),
-                                 nb_list=', '.join(notebooks_list),
-                                 wf_text=workflows_text,
-                                 nb_text=notebooks_text
-                                 )
-        f.write(message)
-        f.close()
-
-        # upload report to google cloud bucket
-        report_path = upload_to_gcs(local_path, gcs_path, verbose)
-
-        self.report_path = report_path
+        # generate the html text for the report
+        message = WORKSPACE_REPORT.render(status_color=status_color,
+                                          status_text=status_text,
+                                          workspace_link=self.link,
+                                          workspace=self.workspace,
+                                          workspace_orig=self.workspace_orig,
+                                          project_orig=self.project_orig,
+                                          time_text=time_text,
+                                          call_cache_text=call_cache_text,
+                                          wf_list=', '.join(workflows_list),
+                                          nb_list=', '.join(notebooks_list),
+                                          wf_text=workflows_text,
+                                          nb_text=notebooks_text)
+
+        # upload report to google cloud bucket, in the background (the queue is flushed at the end of the run)
+        report_upload = get_upload_queue().submit_future(message, gcs_path, html_output, verbose)
+
+        self.report_path = upload_destination(html_output, gcs_path)[2]
         self.status = status_text
 
+        # and the machine-readable version of it, for rebuilding master reports without parsing the html
+        get_upload_queue().submit(dump_sidecar([self], report_name=html_output), gcs_path, sidecar_name(html_output),
+                                  verbose, public=False)
+
         DO_NOT_NOTIFY_LIST = ['help-gatk/Introduction-to-TCGA-Dataset',
                               'help-gatk/Introduction-to-Target-Dataset',
                               'kco-tech/Cumulus',
@@ -352,10 +393,18 @@ class Wspace:
             # print('send_notifications', send_notifications)
             # print('failed', failed)
             if send_notifications & failed:
+                # only link to the report once it's in the bucket
+                try:
+                    report_upload.result()
+                    report_uploaded = True
+                except Exception as e:
+                    print(f'Report for {workspace_key} was not uploaded ({e}); not linking it in the notification')
+                    report_uploaded = False
                 print('Sending failure notification email')
-                self.email_notification()
+                self.email_notification(report_uploaded)
 
-    def email_notification(self):
+    def email_notification(self, report_uploaded=True):
+        ''' email the owners of the featured workspace that its test failed, linking the report if it was uploaded '''
         from_email = 'terra-support-sendgrid@broadinstitute.org'
 
         # format email
@@ -363,11 +412,16 @@ class Wspace:
 
         to_emails = ', '.join(email_recipients)
 
+        if report_uploaded:
+            report_text = f'Please <a href="{self.report_path}">examine the report</a> to see what went wrong'
+        else:
+            report_text = f'Please examine the cloned workspace {self.project}/{self.workspace} to see what went wrong'
+
         subject = f'Workflow error(s) in Terra Featured Workspace {self.workspace_orig}'
         content = f'''Greetings! <br><br>
 An automated test of the workflow(s) in <b>{self.project_orig}/{self.workspace_orig}</b> failed. You are receiving this message because you are an owner of this workspace.
 <br><br>
-Please <a href="{self.report_path}">examine the report</a> to see what went wrong and save any needed changes.
+{report_text} and save any needed changes.
 <br><br>
 If you need help configuring your Featured Workspace workflows, please <a href="https://support.terra.bio/hc/en-us/articles/360033599791">check out the requirements here</a>.
 If you still have questions, contact terra-support@broadinstitute.org, or simply reply to this email.
@@ -388,6 +442,32 @@ P.S. You should receive a separate email from Terra with the subject line: "Terr
             self.share_workspace(email_to_add)
 
 
+def sidecar_name(report_name):
+    ''' name of the json sidecar of an html report, e.g. master_report_<clone time>.json '''
+    return report_name.rsplit('.html', 1)[0] + '.json'
+
+
+def dump_sidecar(workspaces, **info):
+    ''' json sidecar of a report: the full state (Wspace.to_dict) of its workspaces, plus info about the report
+    (e.g. report_name, clone_time, total_cost)
+    '''
+    sidecar = dict(info, version=SIDECAR_VERSION, workspaces=[ws.to_dict() for ws in workspaces])
+    return json.dumps(sidecar, separators=(',', ':'))
+
+
+def load_sidecar(text):
+    ''' read a json sidecar written by dump_sidecar: its dict, with 'workspaces' rebuilt as a dict of
+    original workspace key (project/workspace of the featured workspace) -> Wspace
+    '''
+    sidecar = json.loads(text)
+    workspaces = {}
+    for ws_dict in sidecar['workspaces']:
+        ws = Wspace.from_dict(ws_dict)
+        workspaces[(ws.project_orig or ws.project) + '/' + (ws.workspace_orig or ws.workspace)] = ws
+    sidecar['workspaces'] = workspaces
+    return sidecar
+
+
 if __name__ == "__main__":
     # test this out
     a_workspace = Wspace(workspace='name_of_workspace',